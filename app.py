@@ -1,40 +1,86 @@
-import dash
+import uuid
+
 import dash_bootstrap_components as dbc
+import flask
 from dash import dcc, html
+from dash_extensions.enrich import DashProxy, ServersideOutputTransform
 
+from callbacks.background import get_background_callback_manager
 from callbacks.callbacks import register_callbacks
+from callbacks.serverside import ArrowBackend
+from callbacks.tiles import register_tile_routes
 from constants import STAGE
 from layouts.body import plots, sidebar_controls
 from layouts.devbar import devbar
 from layouts.navbar import navbar
+from src.datasources import availability, metadata, polygon
+from src.utils import blockcache, db_utils, singleflight, tracing
 
-app = dash.Dash(
+app = DashProxy(
     __name__,
     suppress_callback_exceptions=True,
     external_stylesheets=[dbc.themes.BOOTSTRAP],
+    transforms=[ServersideOutputTransform(backends=[ArrowBackend()])],
+    background_callback_manager=get_background_callback_manager(),
 )
 server = app.server
 app.title = "DSCI Data Validation"
 
+
+@server.route("/stats/db-pool")
+def db_pool_stats():
+    return flask.jsonify(db_utils.get_pool_stats())
+
+
+@server.route("/stats/single-flight")
+def single_flight_stats():
+    return flask.jsonify(singleflight.get_stats())
+
+
+@server.route("/stats/block-cache")
+def block_cache_stats():
+    return flask.jsonify(blockcache.get_stats())
+
+
+@server.route("/metrics")
+def metrics():
+    return flask.Response(
+        tracing.render_metrics(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+register_tile_routes(server)
 register_callbacks(app)
 
-layout = [
-    navbar(title="Data Validation"),
-    html.Div(
-        [sidebar_controls([], []), plots()],
-        style={"display": "flex", "flexDirection": "row"},
-    ),
-    dcc.Store(id="raster-stats-data"),
-    dcc.Store(id="iso3-data"),
-    dcc.Interval(
-        id="interval-component", interval=500, max_intervals=1
-    ),  # Fires once, half second after page load
-]
 
-if STAGE == "dev":
-    layout.insert(0, devbar())
+def serve_layout():
+    layout = [
+        navbar(title="Data Validation"),
+        html.Div(
+            [sidebar_controls([], []), plots()],
+            style={"display": "flex", "flexDirection": "row"},
+        ),
+        dcc.Store(id="raster-stats-data"),
+        # The selected admin unit, set once its data is loaded in the worker
+        dcc.Store(id="aoi-data"),
+        # Inputs of the pixel series, only set for Floodscan
+        dcc.Store(id="pixel-series-request"),
+        dcc.Store(id="pixel-series-data"),
+        # Identifies the browser tab, whose superseded background jobs are
+        # cancelled. The id stored in the tab is kept over reloads
+        dcc.Store(
+            id="session-id", data=uuid.uuid4().hex, storage_type="session"
+        ),
+    ]
+    if STAGE == "dev":
+        layout.insert(0, devbar())
+    return html.Div(layout)
+
 
-app.layout = html.Div(layout)
+app.layout = serve_layout
 
 if __name__ == "__main__":
+    metadata.iso3_metadata.start()
+    availability.availability.start()
+    polygon.pcode_index.start()
     app.run(debug=True)
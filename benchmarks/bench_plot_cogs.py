@@ -0,0 +1,62 @@
+"""
+Compare the figure payload and build time of the "heatmap" and "image"
+renderings of `plot_cogs` for a SEAS5-like 7 leadtime figure, at the original
+0.4 degree resolution and upsampled to 0.05 degrees.
+
+Run from the repo root with `python -m benchmarks.bench_plot_cogs`.
+"""
+
+import timeit
+
+import numpy as np
+
+from benchmarks.bench_upsample import synthetic_stack
+from src.utils import plot_utils, raster
+
+SIZES = [(20, 20), (60, 80)]
+REPEAT = 3
+
+
+def smooth_stack(height, width):
+    # Smooth field with some noise, like precipitation, since uniform noise
+    # does not compress like real forecasts
+    da = synthetic_stack(height, width)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    lt = da["lt"].values[:, np.newaxis, np.newaxis]
+    values = 5 + 3 * np.sin(x / 7 + lt) * np.cos(y / 5)
+    values = values + rng.normal(0, 0.1, values.shape)
+    return da.copy(data=values[np.newaxis].astype(np.float32))
+
+
+def main():
+    print(
+        f"{'raster':>22} {'render':>8} {'payload (kB)':>13} "
+        f"{'build + JSON (ms)':>18}"
+    )
+    for height, width in SIZES:
+        da = smooth_stack(height, width)
+        for label, da_plot in [
+            ("original", da),
+            ("upsampled", raster.upsample_raster(da)),
+        ]:
+            da_plot = da_plot.sel(date="2024-01-01")
+            for render in ["heatmap", "image"]:
+
+                def build():
+                    fig = plot_utils.plot_cogs(
+                        da_plot, "", "mm/day", "months", render=render
+                    )
+                    return fig.to_json()
+
+                payload = len(build().encode())
+                seconds = min(timeit.repeat(build, number=1, repeat=REPEAT))
+                shape = "x".join(str(n) for n in da_plot.shape[1:])
+                print(
+                    f"{f'{label} {shape}':>22} {render:>8} "
+                    f"{payload / 1000:>13.1f} {seconds * 1000:>18.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the block-repeat and reprojection paths of `upsample_raster` on a
+synthetic SEAS5-like stack (7 leadtimes at 0.4 degrees) upsampled to the
+0.05 degree target grid.
+
+Run from the repo root with `python -m benchmarks.bench_upsample`.
+"""
+
+import timeit
+
+import numpy as np
+import xarray as xr
+from rasterio.transform import from_origin
+
+from src.utils import raster
+
+SIZES = [(20, 20), (60, 80), (180, 216)]
+REPEAT = 5
+
+
+def synthetic_stack(height, width, resolution=0.4, n_leadtimes=7):
+    rng = np.random.default_rng(0)
+    transform = from_origin(10, 30, resolution, resolution)
+    da = xr.DataArray(
+        rng.random((1, n_leadtimes, height, width), dtype=np.float32),
+        dims=("date", "lt", "y", "x"),
+        coords={
+            "date": ["2024-01-01"],
+            "lt": np.arange(n_leadtimes),
+            "x": transform.c + (np.arange(width) + 0.5) * transform.a,
+            "y": transform.f + (np.arange(height) + 0.5) * transform.e,
+        },
+    )
+    return da.rio.write_crs("EPSG:4326").rio.write_transform(transform)
+
+
+def main():
+    print(
+        f"{'shape':>12} {'reproject (ms)':>15} {'repeat (ms)':>12} {'speedup':>8}"
+    )
+    for height, width in SIZES:
+        da = synthetic_stack(height, width)
+        factor = 8
+        t_reproject = min(
+            timeit.repeat(
+                lambda: raster._upsample_reproject(
+                    da, height * factor, width * factor, "lt"
+                ),
+                number=1,
+                repeat=REPEAT,
+            )
+        )
+        t_repeat = min(
+            timeit.repeat(
+                lambda: raster.upsample_raster(da), number=1, repeat=REPEAT
+            )
+        )
+        print(
+            f"{f'{height}x{width}':>12} {t_reproject * 1000:>15.1f} "
+            f"{t_repeat * 1000:>12.1f} {t_reproject / t_repeat:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compare `raster.zonal_stats` with clipping one admin unit at a time, on a
+synthetic SEAS5-like stack upsampled to 0.05 degrees and Voronoi polygons
+standing in for admin levels of increasing detail.
+
+Run from the repo root with `python -m benchmarks.bench_zonal_stats`.
+"""
+
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+import shapely
+from rioxarray.exceptions import NoDataInBounds
+
+from benchmarks.bench_upsample import synthetic_stack
+from src.utils import raster
+
+N_POLYGONS = [20, 200, 1000]
+REPEAT = 3
+
+
+def synthetic_admin_units(n, bounds, seed=0):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    points = shapely.points(
+        rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)
+    )
+    extent = shapely.box(*bounds)
+    polygons = shapely.voronoi_polygons(
+        shapely.multipoints(points), extend_to=extent
+    )
+    return [polygon.intersection(extent) for polygon in polygons.geoms]
+
+
+def clip_loop(da, geometries, all_touched):
+    rows = []
+    for lt in da["lt"].values:
+        da_lt = da.sel(lt=lt)
+        for zone, geometry in enumerate(geometries):
+            try:
+                values = da_lt.rio.clip([geometry], all_touched=all_touched)
+                values = values.values[~np.isnan(values.values)]
+            except NoDataInBounds:
+                values = np.array([])
+            row = {"lt": lt, "zone": zone, "count": values.size}
+            if values.size:
+                row.update(
+                    mean=values.mean(),
+                    median=np.median(values),
+                    min=values.min(),
+                    max=values.max(),
+                    sum=values.sum(),
+                    std=values.std(),
+                )
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    # 7 leadtimes over 24 x 32 degrees, i.e. 480 x 640 pixels per leadtime
+    da = raster.upsample_raster(synthetic_stack(60, 80)).isel(date=0)
+    bounds = (10.5, 6.5, 41.5, 29.5)
+    print(
+        f"{'polygons':>9} {'all_touched':>12} {'clip loop (s)':>14} "
+        f"{'zonal_stats (s)':>16} {'speedup':>8} {'max rel diff':>13}"
+    )
+    for n in N_POLYGONS:
+        geometries = synthetic_admin_units(n, bounds)
+        for all_touched in [False, True]:
+            # The loop is only timed once, as it takes long on many polygons
+            start = time.perf_counter()
+            df_loop = clip_loop(da, geometries, all_touched)
+            t_loop = time.perf_counter() - start
+            t_zonal = min(
+                timeit.repeat(
+                    lambda: raster.zonal_stats(da, geometries, all_touched),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            df_zonal = raster.zonal_stats(da, geometries, all_touched)
+            df = df_zonal.merge(df_loop, on=["lt", "zone"])
+            diff = max(
+                np.nanmax(
+                    np.abs(df[f"{stat}_x"] - df[f"{stat}_y"])
+                    / np.maximum(np.abs(df[f"{stat}_y"]), 1e-6)
+                )
+                for stat in raster.ZONAL_STATS
+            )
+            print(
+                f"{n:>9} {str(all_touched):>12} {t_loop:>14.2f} "
+                f"{t_zonal:>16.3f} {t_loop / t_zonal:>7.0f}x {diff:>13.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Stand-in for `ocha_stratus` serving blobs from local directories and the
+database from a local SQLite file, so that the app's blob and database code
+paths run offline. Blob URLs point at a local HTTP server answering HEAD and
+range requests like blob storage, with a dummy SAS token.
+
+`install` must be called before any module of `src` is imported, since they
+bind `ocha_stratus` at import time.
+"""
+
+import multiprocessing
+import os
+import re
+import sys
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import geopandas as gpd
+import rioxarray as rxr
+from sqlalchemy import create_engine
+
+
+class LocalBlobProperties:
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.etag = f'"{stat.st_mtime_ns:x}{stat.st_size:x}"'
+        self.size = stat.st_size
+
+
+class LocalBlobClient:
+    def __init__(self, path, url=None):
+        self.path = path
+        self._url = url
+
+    @property
+    def url(self):
+        return self._url or self.path
+
+    def get_blob_properties(self):
+        return LocalBlobProperties(self.path)
+
+
+class LocalContainerClient:
+    """
+    The subset of `azure.storage.blob.ContainerClient` used by the app, over
+    a directory laid out like the container.
+    """
+
+    def __init__(self, root, url=None):
+        self.root = root
+        self.url = url
+
+    def get_blob_client(self, blob_name):
+        url = f"{self.url}/{blob_name}?sv=standin" if self.url else None
+        return LocalBlobClient(os.path.join(self.root, blob_name), url)
+
+    def list_blob_names(self, name_starts_with=""):
+        prefix_dir = os.path.dirname(name_starts_with)
+        directory = os.path.join(self.root, prefix_dir)
+        if not os.path.isdir(directory):
+            return
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if name.startswith(name_starts_with):
+                    yield name
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files under the server's `root` with their etag, answering
+    HEAD requests and GET requests for a single byte range.
+    """
+
+    def do_HEAD(self):
+        path = self._resolve()
+        if path is None:
+            return
+        self._send_headers(200, path, os.path.getsize(path))
+        self.end_headers()
+
+    def do_GET(self):
+        path = self._resolve()
+        if path is None:
+            return
+        size = os.path.getsize(path)
+        match = re.fullmatch(
+            r"bytes=(\d+)-(\d*)", self.headers.get("Range", "")
+        )
+        if match is None:
+            start, end = 0, size
+            self._send_headers(200, path, size)
+        else:
+            start = int(match[1])
+            end = min(int(match[2]) + 1 if match[2] else size, size)
+            if start >= end:
+                self.send_error(416)
+                return
+            self._send_headers(206, path, end - start)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end - 1}/{size}"
+            )
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            try:
+                self.wfile.write(f.read(end - start))
+            except (BrokenPipeError, ConnectionResetError):
+                # GDAL drops the connection once it has read enough
+                pass
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self):
+        name = unquote(urlsplit(self.path).path).lstrip("/")
+        path = os.path.join(self.server.root, name)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        return path
+
+    def _send_headers(self, status, path, length):
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", LocalBlobProperties(path).etag)
+
+
+def serve_blobs(blob_root):
+    """
+    Serve the containers under `blob_root` over HTTP on a local port, from a
+    daemon process. GDAL holds the GIL while it reads through /vsicurl, so
+    the server can't run in a thread of the reading process.
+
+    Returns
+    -------
+    str
+        Base URL of the containers.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    context.Process(
+        target=_serve_forever, args=(blob_root, sender), daemon=True
+    ).start()
+    return f"http://127.0.0.1:{receiver.recv()}"
+
+
+def _serve_forever(blob_root, sender):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.daemon_threads = True
+    server.root = blob_root
+    sender.send(server.server_port)
+    server.serve_forever()
+
+
+def make_module(blob_root, db_url, blob_url=None):
+    """
+    Build the stand-in module.
+
+    Parameters
+    ----------
+    blob_root : str
+        Directory with one subdirectory per container, e.g. "raster" and
+        "polygon".
+    db_url : str
+        SQLAlchemy URL returned for every stage.
+    blob_url : str, optional
+        Base URL serving `blob_root`, see `serve_blobs`. Blob clients return
+        local paths as their URL without it.
+    """
+    module = types.ModuleType("ocha_stratus")
+
+    def get_container_client(
+        container_name="projects", stage="dev", write=False
+    ):
+        return LocalContainerClient(
+            os.path.join(blob_root, container_name),
+            f"{blob_url}/{container_name}" if blob_url else None,
+        )
+
+    def get_engine(stage="dev", write=False):
+        return create_engine(db_url)
+
+    def load_shp_from_blob(
+        blob_name, shapefile=None, stage="dev", container_name="projects"
+    ):
+        path = os.path.join(blob_root, container_name, blob_name)
+        if shapefile is None:
+            return gpd.read_file(f"zip://{path}")
+        return gpd.read_file(f"zip://{path}!{shapefile}")
+
+    def open_blob_cog(blob_name, stage="dev", container_name="raster", **kw):
+        path = os.path.join(blob_root, container_name, blob_name)
+        return rxr.open_rasterio(path, **kw)
+
+    module.get_container_client = get_container_client
+    module.get_engine = get_engine
+    module.load_shp_from_blob = load_shp_from_blob
+    module.open_blob_cog = open_blob_cog
+    return module
+
+
+def install(blob_root, db_url):
+    """
+    Replace `ocha_stratus` with the stand-in for the rest of the process,
+    serving the blobs over HTTP.
+    """
+    if any(name.startswith("src.") for name in sys.modules):
+        raise RuntimeError("Install the stand-in before importing src")
+    sys.modules["ocha_stratus"] = make_module(
+        blob_root, db_url, serve_blobs(blob_root)
+    )
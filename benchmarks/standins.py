@@ -0,0 +1,261 @@
+"""
+Synthetic stand-ins for the data behind the app:
+
+- COGs on the Floodscan (1/12 degree, Africa) and SEAS5 (0.4 degree, global)
+  grids, named like the blobs of the "raster" container
+- Zipped COD-AB shapefiles of a synthetic country in the "polygon" container
+- A SQLite database with `iso3`, `polygon`, `floodscan` and `seas5` tables
+  covering the full record of both datasets
+
+Import this module only after `benchmarks.fake_stratus.install`, as it uses
+the blob naming of `src.datasources`.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import zipfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+from benchmarks.bench_zonal_stats import synthetic_admin_units
+from src.datasources import floodscan, seas5
+from src.utils import date_utils
+from src.validation import STAT_NAMES
+
+# Bump when the generated data changes, to rebuild existing stand-ins
+VERSION = 1
+
+ISO3 = "ABC"
+COUNTRY_BOUNDS = (30.0, -2.0, 38.0, 6.0)
+# Admin units per level below the country
+N_ADMIN_UNITS = {1: 10, 2: 200}
+# (minx, miny, maxx, maxy) and resolution of the COG grids
+FLOODSCAN_GRID = ((-18.0, -35.0, 52.0, 38.0), 1 / 12)
+SEAS5_GRID = ((-180.0, -90.0, 180.0, 90.0), 0.4)
+FLOODSCAN_DATES = [
+    d.strftime("%Y-%m-%d")
+    for d in pd.date_range("2024-12-22", "2024-12-31", freq="D")
+]
+SEAS5_DATES = ["2024-11-01", "2024-12-01"]
+LAST_DATE = "2024-12-31"
+
+
+def build(root):
+    """
+    Write the stand-ins under `root`, unless the current version is already
+    there.
+
+    Returns
+    -------
+    dict
+        "blob_root" and "db_url" to pass to `fake_stratus.install`.
+    """
+    paths = get_paths(root)
+    marker = os.path.join(root, "standins.json")
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f).get("version") == VERSION:
+                return paths
+
+    rng = np.random.default_rng(0)
+    admin_units = make_admin_units()
+    write_codab_zip(os.path.join(paths["blob_root"], "polygon"), admin_units)
+    raster_root = os.path.join(paths["blob_root"], "raster")
+    for date_str in FLOODSCAN_DATES:
+        write_cog(
+            os.path.join(
+                raster_root, floodscan.get_floodscan_blob_name(date_str)
+            ),
+            rng.random((2, *_grid_shape(FLOODSCAN_GRID)), np.float32),
+            FLOODSCAN_GRID,
+        )
+    for date_str in SEAS5_DATES:
+        for lt in seas5.SEAS5_LEADTIMES:
+            write_cog(
+                os.path.join(
+                    raster_root, seas5.get_seas5_blob_name(date_str, lt)
+                ),
+                (rng.random((1, *_grid_shape(SEAS5_GRID))) * 10).astype(
+                    np.float32
+                ),
+                SEAS5_GRID,
+                tags={"leadtime": lt},
+            )
+    seed_db(paths["db_path"], admin_units, rng)
+
+    with open(marker, "w") as f:
+        json.dump({"version": VERSION}, f)
+    return paths
+
+
+def get_paths(root):
+    db_path = os.path.join(root, "db.sqlite")
+    return {
+        "blob_root": os.path.join(root, "blobs"),
+        "db_path": db_path,
+        "db_url": f"sqlite:///{db_path}",
+    }
+
+
+def make_admin_units():
+    """
+    Get one GeoDataFrame per admin level, with the `ADM{n}_PCODE` and
+    `ADM{n}_EN` columns of COD-ABs.
+    """
+    levels = {0: [shapely.box(*COUNTRY_BOUNDS)]}
+    for adm_level, n in N_ADMIN_UNITS.items():
+        levels[adm_level] = synthetic_admin_units(
+            n, COUNTRY_BOUNDS, seed=adm_level
+        )
+    gdfs = {}
+    for adm_level, geometries in levels.items():
+        width = 2 * adm_level
+        pcodes = [
+            f"{ISO3[:2]}{i:0{width}d}" if width else ISO3[:2]
+            for i in range(1, len(geometries) + 1)
+        ]
+        gdfs[adm_level] = gpd.GeoDataFrame(
+            {
+                f"ADM{adm_level}_PCODE": pcodes,
+                f"ADM{adm_level}_EN": [f"Unit {pcode}" for pcode in pcodes],
+            },
+            geometry=geometries,
+            crs="EPSG:4326",
+        )
+    return gdfs
+
+
+def write_codab_zip(directory, admin_units):
+    os.makedirs(directory, exist_ok=True)
+    iso3 = ISO3.lower()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for adm_level, gdf in admin_units.items():
+            gdf.to_file(os.path.join(tmp_dir, f"{iso3}_adm{adm_level}.shp"))
+        with zipfile.ZipFile(
+            os.path.join(directory, f"{iso3}_shp.zip"), "w"
+        ) as zf:
+            for name in sorted(os.listdir(tmp_dir)):
+                zf.write(os.path.join(tmp_dir, name), name)
+
+
+def write_cog(path, values, grid, tags=None):
+    (minx, _, _, maxy), resolution = grid
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profile = {
+        "driver": "COG",
+        "count": values.shape[0],
+        "height": values.shape[1],
+        "width": values.shape[2],
+        "dtype": values.dtype,
+        "crs": "EPSG:4326",
+        "transform": from_origin(minx, maxy, resolution, resolution),
+        "blocksize": 256,
+        "overview_resampling": "average",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(values)
+        if tags:
+            dst.update_tags(**tags)
+
+
+def seed_db(db_path, admin_units, rng):
+    """
+    Create the tables read by the app, with stats for every date of the
+    record for the country and its first level admin units, and the indexes
+    of `sql/indexes.sql`.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    max_adm_level = max(admin_units)
+    df_iso3 = pd.DataFrame(
+        {"iso3": [ISO3], "max_adm_level": [max_adm_level], "floodscan": [1]}
+    )
+    df_polygon = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "iso3": ISO3,
+                    "adm_level": adm_level,
+                    "pcode": gdf[f"ADM{adm_level}_PCODE"],
+                    "name": gdf[f"ADM{adm_level}_EN"],
+                }
+            )
+            for adm_level, gdf in admin_units.items()
+        ],
+        ignore_index=True,
+    )
+    units = df_polygon[df_polygon["adm_level"] <= 1]
+
+    floodscan_dates = pd.date_range(
+        date_utils.DATE_RANGES["floodscan"]["start_date"], LAST_DATE, freq="D"
+    ).strftime("%Y-%m-%d")
+    df_floodscan = pd.merge(
+        units[["iso3", "pcode", "adm_level"]],
+        pd.DataFrame({"band": list(floodscan.FLOODSCAN_BANDS)}),
+        how="cross",
+    ).merge(pd.DataFrame({"valid_date": floodscan_dates}), how="cross")
+    df_floodscan = _add_stats(df_floodscan, rng)
+
+    issued_dates = pd.date_range(
+        date_utils.DATE_RANGES["seas5"]["start_date"], LAST_DATE, freq="MS"
+    )
+    df_seas5 = pd.merge(
+        units[["iso3", "pcode", "adm_level"]],
+        pd.DataFrame({"issued_date": issued_dates}),
+        how="cross",
+    ).merge(
+        pd.DataFrame({"leadtime": list(seas5.SEAS5_LEADTIMES)}), how="cross"
+    )
+    valid_dates = [
+        issued + pd.DateOffset(months=lt)
+        for issued, lt in zip(df_seas5["issued_date"], df_seas5["leadtime"])
+    ]
+    df_seas5["valid_date"] = pd.DatetimeIndex(valid_dates).strftime("%Y-%m-%d")
+    df_seas5["issued_date"] = df_seas5["issued_date"].dt.strftime("%Y-%m-%d")
+    df_seas5 = _add_stats(df_seas5, rng)
+
+    with sqlite3.connect(db_path) as con:
+        df_iso3.to_sql("iso3", con, index=False)
+        df_polygon.to_sql("polygon", con, index=False)
+        df_floodscan.to_sql("floodscan", con, index=False, chunksize=50000)
+        df_seas5.to_sql("seas5", con, index=False, chunksize=50000)
+        for statement in _index_statements():
+            con.execute(statement)
+
+
+def _add_stats(df, rng):
+    values = rng.random((len(df), len(STAT_NAMES)), np.float32)
+    df_stats = pd.DataFrame(values, columns=STAT_NAMES, index=df.index)
+    df_stats["count"] = (df_stats["count"] * 100).astype(int)
+    return pd.concat([df, df_stats], axis=1)
+
+
+def _index_statements():
+    # The Postgres indexes of the repo, without the Postgres-only options
+    path = os.path.join(os.path.dirname(__file__), "..", "sql", "indexes.sql")
+    with open(path) as f:
+        statements = f.read().split(";")
+    for statement in statements:
+        lines = [
+            line
+            for line in statement.splitlines()
+            if not line.startswith("--")
+        ]
+        statement = "\n".join(lines).strip()
+        if statement:
+            yield statement.replace("CONCURRENTLY ", "")
+
+
+def _grid_shape(grid):
+    (minx, miny, maxx, maxy), resolution = grid
+    return (
+        round((maxy - miny) / resolution),
+        round((maxx - minx) / resolution),
+    )
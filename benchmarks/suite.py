@@ -0,0 +1,489 @@
+"""
+Time the datasources, raster utils, plotting and every Dash callback end to
+end against synthetic stand-ins of the blob containers and the database (see
+`benchmarks.standins`), served through a stand-in of `ocha_stratus`.
+
+The caches start empty on each run. Each case is timed on its first call,
+which may fill caches, and on `--repeat` more calls. The results are written
+as JSON and compared with a previous run given as the
+baseline, exiting with an error if any case got slower than the threshold.
+
+Run from the repo root with
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --output new.json --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks import fake_stratus
+
+DEFAULT_WORKDIR = os.path.join(
+    tempfile.gettempdir(), "ds-app-data-validation-bench"
+)
+# Seconds between polls of background callback jobs
+POLL_INTERVAL = 0.02
+REPEAT = 5
+
+# Values of the app's controls in the callback cases, per dataset
+SCENARIOS = {
+    "floodscan": {
+        "dataset-dropdown.value": "floodscan",
+        "issue-date-dropdown.value": "2024-12-31",
+        "issue-date-dropdown.search_value": "2024-12",
+    },
+    "seas5": {
+        "dataset-dropdown.value": "seas5",
+        "issue-date-dropdown.value": "2024-12-01",
+        "issue-date-dropdown.search_value": "2024-1",
+    },
+}
+CONTROLS = {
+    "iso3-dropdown.value": "ABC",
+    "adm-level-dropdown.value": "1",
+    "pcode-dropdown.value": "AB01",
+    "pcode-dropdown.search_value": "Unit AB0",
+    "band-select.value": "SFED",
+    "map-leadtime.value": 0,
+    "raster-display.value": "upsampled",
+    "stat-dropdown.value": "mean",
+    # A pixel of the synthetic country
+    "cog-map.clickData": {"latlng": {"lat": 5.5, "lng": 30.5}},
+}
+
+
+def configure(workdir):
+    """
+    Point the app at the stand-ins under `workdir`, with empty caches. Must
+    run before any module of `src` is imported.
+    """
+    cache_dir = os.path.join(workdir, "cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.environ.update(
+        {"STAGE": "dev", "DSCI_CACHE_DIR": cache_dir, "DSCI_TRACING": "false"}
+    )
+    # Go through the blob and database code paths rather than the local
+    # overrides
+    for name in [
+        "DSCI_DB_URL",
+        "DSCI_LOCAL_RASTER_DIR",
+        "DSCI_LOCAL_CODAB_DIR",
+    ]:
+        os.environ.pop(name, None)
+    paths_root = os.path.join(workdir, "standins")
+    fake_stratus.install(
+        os.path.join(paths_root, "blobs"),
+        f"sqlite:///{os.path.join(paths_root, 'db.sqlite')}",
+    )
+    return paths_root
+
+
+def get_cases():
+    """
+    List the cases as (name, function) pairs, in the order they are run.
+    """
+    from benchmarks.standins import ISO3
+    from src.datasources import (
+        availability,
+        codab,
+        floodscan,
+        polygon,
+        seas5,
+    )
+    from src.utils import plot_utils, raster
+
+    pcode = CONTROLS["pcode-dropdown.value"]
+    floodscan_date = SCENARIOS["floodscan"]["issue-date-dropdown.value"]
+    seas5_date = SCENARIOS["seas5"]["issue-date-dropdown.value"]
+    gdf = codab.load_codab_geometry(ISO3, 1, pcode)
+    gdf_adm2 = codab.load_codab(ISO3, 2)
+
+    da_floodscan = floodscan.open_floodscan_rasters(
+        floodscan_date, "SFED", bbox=gdf
+    ).load()
+    da_seas5 = seas5.open_seas5_rasters(seas5_date, bbox=gdf)
+    da_seas5_upsampled = raster.upsample_raster(
+        raster.clip(da_seas5, gdf, all_touched=True)
+    )
+    da_seas5_plot = raster.clip(da_seas5_upsampled, gdf).sel(date=seas5_date)
+    da_seas5_country = raster.upsample_raster(
+        seas5.open_seas5_rasters(seas5_date, bbox=gdf_adm2)
+    ).isel(date=0)
+    df_floodscan = floodscan.get_raster_stats(
+        ISO3, pcode, floodscan_date, "SFED"
+    )
+    df_seas5 = seas5.get_raster_stats(ISO3, pcode, seas5_date)
+
+    cases = [
+        (
+            "floodscan.get_raster_stats",
+            lambda: floodscan.get_raster_stats(
+                ISO3, pcode, floodscan_date, "SFED"
+            ),
+        ),
+        (
+            "seas5.get_raster_stats",
+            lambda: seas5.get_raster_stats(ISO3, pcode, seas5_date),
+        ),
+        (
+            "floodscan.open_floodscan_rasters",
+            lambda: floodscan.open_floodscan_rasters(
+                floodscan_date, "SFED", bbox=gdf
+            ).load(),
+        ),
+        (
+            "seas5.open_seas5_rasters",
+            lambda: seas5.open_seas5_rasters(seas5_date, bbox=gdf),
+        ),
+        ("codab.load_codab[adm2]", lambda: codab.load_codab(ISO3, 2)),
+        (
+            "polygon.search_pcodes",
+            lambda: polygon.search_pcodes(ISO3, 2, "Unit AB00"),
+        ),
+        (
+            "availability.search_dates",
+            lambda: availability.search_dates("floodscan", "2024-1"),
+        ),
+        (
+            "raster.upsample_raster[floodscan]",
+            lambda: raster.upsample_raster(da_floodscan),
+        ),
+        (
+            "raster.upsample_raster[seas5]",
+            lambda: raster.upsample_raster(da_seas5),
+        ),
+        (
+            "raster.clip[seas5 upsampled]",
+            lambda: raster.clip(
+                da_seas5_upsampled, gdf, cache_key=("bench", pcode)
+            ),
+        ),
+        (
+            "raster.zonal_stats[seas5 adm2]",
+            lambda: raster.zonal_stats(da_seas5_country, gdf_adm2.geometry),
+        ),
+        (
+            "plot_utils.plot_cogs[seas5]",
+            lambda: plot_utils.plot_cogs(
+                da_seas5_plot, "", "mm/day", "months"
+            ).to_json(),
+        ),
+        (
+            "plot_utils.plot_floodscan_timeseries",
+            lambda: plot_utils.plot_floodscan_timeseries(
+                df_floodscan, floodscan_date
+            ).to_json(),
+        ),
+        (
+            "plot_utils.plot_seas5_timeseries",
+            lambda: plot_utils.plot_seas5_timeseries(
+                df_seas5, seas5_date
+            ).to_json(),
+        ),
+    ]
+    return cases + get_callback_cases()
+
+
+def get_callback_cases():
+    """
+    List a case per callback and dataset, posting the callback's inputs to
+    the app like the browser does, and a case per dataset for map tiles.
+    """
+    import app
+    from callbacks.tiles import get_tile_url
+
+    client = app.server.test_client()
+    client.get("/")
+    dependencies = client.get("/_dash-dependencies").get_json()
+    names = {
+        output: spec["callback"].__name__
+        for output, spec in app.app.callback_map.items()
+    }
+
+    cases = []
+    for dataset, scenario in SCENARIOS.items():
+        values = {**CONTROLS, **scenario}
+        # The admin unit is loaded in the worker before the background jobs
+        values["aoi-data.data"] = _post_callback(
+            client, _find_dependency(dependencies, "aoi-data.data"), values
+        )["aoi-data"]["data"]
+        # The stats frame is stored server-side, and only its key is passed
+        # to the plotting callback
+        values["raster-stats-data.data"] = _post_callback(
+            client,
+            _find_dependency(dependencies, "raster-stats-data.data"),
+            values,
+        )["raster-stats-data"]["data"]
+        # Only set for Floodscan, whose pixel series is drawn
+        response = _post_callback(
+            client,
+            _find_dependency(dependencies, "pixel-series-request.data"),
+            values,
+        )
+        values["pixel-series-request.data"] = (
+            (response or {}).get("pixel-series-request", {}).get("data")
+        )
+        # Stored server-side like the raster stats, so that changing the
+        # stat only re-renders it
+        values["pixel-series-data.data"] = _post_callback(
+            client,
+            _find_dependency(dependencies, "pixel-series-data.data"),
+            values,
+        )["pixel-series-data"]["data"]
+        for dependency in dependencies:
+            name = f"callback.{names[dependency['output']]}[{dataset}]"
+            cases.append(
+                (
+                    name,
+                    lambda d=dependency, v=values: _post_callback(
+                        client, d, v
+                    ),
+                )
+            )
+
+        layer = "SFED" if dataset == "floodscan" else "0"
+        date_str = scenario["issue-date-dropdown.value"]
+        # Tile over the synthetic country at zoom 6
+        url = get_tile_url(dataset, date_str, layer).format(z=6, x=38, y=31)
+        cases.append((f"route.tile[{dataset}]", lambda u=url: _get(client, u)))
+    return cases
+
+
+def _find_dependency(dependencies, output):
+    return next(d for d in dependencies if output in d["output"])
+
+
+def _post_callback(client, dependency, values):
+    def props(specs):
+        return [
+            {
+                "id": spec["id"],
+                "property": spec["property"],
+                "value": values.get(f"{spec['id']}.{spec['property']}"),
+            }
+            for spec in specs
+        ]
+
+    outputs = _parse_outputs(dependency["output"])
+    body = {
+        "output": dependency["output"],
+        "outputs": outputs if len(outputs) > 1 else outputs[0],
+        "inputs": props(dependency["inputs"]),
+        "state": props(dependency["state"]),
+        "changedPropIds": [],
+    }
+    url = "/_dash-update-component"
+    polled_after_exit = False
+    while True:
+        response = client.post(url, json=body)
+        if response.status_code == 204 and "job=" in url:
+            # Dash reads the result before checking that the job is still
+            # running, so a job exiting in between is taken for a cancelled
+            # one. Its result is still stored and returned by the next poll.
+            if not polled_after_exit:
+                polled_after_exit = True
+                continue
+        if response.status_code == 204:  # PreventUpdate
+            return None
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"{dependency['output']} failed with {response.status_code}"
+            )
+        data = response.get_json()
+        if "response" in data:
+            return data["response"]
+        # Background callbacks return the job, polled like the renderer does
+        # until its result is stored
+        if "cacheKey" in data:
+            url = (
+                f"/_dash-update-component?cacheKey={data['cacheKey']}"
+                f"&job={data['job']}"
+            )
+        time.sleep(POLL_INTERVAL)
+
+
+def _parse_outputs(output):
+    # "id.prop", "id.prop@hash" for duplicate outputs, or "..a.x...b.y.."
+    # for multiple outputs
+    specs = (
+        output.strip(".").split("...") if output.startswith("..") else [output]
+    )
+    outputs = []
+    for spec in specs:
+        component_id, prop = spec.split("@")[0].rsplit(".", 1)
+        outputs.append({"id": component_id, "property": prop})
+    return outputs
+
+
+def _get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} failed with {response.status_code}")
+    return response.data
+
+
+def run_case(func, repeat):
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "first_s": first,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+    }
+
+
+def compare(results, baseline, threshold, min_delta):
+    """
+    Compare the fastest time of each case with the baseline.
+
+    Returns
+    -------
+    list of tuple
+        (name, seconds, baseline seconds, relative change, regressed) for
+        each case, with None for cases missing from the baseline.
+    """
+    rows = []
+    for name, result in results.items():
+        seconds = result["min_s"]
+        base = baseline.get(name, {}).get("min_s")
+        if base is None:
+            rows.append((name, seconds, None, None, False))
+            continue
+        change = seconds / base - 1 if base > 0 else 0.0
+        regressed = change > threshold and seconds - base > min_delta
+        rows.append((name, seconds, base, change, regressed))
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", required=True, help="Results JSON path")
+    parser.add_argument("--baseline", help="Results JSON to compare with")
+    parser.add_argument(
+        "--workdir",
+        default=DEFAULT_WORKDIR,
+        help="Directory of the stand-ins and caches",
+    )
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument(
+        "-k",
+        dest="pattern",
+        help="Only run the cases whose name contains this string",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown reported as a regression",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=1.0,
+        help="Ignore slowdowns smaller than this, as noise",
+    )
+    args = parser.parse_args()
+
+    standins_root = configure(args.workdir)
+    from benchmarks import standins
+
+    start = time.perf_counter()
+    standins.build(standins_root)
+    print(f"Stand-ins ready in {time.perf_counter() - start:.1f}s")
+
+    from src.constants import STATS_BACKEND
+
+    if STATS_BACKEND == "parquet":
+        from src.datasources.stats_mirror import sync_metadata, sync_table
+
+        start = time.perf_counter()
+        for table in ["floodscan", "seas5"]:
+            sync_table(table)
+        for table in ["iso3", "polygon"]:
+            sync_metadata(table)
+        print(f"Stats mirror synced in {time.perf_counter() - start:.1f}s")
+
+    results = {}
+    for name, func in get_cases():
+        if args.pattern and args.pattern not in name:
+            continue
+        results[name] = run_case(func, args.repeat)
+        result = results[name]
+        print(
+            f"{name:<55} first {result['first_s'] * 1000:>9.1f} ms   "
+            f"min {result['min_s'] * 1000:>9.1f} ms   "
+            f"median {result['median_s'] * 1000:>9.1f} ms"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now(timezone.utc).isoformat(),
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "repeat": args.repeat,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(
+        results,
+        baseline["results"],
+        args.threshold,
+        args.min_delta_ms / 1000,
+    )
+    print(f"\nCompared with {args.baseline} ({baseline.get('commit')})")
+    n_regressed = 0
+    for name, seconds, base, change, regressed in rows:
+        if base is None:
+            print(f"{name:<55} {seconds * 1000:>9.1f} ms   (new)")
+            continue
+        flag = "  REGRESSION" if regressed else ""
+        print(
+            f"{name:<55} {seconds * 1000:>9.1f} ms   "
+            f"was {base * 1000:>9.1f} ms   {change:>+7.1%}{flag}"
+        )
+        n_regressed += regressed
+    if n_regressed:
+        print(f"\n{n_regressed} regressions beyond {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import os
+import threading
+
+import diskcache
+from dash import DiskcacheManager
+from dash.exceptions import PreventUpdate
+
+from src.constants import JOB_CACHE_DIR, JOB_EXPIRE
+
+# Cache of the job generations, opened once per process since the job
+# processes are forked from the workers
+_generations = None
+_generations_pid = None
+_lock = threading.Lock()
+
+
+def get_background_callback_manager():
+    """
+    Get the manager running background callbacks in separate processes, with
+    their progress and results in a disk cache shared by all workers.
+    """
+    cache = diskcache.Cache(os.path.join(JOB_CACHE_DIR, "results"))
+    return DiskcacheManager(cache, expire=JOB_EXPIRE)
+
+
+class Superseded(PreventUpdate):
+    """
+    Raised in a background job once a newer job of the same callback has
+    started in the same browser session. Dash leaves the outputs unchanged.
+    """
+
+
+class SessionJob:
+    """
+    A run of a background callback in a browser session.
+
+    Starting a job bumps the generation of the callback in the session, so
+    that older jobs still running see at their next `checkpoint` that they
+    are superseded and stop. Dash terminates the previous job of a callback
+    itself when the page that started it triggers it again. The generation
+    also covers jobs the page no longer tracks, e.g. after a reload.
+
+    Parameters
+    ----------
+    session_id : str or None
+        Id of the browser session. Without it the job is never superseded.
+    name : str
+        Name of the callback.
+    set_progress : callable, optional
+        Progress setter of the background callback, called with the message
+        of each checkpoint.
+    """
+
+    def __init__(self, session_id, name, set_progress=None):
+        self.key = f"{name}/{session_id}" if session_id else None
+        self.set_progress = set_progress
+        self.generation = None
+        if self.key is not None:
+            generations = _get_generations()
+            self.generation = generations.incr(self.key)
+            generations.touch(self.key, expire=JOB_EXPIRE)
+
+    def checkpoint(self, message=None):
+        """
+        Stop the job if it has been superseded, and report `message` as its
+        progress otherwise. Call between I/O and compute stages.
+
+        Raises
+        ------
+        Superseded
+        """
+        if self.superseded():
+            raise Superseded(f"{self.key} superseded")
+        if message and self.set_progress is not None:
+            self.set_progress(message)
+
+    def superseded(self):
+        if self.key is None:
+            return False
+        return _get_generations().get(self.key) != self.generation
+
+
+def _get_generations():
+    global _generations, _generations_pid
+    with _lock:
+        if _generations_pid != os.getpid():
+            _generations = diskcache.Cache(
+                os.path.join(JOB_CACHE_DIR, "generations")
+            )
+            _generations_pid = os.getpid()
+        return _generations
@@ -1,27 +1,36 @@
+import logging
+from datetime import datetime, timedelta
+
 import dash
-import ocha_stratus as stratus
-import pandas as pd
 from dash.dependencies import Input, Output, State
+from dash_extensions.enrich import Serverside
 from rasterio.errors import RasterioIOError
-from sqlalchemy import text
+from rioxarray.exceptions import NoDataInBounds
+
+from callbacks.background import SessionJob
+from callbacks.tiles import get_tile_url
+from src.constants import (
+    DATE_PAGE_SIZE,
+    FLOODSCAN_SERIES_DAYS,
+    JOB_POLL_INTERVAL,
+    PCODE_PAGE_SIZE,
+)
+from src.datasources import (
+    availability,
+    climatology,
+    codab,
+    floodscan,
+    metadata,
+    polygon,
+    seas5,
+)
+from src.utils import plot_utils, raster, tracing
 
-from constants import STAGE
-from src.datasources import codab, floodscan, seas5
-from src.utils import date_utils, plot_utils, raster
+logger = logging.getLogger(__name__)
 
 
 def register_callbacks(app):
-    @app.callback(
-        Output("iso3-data", "data"), Input("interval-component", "n_intervals")
-    )
-    def load_iso3_data(_):
-        print("Loading ISO3 data...")
-        engine = stratus.get_engine(STAGE)
-        with engine.connect() as conn:
-            df_iso3 = pd.read_sql(
-                "select iso3, max_adm_level, floodscan from iso3", con=conn
-            )
-        return df_iso3.to_dict()
+    app = tracing.instrument(app)
 
     @app.callback(
         Output("band-select-div", "style"), Input("dataset-dropdown", "value")
@@ -31,43 +40,72 @@ def register_callbacks(app):
             return {}
         return {"display": "none"}
 
+    @app.callback(
+        Output("map-leadtime-div", "style"), Input("dataset-dropdown", "value")
+    )
+    def display_map_leadtime(dataset):
+        if dataset == "seas5":
+            return {}
+        return {"display": "none"}
+
+    @app.callback(
+        Output("pixel-series-div", "style"),
+        Input("dataset-dropdown", "value"),
+    )
+    def display_pixel_series(dataset):
+        if dataset == "floodscan":
+            return {}
+        return {"display": "none"}
+
     @app.callback(
         Output("issue-date-dropdown", "options"),
         Output("issue-date-dropdown", "value"),
         Input("dataset-dropdown", "value"),
     )
     def update_issue_dates(dataset):
-        dates = date_utils.get_date_range(dataset)
-        return dates, dates[0]
+        matches, total = availability.search_dates(
+            dataset, limit=DATE_PAGE_SIZE
+        )
+        options = _add_more_hint(_date_options(matches), total - len(matches))
+        return options, availability.get_default_date(dataset)
+
+    @app.callback(
+        Output("issue-date-dropdown", "options", allow_duplicate=True),
+        Input("issue-date-dropdown", "search_value"),
+        State("dataset-dropdown", "value"),
+        State("issue-date-dropdown", "value"),
+        prevent_initial_call=True,
+    )
+    def search_issue_dates(search_value, dataset, issue_date):
+        matches, total = availability.search_dates(
+            dataset, search_value or "", limit=DATE_PAGE_SIZE
+        )
+        options = _date_options(matches)
+        # The dropdown only shows the label of a value among its options
+        if issue_date and issue_date not in (d for d, _, _ in matches):
+            options.insert(0, {"label": issue_date, "value": issue_date})
+        return _add_more_hint(options, total - len(matches))
 
     @app.callback(
         Output("iso3-dropdown", "options"),
         Output("iso3-dropdown", "value"),
         Input("dataset-dropdown", "value"),
-        Input("iso3-data", "data"),
     )
-    def update_iso3(dataset, iso3_data):
-        if iso3_data:
-            df_iso3 = pd.DataFrame.from_dict(iso3_data)
-            if dataset == "floodscan":
-                df_iso3 = df_iso3[df_iso3["floodscan"]]
-            iso3s = list(df_iso3["iso3"])
-            return iso3s, iso3s[0]
-        return dash.no_update, dash.no_update
+    def update_iso3(dataset):
+        iso3s = metadata.get_iso3s(dataset)
+        if iso3s:
+            return list(iso3s), iso3s[0]
+        return [], None
 
     @app.callback(
         Output("adm-level-dropdown", "options"),
         Input("iso3-dropdown", "value"),
-        Input("iso3-data", "data"),
     )
-    def update_adm_level(iso3, iso3_data):
-        if iso3_data:
-            df_iso3 = pd.DataFrame.from_dict(iso3_data)
-            max_adm_level = df_iso3.loc[
-                df_iso3["iso3"] == iso3, "max_adm_level"
-            ].values[0]
-            return list(range(max_adm_level + 1))
-        return dash.no_update
+    def update_adm_level(iso3):
+        max_adm_level = metadata.get_max_adm_level(iso3)
+        if max_adm_level is None:
+            return []
+        return list(range(max_adm_level + 1))
 
     @app.callback(
         Output("pcode-dropdown", "options"),
@@ -76,46 +114,101 @@ def register_callbacks(app):
         Input("adm-level-dropdown", "value"),
     )
     def update_pcode(iso3, adm_level):
-        engine = stratus.get_engine(STAGE)
-        with engine.connect() as conn:
-            df_pcodes = pd.read_sql(
-                text(
-                    """
-                select iso3, pcode, name, adm_level from polygon
-                where iso3=:iso3 and
-                adm_level=:adm_level
-                """
-                ),
-                con=conn,
-                params={"iso3": iso3, "adm_level": adm_level},
-            )
-        df_pcodes = df_pcodes.sort_values("name", ascending=True)
-        options = [
-            {"label": row["name"], "value": row["pcode"]}
-            for _, row in df_pcodes.iterrows()
-        ]
-        pcode_value = options[0]["value"] if len(options) == 1 else None
+        if not iso3 or adm_level is None:
+            return [], None
+        matches, total = polygon.search_pcodes(
+            iso3, adm_level, limit=PCODE_PAGE_SIZE
+        )
+        pcode_value = matches[0][0] if total == 1 else None
+        options = _add_more_hint(_pcode_options(matches), total - len(matches))
         return options, pcode_value
 
     @app.callback(
-        Output("raster-stats-data", "data"),
-        Output(
-            "chart-leadtime-series", "figure"
-        ),  # Just here to show loading status
+        Output("pcode-dropdown", "options", allow_duplicate=True),
+        Input("pcode-dropdown", "search_value"),
+        State("iso3-dropdown", "value"),
+        State("adm-level-dropdown", "value"),
+        State("pcode-dropdown", "value"),
+        prevent_initial_call=True,
+    )
+    def search_pcode(search_value, iso3, adm_level, pcode):
+        if not iso3 or adm_level is None:
+            return dash.no_update
+        matches, total = polygon.search_pcodes(
+            iso3, adm_level, search_value or "", limit=PCODE_PAGE_SIZE
+        )
+        options = _pcode_options(matches)
+        # The dropdown only shows the label of a value among its options
+        if pcode and pcode not in (pcode for pcode, _ in matches):
+            name = polygon.get_pcode_name(iso3, adm_level, pcode)
+            options.insert(0, {"label": name or pcode, "value": pcode})
+        return _add_more_hint(options, total - len(matches))
+
+    @app.callback(
+        Output("aoi-data", "data"),
         Input("dataset-dropdown", "value"),
         Input("iso3-dropdown", "value"),
         Input("adm-level-dropdown", "value"),
         Input("pcode-dropdown", "value"),
-        Input("issue-date-dropdown", "value"),
         Input("band-select", "value"),
     )
-    def get_raster_stats(dataset, iso3, adm_level, pcode, issue_date, band):
-        if dataset and iso3 and adm_level and pcode and issue_date:
+    def load_aoi(dataset, iso3, adm_level, pcode, band):
+        # Background jobs are forked from the worker and lose what they
+        # cache in memory, so the COD-AB and stats history of the admin
+        # unit are loaded here, into the caches of the worker, before the
+        # jobs reading them are started
+        if not (dataset and iso3 and adm_level and pcode):
+            return None
+        if dataset != "floodscan":
+            band = None
+        try:
+            with tracing.span("codab"):
+                codab.load_codab_geometry(iso3, adm_level, pcode)
+            if dataset == "floodscan":
+                with tracing.span("db"):
+                    floodscan.warm_raster_stats(iso3, pcode, band)
+        except Exception:
+            # The jobs load it themselves and report the error
+            logger.exception(f"Loading {iso3} {pcode} failed")
+        return {
+            "dataset": dataset,
+            "iso3": iso3,
+            "adm_level": adm_level,
+            "pcode": pcode,
+            "band": band,
+        }
+
+    @app.callback(
+        Output("raster-stats-data", "data"),
+        Output(
+            "chart-leadtime-series", "figure"
+        ),  # Just here to show loading status
+        Input("aoi-data", "data"),
+        Input("issue-date-dropdown", "value"),
+        State("session-id", "data"),
+        background=True,
+        progress=Output("chart-leadtime-series-progress", "children"),
+        interval=JOB_POLL_INTERVAL,
+    )
+    def get_raster_stats(set_progress, aoi, issue_date, session):
+        if aoi and issue_date:
+            dataset, iso3, pcode, band = (
+                aoi["dataset"],
+                aoi["iso3"],
+                aoi["pcode"],
+                aoi["band"],
+            )
+            job = SessionJob(session, "get_raster_stats", set_progress)
+            job.checkpoint("Querying raster stats")
             if dataset == "seas5":
                 df = seas5.get_raster_stats(iso3, pcode, issue_date)
             elif dataset == "floodscan":
                 df = floodscan.get_raster_stats(iso3, pcode, issue_date, band)
-            return df.to_dict("records"), dash.no_update
+            job.checkpoint()
+            # Only a key to the frame goes through the browser
+            return Serverside(
+                df, key=f"{dataset}/{iso3}/{pcode}/{issue_date}/{band}"
+            ), dash.no_update
         return None, dash.no_update
 
     @app.callback(
@@ -126,63 +219,276 @@ def register_callbacks(app):
         State("issue-date-dropdown", "value"),
         prevent_initial_call=True,
     )
-    def plot_raster_stats(data, stat, dataset, issued_date):
-        if data:
-            df = pd.DataFrame(data)
+    def plot_raster_stats(df, stat, dataset, issued_date):
+        if df is not None and not df.empty:
             if dataset == "seas5":
                 return plot_utils.plot_seas5_timeseries(df, issued_date, stat)
             elif dataset == "floodscan":
                 return plot_utils.plot_floodscan_timeseries(
                     df, issued_date, stat
                 )
-        elif data == []:
+        elif df is not None:
             return plot_utils.blank_plot("No data available")
         return plot_utils.blank_plot("Select AOI from dropdowns")
 
     @app.callback(
         Output("chart-cog", "figure"),
-        Input("iso3-dropdown", "value"),
-        Input("adm-level-dropdown", "value"),
-        Input("pcode-dropdown", "value"),
+        Input("aoi-data", "data"),
         Input("issue-date-dropdown", "value"),
         Input("raster-display", "value"),
-        Input("band-select", "value"),
-        State("dataset-dropdown", "value"),
+        State("session-id", "data"),
+        background=True,
+        progress=Output("chart-cog-progress", "children"),
+        interval=JOB_POLL_INTERVAL,
     )
-    def plot_cogs(
-        iso3, adm_level, pcode, issue_date, raster_display, band, dataset
-    ):
-        if iso3 and adm_level and pcode and issue_date:
+    def plot_cogs(set_progress, aoi, issue_date, raster_display, session):
+        if aoi and issue_date:
+            dataset, iso3, adm_level, pcode, band = (
+                aoi["dataset"],
+                aoi["iso3"],
+                aoi["adm_level"],
+                aoi["pcode"],
+                aoi["band"],
+            )
+            # Superseded jobs of the session stop at the next checkpoint,
+            # before their next download or computation
+            job = SessionJob(session, "plot_cogs", set_progress)
+            job.checkpoint("Loading admin boundaries")
             # Get the geo bounds
-            gdf = codab.load_codab_from_blob(iso3, admin_level=adm_level)
-            gdf = gdf[gdf[f"ADM{adm_level}_PCODE"] == pcode]
+            with tracing.span("codab"):
+                gdf = codab.load_codab_geometry(iso3, adm_level, pcode)
+            if gdf.empty:
+                return plot_utils.blank_plot("No data in bounds")
 
-            # Get the seas5 rasters
+            # Get the seas5 rasters, reading only the window around the AOI
+            job.checkpoint("Reading COGs")
             try:
-                if dataset == "seas5":
-                    title = "Pixelwise precipitation (mm/day) across leadtimes"
-                    da = seas5.open_seas5_rasters(issue_date)
-                    units = "mm/day"
-                    leadtime_units = "months"
-                elif dataset == "floodscan":
-                    title = "Pixelwise flooded fraction"
-                    da = floodscan.open_floodscan_rasters(issue_date, band)
-                    units = "flood fraction"
-                    leadtime_units = None
-                else:
-                    return plot_utils.blank_plot("Invalid dataset")
+                with tracing.span("blob"):
+                    if dataset == "seas5":
+                        title = (
+                            "Pixelwise precipitation (mm/day) across leadtimes"
+                        )
+                        da = seas5.open_seas5_rasters(issue_date, bbox=gdf)
+                        if da.attrs["missing_leadtimes"]:
+                            missing = ", ".join(
+                                str(lt) for lt in da.attrs["missing_leadtimes"]
+                            )
+                            title += f" (missing leadtimes: {missing})"
+                        units = "mm/day"
+                        leadtime_units = "months"
+                    elif dataset == "floodscan":
+                        title = "Pixelwise flooded fraction"
+                        # The window is read at once, so the read is timed
+                        # as blob time rather than while clipping
+                        da = floodscan.open_floodscan_rasters(
+                            issue_date, band, bbox=gdf
+                        )
+                        units = "flood fraction"
+                        leadtime_units = None
+                    else:
+                        return plot_utils.blank_plot("Invalid dataset")
             except RasterioIOError:
                 return plot_utils.blank_plot("No data available")
+            except NoDataInBounds:
+                return plot_utils.blank_plot("No data in bounds")
+
+            # Difference from the climatology of the day of year or issue
+            # month, read from its chunked store for the window only
+            anomaly = raster_display == "anomaly"
+            if anomaly:
+                job.checkpoint("Reading climatology")
+                try:
+                    with tracing.span("blob"):
+                        da = climatology.get_anomaly(
+                            da,
+                            dataset,
+                            issue_date,
+                            band if dataset == "floodscan" else None,
+                        )
+                except FileNotFoundError:
+                    return plot_utils.blank_plot("No climatology available")
+                title = title.replace("Pixelwise", "Pixelwise anomaly of")
 
-            # Upsample if needed
-            if raster_display == "upsampled":
-                da = da.rio.clip(gdf.geometry, all_touched=True)
-                da = raster.upsample_raster(da)
+            # Upsample if needed. Masks of the admin unit are cached per
+            # raster grid, so the boundary is only rasterized once
+            cache_key = (dataset, iso3, adm_level, pcode)
+            job.checkpoint("Clipping rasters")
             try:
-                da = da.rio.clip(gdf.geometry).sel(date=issue_date)
+                with tracing.span("compute"):
+                    if raster_display == "upsampled":
+                        da = raster.clip(
+                            da, gdf, all_touched=True, cache_key=cache_key
+                        )
+                        da = raster.upsample_raster(da)
+                    da = raster.clip(da, gdf, cache_key=cache_key)
+                    da = da.sel(date=issue_date)
             except Exception:
                 return plot_utils.blank_plot("No data in bounds")
 
             # Now plot
-            return plot_utils.plot_cogs(da, title, units, leadtime_units)
+            job.checkpoint("Rendering")
+            return plot_utils.plot_cogs(
+                da, title, units, leadtime_units, anomaly=anomaly
+            )
         return plot_utils.blank_plot("Select AOI from dropdowns")
+
+    @app.callback(
+        Output("pixel-series-request", "data"),
+        Output("cog-map", "clickData"),
+        Input("aoi-data", "data"),
+        Input("issue-date-dropdown", "value"),
+        Input("cog-map", "clickData"),
+        State("pixel-series-request", "data"),
+    )
+    def request_pixel_series(aoi, issue_date, click_data, previous):
+        # The series is only drawn for Floodscan. Other datasets are left
+        # out here, so that their selections don't start background jobs
+        if aoi is not None and aoi["dataset"] != "floodscan":
+            return dash.no_update, dash.no_update
+        click_reset = dash.no_update
+        point = None
+        if dash.ctx.triggered_id == "aoi-data":
+            # A pixel clicked in the previous admin unit no longer applies
+            if click_data is not None:
+                click_reset = None
+        elif click_data:
+            point = [click_data["latlng"]["lng"], click_data["latlng"]["lat"]]
+        request = None
+        if aoi is not None and issue_date:
+            request = {**aoi, "issue_date": issue_date, "point": point}
+        if request == previous:
+            # E.g. the reset of the click, which doesn't change the request
+            return dash.no_update, click_reset
+        return request, click_reset
+
+    @app.callback(
+        Output("pixel-series-data", "data"),
+        Output("chart-pixel-series", "figure"),
+        Input("pixel-series-request", "data"),
+        State("session-id", "data"),
+        background=True,
+        progress=Output("chart-pixel-series-progress", "children"),
+        interval=JOB_POLL_INTERVAL,
+    )
+    def get_pixel_series(set_progress, request, session):
+        if not request:
+            return None, plot_utils.blank_plot("Select AOI from dropdowns")
+        iso3, adm_level, pcode, band = (
+            request["iso3"],
+            request["adm_level"],
+            request["pcode"],
+            request["band"],
+        )
+        issue_date = request["issue_date"]
+        job = SessionJob(session, "get_pixel_series", set_progress)
+        job.checkpoint("Loading admin boundaries")
+        with tracing.span("codab"):
+            gdf = codab.load_codab_geometry(iso3, adm_level, pcode)
+        if gdf.empty:
+            return None, plot_utils.blank_plot("No data in bounds")
+
+        end_date = datetime.strptime(issue_date, "%Y-%m-%d").date()
+        start_date = end_date - timedelta(days=FLOODSCAN_SERIES_DAYS - 1)
+        dates = availability.get_cog_dates(
+            "floodscan", start_date.isoformat(), issue_date
+        )
+        if not dates:
+            return None, plot_utils.blank_plot("No data available")
+        point = tuple(request["point"]) if request["point"] else None
+
+        job.checkpoint("Querying raster stats")
+        with tracing.span("db"):
+            df_db = floodscan.get_raster_stats_between(
+                iso3, pcode, band, start_date, end_date
+            )
+
+        # The windows of all dates are read and reduced in parallel
+        job.checkpoint(f"Reading {len(dates)} COGs")
+        try:
+            with tracing.span("blob"):
+                df_cog, pixel = floodscan.get_raster_series(
+                    dates, band, gdf, point
+                )
+        except RasterioIOError:
+            return None, plot_utils.blank_plot("No data available")
+        except NoDataInBounds:
+            return None, plot_utils.blank_plot("No data in bounds")
+        job.checkpoint()
+        # The series are stored server-side, so that changing the stat only
+        # re-renders them
+        df = floodscan.stack_series(df_db, df_cog, pixel, point)
+        key = f"pixel-series/{iso3}/{pcode}/{band}/{issue_date}/{point}"
+        return Serverside(df, key=key), dash.no_update
+
+    @app.callback(
+        Output("chart-pixel-series", "figure", allow_duplicate=True),
+        Input("pixel-series-data", "data"),
+        Input("stat-dropdown", "value"),
+        prevent_initial_call=True,
+    )
+    def plot_pixel_series(df, stat):
+        if df is None:
+            # The loading job has drawn why there are no series
+            return dash.no_update
+        df_db, df_cog, pixel, point = floodscan.unstack_series(df)
+        return plot_utils.plot_floodscan_series(
+            df_db, df_cog, stat, pixel, point
+        )
+
+    @app.callback(
+        Output("cog-tiles", "url"),
+        Input("dataset-dropdown", "value"),
+        Input("issue-date-dropdown", "value"),
+        Input("band-select", "value"),
+        Input("map-leadtime", "value"),
+    )
+    def update_cog_tiles(dataset, issue_date, band, leadtime):
+        if dataset and issue_date:
+            layer = band if dataset == "floodscan" else leadtime
+            return get_tile_url(dataset, issue_date, layer)
+        return ""
+
+    @app.callback(
+        Output("cog-map-outline", "data"),
+        Output("cog-map", "bounds"),
+        Input("iso3-dropdown", "value"),
+        Input("adm-level-dropdown", "value"),
+        Input("pcode-dropdown", "value"),
+    )
+    def update_cog_map_outline(iso3, adm_level, pcode):
+        if iso3 and adm_level and pcode:
+            with tracing.span("codab"):
+                gdf = codab.load_codab_geometry(iso3, adm_level, pcode)
+            if not gdf.empty:
+                minx, miny, maxx, maxy = gdf.total_bounds
+                data = gdf[["geometry"]].__geo_interface__
+                return data, [[miny, minx], [maxy, maxx]]
+        return None, dash.no_update
+
+
+def _pcode_options(matches):
+    return [{"label": name, "value": pcode} for pcode, name in matches]
+
+
+def _date_options(matches):
+    options = []
+    for date_str, has_cog, has_stats in matches:
+        label = date_str
+        if not has_cog:
+            label += " (no COG)"
+        elif not has_stats:
+            label += " (no stats)"
+        options.append({"label": label, "value": date_str})
+    return options
+
+
+def _add_more_hint(options, n_more):
+    if n_more > 0:
+        options.append(
+            {
+                "label": f"{n_more} more, type to filter",
+                "value": "",
+                "disabled": True,
+            }
+        )
+    return options
@@ -0,0 +1,37 @@
+from dash_extensions.enrich import ServersideBackend
+
+from src.constants import (
+    SERVERSIDE_STORE_MAX_BYTES,
+    SERVERSIDE_STORE_PATH,
+    SERVERSIDE_STORE_TTL,
+)
+from src.utils.cache_utils import DiskFrameCache
+
+
+class ArrowBackend(ServersideBackend):
+    """
+    Serverside output backend keeping DataFrames in the Arrow format in a
+    SQLite file shared by all workers, so that only the key goes through the
+    browser. Entries expire after `SERVERSIDE_STORE_TTL` seconds.
+    """
+
+    def __init__(
+        self,
+        path=SERVERSIDE_STORE_PATH,
+        max_bytes=SERVERSIDE_STORE_MAX_BYTES,
+        ttl=SERVERSIDE_STORE_TTL,
+    ):
+        self._cache = DiskFrameCache(path, max_bytes, ttl)
+
+    def get(self, key, ignore_expired=False):
+        return self._cache.get(key, ignore_expired=ignore_expired)
+
+    def set(self, key, value):
+        self._cache.put(key, value)
+
+    def has(self, key):
+        return self._cache.has(key)
+
+    @property
+    def uid(self) -> str:
+        return f"{self.__class__.__name__}:{self._cache.path}"
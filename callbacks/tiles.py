@@ -0,0 +1,116 @@
+import hashlib
+import logging
+from datetime import datetime
+from urllib.parse import quote
+
+import flask
+from rasterio.errors import RasterioIOError
+
+from src.constants import STAGE, TILE_CACHE_MAX_BYTES, TILE_MAX_AGE
+from src.datasources import floodscan, seas5
+from src.datasources.blob import get_cog_etag, get_cog_path
+from src.utils import plot_utils, tiles
+from src.utils.cache_utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Flooded fractions of Floodscan bands are always in [0, 1], like in the
+# raster panel
+FLOODSCAN_RANGE = (0, 1)
+
+_tile_cache = LRUCache(TILE_CACHE_MAX_BYTES)
+# (COG path, etag, band) -> default colour range of the band
+_range_cache = LRUCache(1024**2)
+
+
+def register_tile_routes(server):
+    @server.route(
+        "/tiles/<dataset>/<date>/<layer>/<version>/<int:z>/<int:x>/<int:y>.png"
+    )
+    def cog_tile(dataset, date, layer, version, z, x, y):
+        """
+        Serve a 256x256 PNG tile of a floodscan band (SFED/MFED) or SEAS5
+        leadtime for a date, coloured like the raster panel. The colour range
+        can be set with the `zmin` and `zmax` query parameters.
+
+        `version` is the COG etag the URL was built for. Tiles are cached by
+        browsers only while it is still the current one.
+        """
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+            path, band = _get_tile_source(dataset, date, layer)
+        except (KeyError, ValueError):
+            flask.abort(404)
+        try:
+            etag = get_cog_etag(path)
+        except OSError as err:
+            logger.info(f"No COG for tile {path}: {err}")
+            flask.abort(404)
+        zmin = flask.request.args.get("zmin", type=float)
+        zmax = flask.request.args.get("zmax", type=float)
+
+        key = (STAGE, dataset, date, layer, etag, z, x, y, zmin, zmax)
+        png = _tile_cache.get(key)
+        if png is None:
+            try:
+                if zmin is None or zmax is None:
+                    auto_zmin, auto_zmax = _get_value_range(
+                        dataset, path, band, etag
+                    )
+                    zmin = auto_zmin if zmin is None else zmin
+                    zmax = auto_zmax if zmax is None else zmax
+                values = tiles.read_tile(path, band, z, x, y)
+            except RasterioIOError as err:
+                logger.info(f"No COG for tile {key}: {err}")
+                flask.abort(404)
+            png = plot_utils.to_png(values, zmin, zmax)
+            _tile_cache.put(key, png, nbytes=len(png))
+
+        response = flask.Response(png, mimetype="image/png")
+        response.set_etag(hashlib.sha1(png).hexdigest())
+        if version == quote(etag, safe=""):
+            response.cache_control.public = True
+            response.cache_control.max_age = TILE_MAX_AGE
+        else:
+            # The page holds the URL of an older version of the COG
+            response.cache_control.no_cache = True
+        return response.make_conditional(flask.request)
+
+
+def get_tile_url(dataset, date, layer):
+    """
+    Get the tile URL template of a COG layer, versioned by the COG etag, or
+    an empty string if the COG is missing.
+    """
+    path, _ = _get_tile_source(dataset, date, layer)
+    try:
+        version = quote(get_cog_etag(path), safe="")
+    except OSError as err:
+        logger.info(f"No COG for tiles of {path}: {err}")
+        return ""
+    return f"/tiles/{dataset}/{date}/{layer}/{version}/{{z}}/{{x}}/{{y}}.png"
+
+
+def _get_value_range(dataset, path, band, etag):
+    # Floodscan has a fixed range, SEAS5 is autoscaled like the raster panel,
+    # over the whole COG so that neighbouring tiles share the colour scale
+    if dataset == "floodscan":
+        return FLOODSCAN_RANGE
+    key = (path, etag, band)
+    value_range = _range_cache.get(key)
+    if value_range is None:
+        value_range = plot_utils.autoscale(tiles.read_preview(path, band))
+        _range_cache.put(key, value_range)
+    return value_range
+
+
+def _get_tile_source(dataset, date, layer):
+    if dataset == "floodscan":
+        band = floodscan.FLOODSCAN_BANDS[layer]
+        return get_cog_path(floodscan.get_floodscan_blob_name(date)), band
+    elif dataset == "seas5":
+        lt = int(layer)
+        if lt not in seas5.SEAS5_LEADTIMES:
+            raise ValueError(f"Invalid leadtime: {lt}")
+        return get_cog_path(seas5.get_seas5_blob_name(date, lt)), 1
+    raise KeyError(dataset)
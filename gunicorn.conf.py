@@ -0,0 +1,43 @@
+# Picked up automatically by `gunicorn app:server` run from the repo root
+
+
+def on_starting(server):
+    # Start the metrics and call counts merged across workers from zero
+    from src.utils import singleflight, tracing
+
+    tracing.clear_metrics()
+    singleflight.clear_stats()
+
+
+def post_worker_init(worker):
+    # Open the database connections of each worker and load its in-memory
+    # indexes before it takes requests
+    from src.constants import STATS_BACKEND
+    from src.datasources import availability, metadata, polygon
+    from src.utils import db_utils, tracing
+
+    tracing.start_flushing()
+    # The parquet backend reads everything from the local mirror
+    if STATS_BACKEND != "parquet":
+        db_utils.warm_pool()
+    _start_snapshot(worker, metadata.iso3_metadata)
+    _start_snapshot(worker, availability.availability)
+    _start_snapshot(worker, polygon.pcode_index)
+
+
+def worker_exit(server, worker):
+    # Observations still buffered by an exiting worker, e.g. on a restart,
+    # would never reach /metrics
+    from src.utils import tracing
+
+    tracing.flush_metrics()
+
+
+def _start_snapshot(worker, snapshot):
+    # A worker failing to boot halts the whole server, so a snapshot that
+    # can't be loaded, e.g. while the database is down, is only logged. Its
+    # readers load it on first use, and its thread retries in the background
+    try:
+        snapshot.start()
+    except Exception:
+        worker.log.exception(f"Loading {snapshot.name} failed")
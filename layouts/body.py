@@ -1,4 +1,5 @@
 import dash_bootstrap_components as dbc
+import dash_leaflet as dl
 from dash import dcc, html
 
 from src.utils import plot_utils
@@ -45,9 +46,12 @@ def sidebar_controls(iso3_options, date_options):
             html.Div(
                 [
                     html.P("Select Issue Date:"),
-                    dbc.Select(
+                    # Lists the dates with data, searched server-side
+                    dcc.Dropdown(
                         id="issue-date-dropdown",
                         options=date_options,
+                        placeholder="Type a date, e.g. 2024-03",
+                        clearable=False,
                         className="mb-3",
                     ),
                 ]
@@ -78,9 +82,11 @@ def sidebar_controls(iso3_options, date_options):
             html.Div(
                 [
                     html.P("Select Admin Unit:"),
-                    dbc.Select(
+                    # Options are searched server-side as the user types
+                    dcc.Dropdown(
                         id="pcode-dropdown",
                         options=[],
+                        placeholder="Type a name or pcode",
                         className="mb-3",
                     ),
                 ]
@@ -102,6 +108,7 @@ def sidebar_controls(iso3_options, date_options):
                 options=[
                     {"label": "Original", "value": "original"},
                     {"label": "Upsampled", "value": "upsampled"},
+                    {"label": "Anomaly", "value": "anomaly"},
                 ],
                 value="original",
                 inline=True,
@@ -132,6 +139,18 @@ def sidebar_controls(iso3_options, date_options):
     )
 
 
+def progress_spinner(progress_id):
+    # Spinner with the progress messages of the background callback loading
+    # the graph
+    return html.Div(
+        [
+            dbc.Spinner(color="secondary"),
+            html.Div(id=progress_id, className="text-muted small mt-2"),
+        ],
+        style={"textAlign": "center"},
+    )
+
+
 def plots():
     return html.Div(
         [
@@ -142,22 +161,85 @@ def plots():
                             id="chart-leadtime-series",
                             figure=plot_utils.blank_plot(),
                         ),
-                        custom_spinner=dbc.Spinner(color="secondary"),
+                        custom_spinner=progress_spinner(
+                            "chart-leadtime-series-progress"
+                        ),
                     )
                 ],
                 style=chart_style,
             ),
+            # Floodscan stats recomputed from the COGs, and the series of
+            # the pixel clicked on the map
+            html.Div(
+                id="pixel-series-div",
+                style={"display": "none"},
+                children=[
+                    html.Div(
+                        [
+                            dcc.Loading(
+                                dcc.Graph(
+                                    id="chart-pixel-series",
+                                    figure=plot_utils.blank_plot(),
+                                ),
+                                custom_spinner=progress_spinner(
+                                    "chart-pixel-series-progress"
+                                ),
+                            ),
+                            html.P(
+                                "Click the map to add the series of a pixel.",
+                                className="text-muted small ms-2",
+                            ),
+                        ],
+                        style=chart_style,
+                    ),
+                ],
+            ),
             html.Div(
                 [
                     dcc.Loading(
                         dcc.Graph(
                             id="chart-cog", figure=plot_utils.blank_plot()
                         ),
-                        custom_spinner=dbc.Spinner(color="secondary"),
+                        custom_spinner=progress_spinner("chart-cog-progress"),
                     )
                 ],
                 style=chart_style,
             ),
+            html.Div(
+                [
+                    html.Div(
+                        id="map-leadtime-div",
+                        style={"display": "none"},
+                        children=[
+                            html.P("Leadtime (months):"),
+                            dcc.Slider(
+                                id="map-leadtime",
+                                min=0,
+                                max=6,
+                                step=1,
+                                value=0,
+                            ),
+                        ],
+                    ),
+                    # Tiles are rendered server-side from the COGs at the
+                    # resolution of the current zoom level
+                    dl.Map(
+                        [
+                            dl.TileLayer(),
+                            dl.TileLayer(id="cog-tiles", opacity=0.8),
+                            dl.GeoJSON(
+                                id="cog-map-outline",
+                                style={"color": "black", "fill": False},
+                            ),
+                        ],
+                        id="cog-map",
+                        center=[0, 0],
+                        zoom=2,
+                        style={"height": "500px"},
+                    ),
+                ],
+                style={**chart_style, "padding": "10px"},
+            ),
         ],
         style={
             "width": "75%",
@@ -0,0 +1,45 @@
+"""
+Build or update the per-pixel climatology store of a dataset, read by the
+anomaly display of the COG map.
+
+Runs against the stage's blob storage, or against local COGs set with
+DSCI_LOCAL_RASTER_DIR, and writes under DSCI_CLIMATOLOGY_DIR:
+
+    python -m scripts.build_climatology floodscan
+
+Only the days of year (Floodscan) or issue months (SEAS5) with new COGs
+since the last run are recomputed, so the command can run after each
+ingestion.
+"""
+
+import argparse
+import logging
+
+from src.climatology import build_climatology
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("dataset", choices=["floodscan", "seas5"])
+    parser.add_argument(
+        "--store", help="Zarr store, defaults to <dataset>.zarr there"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="Rebuild the store from scratch"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="COGs read at once"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    built = build_climatology(
+        args.dataset, args.store, full=args.full, max_workers=args.workers
+    )
+    print(f"Computed {len(built)} groups")
+
+
+if __name__ == "__main__":
+    main()
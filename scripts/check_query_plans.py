@@ -0,0 +1,204 @@
+"""
+Check with EXPLAIN that the raster stats queries are served by the indexes in
+`sql/indexes.sql`, i.e. that the date predicates are index conditions rather
+than filters over a sequential scan.
+
+Run against a local Postgres stand-in, seeding it with synthetic tables first:
+
+    python -m scripts.check_query_plans --db-url postgresql://... --seed
+
+Seeding drops the floodscan and seas5 tables, so it is refused for databases
+other than local ones unless --force is passed.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+from sqlalchemy import bindparam, create_engine, make_url, text
+
+from src.datasources import floodscan, seas5
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), "..", "sql")
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+SEED_SQL = """
+DROP TABLE IF EXISTS floodscan;
+DROP TABLE IF EXISTS seas5;
+
+CREATE TABLE floodscan AS
+SELECT
+    'ABC' AS iso3,
+    'AB' || LPAD(p::text, 4, '0') AS pcode,
+    1 AS adm_level,
+    band,
+    d::date AS valid_date,
+    random() AS mean, random() AS median, random() AS min, random() AS max,
+    (random() * 100)::int AS count, random() AS sum, random() AS std
+FROM
+    generate_series(1, :n_pcodes) AS p,
+    unnest(ARRAY['SFED', 'MFED']) AS band,
+    generate_series('1998-01-12'::date, '2024-12-31'::date, '1 day') AS d;
+
+CREATE TABLE seas5 AS
+SELECT
+    'ABC' AS iso3,
+    'AB' || LPAD(p::text, 4, '0') AS pcode,
+    1 AS adm_level,
+    d::date AS issued_date,
+    (d + lt * INTERVAL '1 month')::date AS valid_date,
+    lt AS leadtime,
+    random() AS mean, random() AS median, random() AS min, random() AS max,
+    (random() * 100)::int AS count, random() AS sum, random() AS std
+FROM
+    generate_series(1, :n_pcodes) AS p,
+    generate_series(0, 6) AS lt,
+    generate_series('1981-01-01'::date, '2024-12-01'::date, '1 month') AS d;
+"""
+
+
+def seed(engine, n_pcodes):
+    with engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as con:
+        for statement in SEED_SQL.split(";"):
+            if statement.strip():
+                con.execute(text(statement), {"n_pcodes": n_pcodes})
+        with open(os.path.join(SQL_DIR, "indexes.sql")) as f:
+            for statement in f.read().split(";"):
+                lines = [
+                    line
+                    for line in statement.splitlines()
+                    if not line.startswith("--")
+                ]
+                if "".join(lines).strip():
+                    con.execute(text("\n".join(lines)))
+        con.execute(text("ANALYZE floodscan"))
+        con.execute(text("ANALYZE seas5"))
+
+
+def is_local(db_url):
+    """
+    Check that a database URL points at SQLite or at a server on this
+    machine, through a loopback address or a Unix socket.
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() == "sqlite":
+        return True
+    host = url.host or url.query.get("host")
+    if isinstance(host, tuple):
+        host = host[0]
+    return not host or host.startswith("/") or host in LOCAL_HOSTS
+
+
+def iter_plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from iter_plan_nodes(child)
+
+
+def check_plan(con, name, query, params, table, date_column):
+    explain = text(f"EXPLAIN (FORMAT JSON) {query.text}")
+    # Sequences are bound as expanding IN parameters, like the queries bind
+    # them
+    explain = explain.bindparams(
+        *(
+            bindparam(key, expanding=True)
+            for key, value in params.items()
+            if isinstance(value, (list, tuple))
+        )
+    )
+    plan = con.execute(explain, params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(iter_plan_nodes(plan[0]["Plan"]))
+
+    errors = []
+    for node in nodes:
+        if node.get("Relation Name") != table:
+            continue
+        if node["Node Type"] == "Seq Scan":
+            errors.append(f"sequential scan on {table}")
+        if date_column in node.get("Filter", ""):
+            errors.append(f"{date_column} applied as a filter")
+    if not any(date_column in node.get("Index Cond", "") for node in nodes):
+        errors.append(f"{date_column} not used as an index condition")
+
+    # Collapse runs of identical nodes, e.g. one index scan per year
+    node_types = [n["Node Type"] for n in nodes]
+    summary = [
+        f"{node_type} x{count}" if count > 1 else node_type
+        for node_type, count in (
+            (t, len(list(g))) for t, g in itertools.groupby(node_types)
+        )
+    ]
+    status = "FAIL" if errors else "OK"
+    print(f"[{status}] {name}: " + " -> ".join(summary))
+    for error in errors:
+        print(f"       {error}")
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db-url", required=True)
+    parser.add_argument(
+        "--seed",
+        action="store_true",
+        help="Replace the floodscan and seas5 tables with synthetic data",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Seed even if the database is not local",
+    )
+    parser.add_argument("--n-pcodes", type=int, default=20)
+    parser.add_argument("--iso3", default="ABC")
+    parser.add_argument("--pcode", default="AB0001")
+    args = parser.parse_args()
+
+    if args.seed and not (args.force or is_local(args.db_url)):
+        parser.error(
+            "--seed drops the floodscan and seas5 tables, and is only run "
+            "against local databases without --force"
+        )
+    engine = create_engine(args.db_url)
+    if args.seed:
+        seed(engine, args.n_pcodes)
+
+    checks = [
+        (
+            "floodscan mid-year window",
+            floodscan.get_raster_stats_query(
+                args.iso3, args.pcode, "2024-06-15", "SFED"
+            ),
+            "floodscan",
+            "valid_date",
+        ),
+        (
+            "floodscan window across new year",
+            floodscan.get_raster_stats_query(
+                args.iso3, args.pcode, "2024-01-05", "MFED"
+            ),
+            "floodscan",
+            "valid_date",
+        ),
+        (
+            "seas5 issue date",
+            seas5.get_raster_stats_query(args.iso3, args.pcode, "2024-03-01"),
+            "seas5",
+            "issued_date",
+        ),
+    ]
+    with engine.connect() as con:
+        results = [
+            check_plan(con, name, query, params, table, date_column)
+            for name, (query, params), table, date_column in checks
+        ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
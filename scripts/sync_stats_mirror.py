@@ -0,0 +1,57 @@
+"""
+Sync the local Parquet mirror of the floodscan and seas5 stats tables, read
+by the app with DSCI_STATS_BACKEND=parquet.
+
+The iso3 and polygon tables, which fill the dropdowns, are copied whole on
+each run, so that the app runs without the database.
+
+Runs against the stage's database, or the one set with DSCI_DB_URL, and
+writes under DSCI_STATS_MIRROR_DIR:
+
+    python -m scripts.sync_stats_mirror
+
+Only the rows from the newest mirrored date on are fetched, so the command
+can run after each ingestion. Rebuild the mirror with --full after a backfill.
+"""
+
+import argparse
+import logging
+
+from src.constants import STAGE
+from src.datasources.stats_mirror import (
+    METADATA_COLUMNS,
+    sync_metadata,
+    sync_table,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "datasets",
+        nargs="*",
+        help="floodscan and/or seas5, by default both",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="Rebuild the mirror from scratch"
+    )
+    parser.add_argument("--stage", default=STAGE)
+    args = parser.parse_args()
+    datasets = args.datasets or ["floodscan", "seas5"]
+    for dataset in datasets:
+        if dataset not in ("floodscan", "seas5"):
+            parser.error(f"Unknown dataset: {dataset}")
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    for dataset in datasets:
+        n_rows = sync_table(dataset, args.stage, full=args.full)
+        print(f"Mirrored {n_rows} rows of {dataset}")
+    for table in METADATA_COLUMNS:
+        n_rows = sync_metadata(table, args.stage)
+        print(f"Copied {n_rows} rows of {table}")
+
+
+if __name__ == "__main__":
+    main()
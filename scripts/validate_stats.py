@@ -0,0 +1,62 @@
+"""
+Validate the raster stats tables of a date against stats recomputed from the
+COGs, for every admin unit, and write the discrepancies to a Parquet report.
+
+Runs against the stage's database and blob storage, or against local
+stand-ins set with DSCI_DB_URL, DSCI_LOCAL_RASTER_DIR and
+DSCI_LOCAL_CODAB_DIR:
+
+    python -m scripts.validate_stats floodscan 2024-01-05 --output report.parquet
+
+An interrupted run resumes from its checkpoint when run again with the same
+arguments.
+"""
+
+import argparse
+import logging
+import sys
+
+from src.validation import run_validation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("dataset", choices=["floodscan", "seas5"])
+    parser.add_argument(
+        "date", help="Valid date (floodscan) or issue date (seas5)"
+    )
+    parser.add_argument("--output", required=True, help="Parquet report")
+    parser.add_argument(
+        "--checkpoint-dir",
+        help="Directory of per-task results, defaults to <output>.checkpoint",
+    )
+    parser.add_argument(
+        "--iso3", action="append", help="Only validate this country"
+    )
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--atol", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    df_report = run_validation(
+        args.dataset,
+        args.date,
+        args.output,
+        checkpoint_dir=args.checkpoint_dir,
+        iso3s=[iso3.upper() for iso3 in args.iso3 or []],
+        max_workers=args.workers,
+        rtol=args.rtol,
+        atol=args.atol,
+    )
+    if df_report.empty:
+        print("No discrepancies found")
+        sys.exit(0)
+    print(df_report.groupby(["iso3", "adm_level", "issue"]).size().to_string())
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+-- Composite indexes serving the raster stats queries in src/datasources.
+-- The equality columns come first and the date last, so that each per-year
+-- date range in the query is a single index range scan.
+--
+-- CONCURRENTLY avoids blocking the ingestion pipelines while the index is
+-- built, and cannot be run inside a transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS floodscan_iso3_pcode_band_valid_date_idx
+    ON floodscan (iso3, pcode, band, valid_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS seas5_iso3_pcode_issued_date_idx
+    ON seas5 (iso3, pcode, issued_date);
+
+-- Newest ingested date, used to invalidate cached query results
+CREATE INDEX CONCURRENTLY IF NOT EXISTS floodscan_valid_date_idx
+    ON floodscan (valid_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS seas5_issued_date_idx
+    ON seas5 (issued_date);
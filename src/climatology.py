@@ -0,0 +1,249 @@
+import logging
+import os
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import dask.array
+import numcodecs
+import numpy as np
+import rasterio
+import xarray as xr
+from rasterio.errors import RasterioIOError
+
+from src.constants import CLIMATOLOGY_QUANTILES
+from src.datasources import availability, floodscan, seas5
+from src.datasources.blob import get_cog_path
+from src.datasources.climatology import (
+    GROUP_DIMS,
+    LAYER_DIMS,
+    get_group,
+    get_store_path,
+)
+from src.utils import blockcache
+
+logger = logging.getLogger(__name__)
+
+# Rows and columns per chunk of the store. Groups are computed one strip of
+# chunk rows at a time
+CHUNK_SIZE = 256
+COMPRESSOR = numcodecs.Blosc(
+    cname="zstd", clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE
+)
+GROUPS = {"floodscan": list(range(1, 367)), "seas5": list(range(1, 13))}
+LAYERS = {
+    "floodscan": list(floodscan.FLOODSCAN_BANDS),
+    "seas5": list(seas5.SEAS5_LEADTIMES),
+}
+
+
+def build_climatology(
+    dataset,
+    path=None,
+    full=False,
+    quantiles=CLIMATOLOGY_QUANTILES,
+    max_workers=8,
+):
+    """
+    Build or update the per-pixel climatology store of a dataset: the mean,
+    standard deviation and quantiles over all years, per day of year and
+    band for Floodscan, and per issue month and leadtime for SEAS5.
+
+    The store is a chunked, compressed Zarr store with dimensions (group,
+    layer, y, x), see `src.datasources.climatology`. The number of dates of
+    each group is stored with it, so an update only recomputes the groups
+    with new or backfilled COGs. A group is written as a region of the store
+    one strip of rows at a time, reading the strip from the COGs of all its
+    dates, and its number of dates is written last, so a group interrupted
+    half-way is recomputed by the next run.
+
+    Parameters
+    ----------
+    dataset : str
+        "floodscan" or "seas5".
+    path : str, optional
+        Path of the store, by default under `CLIMATOLOGY_DIR`.
+    full : bool, optional
+        Rebuild the store from scratch.
+    quantiles : list of float, optional
+        Quantiles to compute, stored as e.g. "q10" for 0.1.
+    max_workers : int, optional
+        Number of COGs read at once.
+
+    Returns
+    -------
+    list
+        The groups that were computed.
+    """
+    path = path or get_store_path(dataset)
+    dates_by_group = defaultdict(list)
+    for date_str in sorted(availability.list_cog_dates(dataset)):
+        dates_by_group[get_group(dataset, date_str)].append(date_str)
+    if not dates_by_group:
+        raise ValueError(f"No {dataset} COGs found")
+
+    if full or not os.path.exists(path):
+        first_date = min(min(dates) for dates in dates_by_group.values())
+        _create_store(path, dataset, first_date, quantiles)
+    with xr.open_zarr(path, chunks=None) as ds:
+        if ds.attrs["quantiles"] != list(quantiles):
+            raise ValueError(
+                f"The store has quantiles {ds.attrs['quantiles']}, rebuild "
+                "it to change them"
+            )
+        n_dates = ds["n_dates"].to_series()
+        height, width = ds.sizes["y"], ds.sizes["x"]
+
+    built = []
+    for i, group in enumerate(GROUPS[dataset]):
+        dates = dates_by_group.get(group, [])
+        if len(dates) == n_dates[group]:
+            continue
+        logger.info(
+            f"Computing {dataset} group {group} from {len(dates)} COGs"
+        )
+        _build_group(
+            path, dataset, i, dates, (height, width), quantiles, max_workers
+        )
+        built.append(group)
+    return built
+
+
+def _create_store(path, dataset, date_str, quantiles):
+    with rasterio.open(_get_cog_paths(dataset, date_str)[0]) as src:
+        transform, crs = src.transform, src.crs
+        height, width = src.height, src.width
+    group_dim, layer_dim = GROUP_DIMS[dataset], LAYER_DIMS[dataset]
+    groups, layers = GROUPS[dataset], LAYERS[dataset]
+
+    shape = (len(groups), len(layers), height, width)
+    chunks = (1, 1, CHUNK_SIZE, CHUNK_SIZE)
+    data_vars = {
+        name: (
+            (group_dim, layer_dim, "y", "x"),
+            dask.array.full(shape, np.nan, dtype=np.float32, chunks=chunks),
+        )
+        for name in _get_stat_names(quantiles)
+    }
+    data_vars["n_dates"] = ((group_dim,), np.zeros(len(groups), np.int32))
+    ds = xr.Dataset(
+        data_vars,
+        coords={
+            group_dim: groups,
+            layer_dim: layers,
+            "y": transform.f + (np.arange(height) + 0.5) * transform.e,
+            "x": transform.c + (np.arange(width) + 0.5) * transform.a,
+        },
+        attrs={"dataset": dataset, "quantiles": list(quantiles)},
+    )
+    ds = ds.rio.write_crs(crs).rio.write_transform(transform)
+    encoding = {
+        name: {"chunks": chunks, "compressor": COMPRESSOR}
+        for name in _get_stat_names(quantiles)
+    }
+    # Only the coordinates and the number of dates are written, the stats
+    # are written group by group
+    ds.to_zarr(path, mode="w", compute=False, encoding=encoding)
+
+
+def _build_group(path, dataset, i, dates, shape, quantiles, max_workers):
+    group_dim, layer_dim = GROUP_DIMS[dataset], LAYER_DIMS[dataset]
+    height, width = shape
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, height, CHUNK_SIZE):
+            rows = slice(start, min(start + CHUNK_SIZE, height))
+            strips = executor.map(
+                lambda date_str: _read_strip(dataset, date_str, rows, width),
+                dates,
+            )
+            # (date, layer, y, x), with a single NaN date for groups whose
+            # COGs were all removed
+            values = np.stack(
+                list(strips) or [_empty_strip(dataset, rows, width)]
+            )
+            part = xr.Dataset(
+                {
+                    name: ((group_dim, layer_dim, "y", "x"), stat[np.newaxis])
+                    for name, stat in _compute_stats(values, quantiles).items()
+                }
+            )
+            part.to_zarr(path, region={group_dim: slice(i, i + 1), "y": rows})
+    n_dates = xr.Dataset(
+        {"n_dates": ((group_dim,), np.array([len(dates)], np.int32))}
+    )
+    n_dates.to_zarr(path, region={group_dim: slice(i, i + 1)})
+
+
+def _read_strip(dataset, date_str, rows, width):
+    # Rows of all layers of a date, with NaN for nodata and missing COGs
+    values = _empty_strip(dataset, rows, width)
+    window = rasterio.windows.Window(
+        0, rows.start, width, rows.stop - rows.start
+    )
+    for i, path in enumerate(_get_cog_paths(dataset, date_str)):
+        try:
+            with rasterio.open(
+                path, **blockcache.get_open_kwargs(path)
+            ) as src:
+                if dataset == "floodscan":
+                    layers = src.read(window=window, masked=True)
+                    values[:] = layers.astype(np.float32).filled(np.nan)
+                else:
+                    layer = src.read(1, window=window, masked=True)
+                    values[i] = layer.astype(np.float32).filled(np.nan)
+        except RasterioIOError as err:
+            logger.warning(f"Skipping {path}: {err}")
+    return values
+
+
+def _empty_strip(dataset, rows, width):
+    shape = (len(LAYERS[dataset]), rows.stop - rows.start, width)
+    return np.full(shape, np.nan, np.float32)
+
+
+def _get_cog_paths(dataset, date_str):
+    # Floodscan has both bands in one COG, SEAS5 has a COG per leadtime
+    if dataset == "floodscan":
+        return [get_cog_path(floodscan.get_floodscan_blob_name(date_str))]
+    return [
+        get_cog_path(seas5.get_seas5_blob_name(date_str, lt))
+        for lt in seas5.SEAS5_LEADTIMES
+    ]
+
+
+def _compute_stats(values, quantiles):
+    # Stats over the dates, ignoring NaN. Pixels without any value are NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        stats = {
+            "mean": np.nanmean(values, axis=0),
+            "std": np.nanstd(values, axis=0),
+        }
+        for q, stat in zip(quantiles, _nanquantile(values, quantiles)):
+            stats[_quantile_name(q)] = stat
+    return {name: stat.astype(np.float32) for name, stat in stats.items()}
+
+
+def _nanquantile(values, quantiles):
+    # numpy.nanquantile along the first axis, with linear interpolation.
+    # numpy computes it pixel by pixel in Python when there is any NaN
+    values = np.sort(values, axis=0)  # NaN last
+    count = np.count_nonzero(~np.isnan(values), axis=0)
+    stats = []
+    for q in quantiles:
+        position = np.maximum(count - 1, 0) * q
+        lower = np.floor(position).astype(np.intp)
+        upper = np.ceil(position).astype(np.intp)
+        low = np.take_along_axis(values, lower[np.newaxis], axis=0)[0]
+        high = np.take_along_axis(values, upper[np.newaxis], axis=0)[0]
+        stat = low + (high - low) * (position - lower)
+        stats.append(np.where(count > 0, stat, np.nan))
+    return stats
+
+
+def _get_stat_names(quantiles):
+    return ["mean", "std"] + [_quantile_name(q) for q in quantiles]
+
+
+def _quantile_name(q):
+    return f"q{round(q * 100):02d}"
@@ -1,3 +1,168 @@
 import os
+import tempfile
 
 STAGE = os.getenv("STAGE")
+
+# Local directory shared by all workers for on-disk caches
+CACHE_DIR = os.getenv(
+    "DSCI_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "ds-app-data-validation"),
+)
+
+# COD-AB geometry cache
+CODAB_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_CODAB_CACHE_MAX_BYTES", 256 * 1024**2)
+)
+# Seconds before the blob etag of a cached COD-AB is checked again
+CODAB_ETAG_TTL = int(os.getenv("DSCI_CODAB_ETAG_TTL", 600))
+
+# Directory of COGs laid out like the "raster" blob container. When set, COGs
+# are read from here instead of blob storage (e.g. for offline stand-ins)
+LOCAL_RASTER_DIR = os.getenv("DSCI_LOCAL_RASTER_DIR")
+# Directory of zipped COD-AB shapefiles laid out like the "polygon" blob
+# container, read instead of blob storage when set
+LOCAL_CODAB_DIR = os.getenv("DSCI_LOCAL_CODAB_DIR")
+
+# Concurrent SEAS5 leadtime fetch
+SEAS5_FETCH_WORKERS = int(os.getenv("DSCI_SEAS5_FETCH_WORKERS", 7))
+# Seconds allowed for fetching each leadtime COG
+SEAS5_FETCH_TIMEOUT = float(os.getenv("DSCI_SEAS5_FETCH_TIMEOUT", 30))
+
+# Database connection pool, one per stage and worker. DSCI_DB_URL overrides
+# the stage's database, e.g. to point at a local stand-in
+DB_URL = os.getenv("DSCI_DB_URL")
+DB_POOL_SIZE = int(os.getenv("DSCI_DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DSCI_DB_MAX_OVERFLOW", 5))
+# Seconds to wait for a connection from the pool before failing
+DB_POOL_TIMEOUT = float(os.getenv("DSCI_DB_POOL_TIMEOUT", 10))
+# Seconds after which connections are replaced, below the server's idle limit
+DB_POOL_RECYCLE = int(os.getenv("DSCI_DB_POOL_RECYCLE", 1800))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DSCI_DB_STATEMENT_TIMEOUT_MS", 30000))
+
+# Raster stats query results shared by all workers
+RASTER_STATS_CACHE_PATH = os.path.join(CACHE_DIR, "raster_stats.sqlite")
+RASTER_STATS_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_RASTER_STATS_CACHE_MAX_BYTES", 512 * 1024**2)
+)
+RASTER_STATS_CACHE_TTL = int(os.getenv("DSCI_RASTER_STATS_CACHE_TTL", 86400))
+# Seconds before the newest date in a stats table is checked again
+RASTER_STATS_WATERMARK_TTL = int(
+    os.getenv("DSCI_RASTER_STATS_WATERMARK_TTL", 60)
+)
+
+# Local Parquet mirror of the floodscan and seas5 stats tables, synced with
+# scripts/sync_stats_mirror.py. With the "parquet" backend the stats are
+# read from the mirror instead of the database
+STATS_MIRROR_DIR = os.getenv(
+    "DSCI_STATS_MIRROR_DIR", os.path.join(CACHE_DIR, "stats_mirror")
+)
+STATS_BACKEND = os.getenv("DSCI_STATS_BACKEND", "db")
+
+# Load the full floodscan stats history of an admin unit once and slice date
+# windows from it in memory
+FLOODSCAN_STATS_HISTORY = (
+    os.getenv("DSCI_FLOODSCAN_STATS_HISTORY", "true").lower() == "true"
+)
+FLOODSCAN_HISTORY_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_FLOODSCAN_HISTORY_CACHE_MAX_BYTES", 256 * 1024**2)
+)
+# Days of daily Floodscan COGs read for the series of the raster explorer,
+# and the number read at once
+FLOODSCAN_SERIES_DAYS = int(os.getenv("DSCI_FLOODSCAN_SERIES_DAYS", 90))
+FLOODSCAN_SERIES_WORKERS = int(os.getenv("DSCI_FLOODSCAN_SERIES_WORKERS", 8))
+
+# Server-side storage of frames behind dcc.Store components
+SERVERSIDE_STORE_PATH = os.path.join(CACHE_DIR, "serverside.sqlite")
+SERVERSIDE_STORE_MAX_BYTES = int(
+    os.getenv("DSCI_SERVERSIDE_STORE_MAX_BYTES", 1024**3)
+)
+SERVERSIDE_STORE_TTL = int(os.getenv("DSCI_SERVERSIDE_STORE_TTL", 86400))
+
+# Raster panel rendering: "image" sends PNGs, "heatmap" sends all values
+COG_RENDER = os.getenv("DSCI_COG_RENDER", "image")
+# Maximum image pixels along each side of the raster panel
+COG_IMAGE_MAX_SIZE = int(os.getenv("DSCI_COG_IMAGE_MAX_SIZE", 600))
+# Maximum cells along each side of the grid providing hover values
+COG_HOVER_GRID_SIZE = int(os.getenv("DSCI_COG_HOVER_GRID_SIZE", 60))
+
+# Per-pixel climatology stores of the anomaly display, built with
+# scripts/build_climatology.py, and the quantiles they hold
+CLIMATOLOGY_DIR = os.getenv(
+    "DSCI_CLIMATOLOGY_DIR", os.path.join(CACHE_DIR, "climatology")
+)
+CLIMATOLOGY_QUANTILES = [
+    float(q)
+    for q in os.getenv("DSCI_CLIMATOLOGY_QUANTILES", "0.1,0.5,0.9").split(",")
+]
+
+# Seconds between reloads of the iso3 table kept in memory by each worker
+ISO3_REFRESH_INTERVAL = int(os.getenv("DSCI_ISO3_REFRESH_INTERVAL", 3600))
+
+# Dates with COGs or raster stats, listed in the issue date dropdown. The
+# index is updated with the dates since the newest known one every
+# AVAILABILITY_REFRESH_INTERVAL seconds, and fully rebuilt every
+# AVAILABILITY_FULL_REFRESH_INTERVAL seconds to pick up backfills
+AVAILABILITY_REFRESH_INTERVAL = int(
+    os.getenv("DSCI_AVAILABILITY_REFRESH_INTERVAL", 600)
+)
+AVAILABILITY_FULL_REFRESH_INTERVAL = int(
+    os.getenv("DSCI_AVAILABILITY_FULL_REFRESH_INTERVAL", 86400)
+)
+# Dates listed in the issue date dropdown at once
+DATE_PAGE_SIZE = int(os.getenv("DSCI_DATE_PAGE_SIZE", 50))
+
+# In-memory index of the admin units in the polygon table, for type-ahead
+# search of the pcode dropdown
+PCODE_INDEX_REFRESH_INTERVAL = int(
+    os.getenv("DSCI_PCODE_INDEX_REFRESH_INTERVAL", 3600)
+)
+# Admin units listed in the pcode dropdown at once
+PCODE_PAGE_SIZE = int(os.getenv("DSCI_PCODE_PAGE_SIZE", 50))
+
+# Rasterized admin unit masks shared by all workers
+MASK_CACHE_DIR = os.path.join(CACHE_DIR, "masks")
+MASK_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_MASK_CACHE_MAX_BYTES", 512 * 1024**2)
+)
+
+# Background callbacks, run in separate processes with their progress and
+# results kept under JOB_CACHE_DIR for JOB_EXPIRE seconds
+JOB_CACHE_DIR = os.path.join(CACHE_DIR, "jobs")
+JOB_EXPIRE = int(os.getenv("DSCI_JOB_EXPIRE", 600))
+# Milliseconds between polls of a background callback by the browser
+JOB_POLL_INTERVAL = int(os.getenv("DSCI_JOB_POLL_INTERVAL", 500))
+
+# Byte-range block cache of remote COGs on local disk, shared by all workers
+BLOCK_CACHE = os.getenv("DSCI_BLOCK_CACHE", "true").lower() == "true"
+BLOCK_CACHE_DIR = os.path.join(CACHE_DIR, "blocks")
+BLOCK_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_BLOCK_CACHE_MAX_BYTES", 2 * 1024**3)
+)
+BLOCK_CACHE_BLOCK_SIZE = int(
+    os.getenv("DSCI_BLOCK_CACHE_BLOCK_SIZE", 64 * 1024)
+)
+# Bytes fetched in one request when a COG is opened, covering its header and
+# IFDs
+BLOCK_CACHE_PREFETCH_BYTES = int(
+    os.getenv("DSCI_BLOCK_CACHE_PREFETCH_BYTES", 128 * 1024)
+)
+# Seconds before the etag of a COG is checked again
+BLOCK_CACHE_ETAG_TTL = int(os.getenv("DSCI_BLOCK_CACHE_ETAG_TTL", 600))
+
+# Lock files and results handed over between processes by the single-flight
+# layer coalescing identical concurrent loads
+SINGLE_FLIGHT_DIR = os.path.join(CACHE_DIR, "singleflight")
+
+# XYZ map tiles rendered from COGs
+TILE_CACHE_MAX_BYTES = int(
+    os.getenv("DSCI_TILE_CACHE_MAX_BYTES", 128 * 1024**2)
+)
+TILE_MAX_AGE = int(os.getenv("DSCI_TILE_MAX_AGE", 86400))
+
+# Per-callback timings of database, blob, compute and render phases, served
+# as Prometheus histograms on /metrics and logged as JSON lines
+TRACING = os.getenv("DSCI_TRACING", "false").lower() == "true"
+# Histograms of all workers and background jobs, served by any worker
+METRICS_PATH = os.path.join(CACHE_DIR, "metrics.sqlite")
+# Seconds between writes of a worker's observations to METRICS_PATH
+METRICS_FLUSH_INTERVAL = float(os.getenv("DSCI_METRICS_FLUSH_INTERVAL", 10))
@@ -0,0 +1,242 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import date
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from src.constants import (
+    AVAILABILITY_FULL_REFRESH_INTERVAL,
+    AVAILABILITY_REFRESH_INTERVAL,
+    CACHE_DIR,
+    STAGE,
+    STATS_BACKEND,
+)
+from src.datasources import blob, stats_mirror
+from src.utils import db_utils
+from src.utils.cache_utils import RefreshedSnapshot, atomic_write_path
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_DIR = os.path.join(CACHE_DIR, "availability")
+
+# Blob name prefixes, directly followed by the date of the COG
+COG_PREFIXES = {
+    "floodscan": "floodscan/daily/v5/processed/aer_area_300s_v",
+    "seas5": "seas5/monthly/processed/precip_em_i",
+}
+STATS_DATE_COLUMNS = {"floodscan": "valid_date", "seas5": "issued_date"}
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+# Dates with a COG or stats in ascending order, and whether each has a COG
+# and stats
+Availability = namedtuple("Availability", ["dates", "has_cog", "has_stats"])
+
+
+def list_cog_dates(dataset, since=None):
+    """
+    List the dates of the COGs of a dataset in blob storage. With `since`,
+    only the blobs of its year and later are listed.
+    """
+    prefix = COG_PREFIXES[dataset]
+    if since is None:
+        prefixes = [prefix]
+    else:
+        since_year = int(since[:4])
+        prefixes = [
+            f"{prefix}{year}"
+            for year in range(since_year, date.today().year + 1)
+        ]
+    dates = set()
+    for year_prefix in prefixes:
+        for name in blob.list_blob_names(year_prefix):
+            date_str = name[len(prefix) : len(prefix) + 10]
+            if DATE_PATTERN.fullmatch(date_str):
+                dates.add(date_str)
+    return dates
+
+
+def list_stats_dates(dataset, since=None, stage=STAGE):
+    """
+    List the distinct dates in the stats table of a dataset, only from
+    `since` onwards if given.
+    """
+    if STATS_BACKEND == "parquet":
+        return stats_mirror.list_dates(dataset, since, stage)
+    column = STATS_DATE_COLUMNS[dataset]
+    query = f"SELECT DISTINCT {column} FROM {dataset}"
+    params = {}
+    if since is not None:
+        query += f" WHERE {column} >= :since"
+        params["since"] = since
+    with db_utils.connect(stage) as conn:
+        df = pd.read_sql(text(query), con=conn, params=params)
+    return set(pd.to_datetime(df[column]).dt.strftime("%Y-%m-%d"))
+
+
+def refresh_availability(dataset, stage=STAGE):
+    """
+    Update the available dates of a dataset persisted under
+    `AVAILABILITY_DIR`, with only the dates since the newest known ones
+    unless a full rebuild is due.
+
+    The state is shared by all workers: one worker at a time updates it,
+    and a state updated by another worker within the last
+    `AVAILABILITY_REFRESH_INTERVAL` seconds is used as it is. If the update
+    fails, e.g. while blob storage or the database is down, the persisted
+    dates are served.
+
+    Returns
+    -------
+    Availability
+    """
+    path = os.path.join(AVAILABILITY_DIR, f"{stage}_{dataset}.json")
+    os.makedirs(AVAILABILITY_DIR, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            state = _read_state(path)
+            if (
+                state is None
+                or time.time() - state["refreshed_at"]
+                > AVAILABILITY_REFRESH_INTERVAL
+            ):
+                try:
+                    state = _update_state(path, state, dataset, stage)
+                except Exception:
+                    if state is None:
+                        raise
+                    logger.exception(
+                        f"Updating the {dataset} availability index failed, "
+                        "serving the persisted one"
+                    )
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    dates = np.array(
+        sorted(state["cog_dates"] | state["stats_dates"]), dtype=str
+    )
+    return Availability(
+        dates=dates,
+        has_cog=np.isin(dates, list(state["cog_dates"])),
+        has_stats=np.isin(dates, list(state["stats_dates"])),
+    )
+
+
+def _update_state(path, state, dataset, stage):
+    now = time.time()
+    if (
+        state is None
+        or now - state["full_refresh_at"] > AVAILABILITY_FULL_REFRESH_INTERVAL
+    ):
+        logger.info(f"Rebuilding the {dataset} availability index")
+        state = {
+            "cog_dates": list_cog_dates(dataset),
+            "stats_dates": list_stats_dates(dataset, stage=stage),
+            "full_refresh_at": now,
+        }
+    else:
+        for key, list_dates in [
+            ("cog_dates", list_cog_dates),
+            ("stats_dates", list_stats_dates),
+        ]:
+            since = max(state[key], default=None)
+            state[key] = state[key] | list_dates(dataset, since=since)
+    state["refreshed_at"] = now
+    _write_state(path, state)
+    return state
+
+
+def load_availability():
+    return MappingProxyType(
+        {dataset: refresh_availability(dataset) for dataset in COG_PREFIXES}
+    )
+
+
+availability = RefreshedSnapshot(
+    load_availability, AVAILABILITY_REFRESH_INTERVAL, "data availability"
+)
+
+
+def search_dates(dataset, query="", offset=0, limit=50):
+    """
+    Find the available dates of a dataset starting with `query`, e.g. "2024"
+    or "2024-03", newest first.
+
+    Returns
+    -------
+    tuple
+        List of (date, has COG, has stats) in the page, and total number of
+        matches.
+    """
+    index = availability.get()[dataset]
+    query = query.strip()
+    start = np.searchsorted(index.dates, query, side="left")
+    stop = np.searchsorted(index.dates, query + "\U0010ffff", side="left")
+    # Dates are stored in ascending order, pages start from the newest
+    positions = np.arange(stop - 1, start - 1, -1)[offset : offset + limit]
+    matches = [
+        (str(index.dates[i]), bool(index.has_cog[i]), bool(index.has_stats[i]))
+        for i in positions
+    ]
+    return matches, int(stop - start)
+
+
+def get_default_date(dataset):
+    """
+    Get the newest date with both a COG and stats, or the newest date with
+    either if there is none.
+    """
+    index = availability.get()[dataset]
+    complete = np.flatnonzero(index.has_cog & index.has_stats)
+    if complete.size:
+        return str(index.dates[complete[-1]])
+    if index.dates.size:
+        return str(index.dates[-1])
+    return None
+
+
+def get_cog_dates(dataset, start, end):
+    """
+    Get the dates of a dataset with a COG from `start` to `end` inclusive,
+    in ascending order.
+    """
+    index = availability.get()[dataset]
+    lo = np.searchsorted(index.dates, start, side="left")
+    hi = np.searchsorted(index.dates, end, side="right")
+    return [str(d) for d in index.dates[lo:hi][index.has_cog[lo:hi]]]
+
+
+def _read_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # States written before workers shared them count as outdated
+    state.setdefault("refreshed_at", 0)
+    state["cog_dates"] = set(state["cog_dates"])
+    state["stats_dates"] = set(state["stats_dates"])
+    return state
+
+
+def _write_state(path, state):
+    tmp_path = atomic_write_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "cog_dates": sorted(state["cog_dates"]),
+                "stats_dates": sorted(state["stats_dates"]),
+                "full_refresh_at": state["full_refresh_at"],
+                "refreshed_at": state["refreshed_at"],
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
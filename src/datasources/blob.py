@@ -0,0 +1,48 @@
+import glob
+import os
+
+import ocha_stratus as stratus
+
+from src.constants import LOCAL_RASTER_DIR, STAGE
+from src.utils import blockcache
+
+
+def get_cog_path(blob_name: str, container_name: str = "raster"):
+    """
+    Get a path that rasterio can open for a COG in blob storage, or for its
+    copy under `LOCAL_RASTER_DIR` when that is set.
+    """
+    if LOCAL_RASTER_DIR:
+        return os.path.join(LOCAL_RASTER_DIR, blob_name)
+    container_client = stratus.get_container_client(
+        stage=STAGE, container_name=container_name
+    )
+    return container_client.get_blob_client(blob_name).url
+
+
+def get_cog_etag(path: str):
+    """
+    Get the version of a COG at a path from `get_cog_path`: the blob etag, or
+    the modification time and size of a local copy.
+    """
+    if LOCAL_RASTER_DIR:
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns:x}{stat.st_size:x}"
+    return blockcache.get_etag(path)
+
+
+def list_blob_names(prefix: str, container_name: str = "raster"):
+    """
+    List the names of the blobs starting with `prefix`, or of the files under
+    `LOCAL_RASTER_DIR` when that is set for the raster container.
+    """
+    if LOCAL_RASTER_DIR and container_name == "raster":
+        paths = glob.glob(os.path.join(LOCAL_RASTER_DIR, f"{prefix}*"))
+        return [
+            os.path.relpath(path, LOCAL_RASTER_DIR).replace(os.sep, "/")
+            for path in paths
+        ]
+    container_client = stratus.get_container_client(
+        stage=STAGE, container_name=container_name
+    )
+    return list(container_client.list_blob_names(name_starts_with=prefix))
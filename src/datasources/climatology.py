@@ -0,0 +1,113 @@
+import os
+from datetime import date
+
+import numpy as np
+import xarray as xr
+
+from src.constants import CLIMATOLOGY_DIR
+from src.utils.raster import to_bbox
+
+# Dimension of the climatology groups and of the layers of each dataset
+GROUP_DIMS = {"floodscan": "doy", "seas5": "month"}
+LAYER_DIMS = {"floodscan": "band", "seas5": "lt"}
+
+
+def get_store_path(dataset):
+    return os.path.join(CLIMATOLOGY_DIR, f"{dataset}.zarr")
+
+
+def get_group(dataset, date_str):
+    """
+    Get the climatology group of a date: its day of year for Floodscan,
+    counted as in a leap year so that a calendar day always has the same
+    group, or its issue month for SEAS5.
+    """
+    _, month, day = (int(part) for part in date_str.split("-"))
+    if dataset == "floodscan":
+        return date(2000, month, day).timetuple().tm_yday
+    return month
+
+
+def open_climatology(dataset, date_str, bbox, stat="mean", layer=None):
+    """
+    Read a climatology stat of the group of `date_str` in the window of
+    `bbox`, padded by one pixel like `src.utils.raster.open_cog`. Only the
+    chunks of the store intersecting the window are read.
+
+    Parameters
+    ----------
+    stat : str, optional
+        "mean", "std" or a quantile such as "q50".
+    layer : str or int, optional
+        Band (Floodscan) or leadtime (SEAS5) to read, by default all.
+
+    Returns
+    -------
+    xarray.DataArray
+        With dimensions (y, x), or (band, y, x) or (lt, y, x) without
+        `layer`. Pixels of groups not built yet are NaN.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the store of the dataset hasn't been built.
+    """
+    path = get_store_path(dataset)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No climatology store at {path}")
+    minx, miny, maxx, maxy = to_bbox(bbox)
+    # Read through zarr rather than dask, whose thread pool doesn't survive
+    # the fork of background callback jobs
+    with xr.open_zarr(path, chunks=None) as ds:
+        da = ds[stat].sel({GROUP_DIMS[dataset]: get_group(dataset, date_str)})
+        if layer is not None:
+            da = da.sel({LAYER_DIMS[dataset]: layer})
+        res_x = abs(float(ds["x"][1] - ds["x"][0]))
+        res_y = abs(float(ds["y"][1] - ds["y"][0]))
+        da = da.sel(
+            x=slice(minx - res_x, maxx + res_x),
+            y=slice(maxy + res_y, miny - res_y),
+        )
+        return da.load()
+
+
+def get_anomaly(da, dataset, date_str, layer=None):
+    """
+    Subtract the climatological mean of `date_str` from a raster window,
+    e.g. read with `src.utils.raster.open_cog` with a bbox.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Raster on the grid of the COGs, with `y` and `x` as its last
+        dimensions, and for SEAS5 a leadtime dimension named like the layer
+        dimension of the store.
+    layer : str, optional
+        Band of a Floodscan raster.
+
+    Returns
+    -------
+    xarray.DataArray
+        The anomaly on the grid of `da`, with NaN as nodata.
+    """
+    bounds = da.rio.bounds()
+    mean = open_climatology(dataset, date_str, bounds, layer=layer)
+    res_x, res_y = (abs(r) for r in da.rio.resolution())
+    mean = mean.reindex(
+        x=da["x"],
+        y=da["y"],
+        method="nearest",
+        tolerance=min(res_x, res_y) / 2,
+    )
+    layer_dim = LAYER_DIMS[dataset]
+    if layer_dim in mean.dims:
+        # Match the layers by coordinate, since a SEAS5 stack can miss
+        # leadtimes of the store
+        mean = mean.reindex({layer_dim: da[layer_dim].values})
+    mean = mean.broadcast_like(da).transpose(*da.dims)
+    values = da.values.astype(np.float32)
+    nodata = da.rio.nodata
+    if nodata is not None:
+        values[da.values == nodata] = np.nan
+    anomaly = da.copy(data=values - mean.values)
+    return anomaly.rio.write_nodata(np.nan)
@@ -1,12 +1,43 @@
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+import geopandas as gpd
 import ocha_stratus as stratus
+import shapely
+
+from src.constants import (
+    CACHE_DIR,
+    CODAB_CACHE_MAX_BYTES,
+    CODAB_ETAG_TTL,
+    LOCAL_CODAB_DIR,
+    STAGE,
+)
+from src.utils.cache_utils import LRUCache, atomic_write_path
+from src.utils.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+CODAB_CACHE_DIR = os.path.join(CACHE_DIR, "codab")
 
-from src.constants import STAGE
+# (iso3, admin_level) -> (etag, gdf, {pcode: row position})
+_codab_cache = LRUCache(CODAB_CACHE_MAX_BYTES)
+# (iso3, admin_level) -> (etag, time the etag was last checked)
+_etags = {}
+_etags_lock = threading.Lock()
+_codab_flight = SingleFlight("codab")
 
 
 def load_codab_from_blob(iso3: str, admin_level: int = 0):
     iso3 = iso3.lower()
     blob_name = f"{iso3.lower()}_shp.zip"
     shapefile = f"{iso3}_adm{admin_level}.shp"
+    if LOCAL_CODAB_DIR:
+        path = os.path.join(LOCAL_CODAB_DIR, blob_name)
+        return gpd.read_file(f"zip://{path}!{shapefile}")
     gdf = stratus.load_shp_from_blob(
         blob_name=blob_name,
         shapefile=shapefile,
@@ -14,3 +45,128 @@ def load_codab_from_blob(iso3: str, admin_level: int = 0):
         container_name="polygon",
     )
     return gdf
+
+
+def get_codab_etag(iso3: str):
+    if LOCAL_CODAB_DIR:
+        stat = os.stat(
+            os.path.join(LOCAL_CODAB_DIR, f"{iso3.lower()}_shp.zip")
+        )
+        return f"{stat.st_mtime_ns:x}{stat.st_size:x}"
+    blob_client = stratus.get_container_client(
+        stage=STAGE, container_name="polygon"
+    ).get_blob_client(f"{iso3.lower()}_shp.zip")
+    return blob_client.get_blob_properties().etag.strip('"')
+
+
+def load_codab(iso3: str, admin_level: int = 0):
+    """
+    Load the COD-AB for an admin level through the geometry cache.
+
+    Lookups go to an in-process LRU first, then to a GeoParquet mirror on
+    local disk shared by all workers, and only then to blob storage. Both
+    levels are keyed by the blob etag, which is revalidated at most every
+    `CODAB_ETAG_TTL` seconds, so a re-uploaded COD-AB replaces the cached one.
+
+    Parameters
+    ----------
+    iso3 : str
+        Country ISO3 code.
+    admin_level : int, optional
+        Admin level of the boundaries to load.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        The admin boundaries. Treat as read-only, since it is shared between
+        callers.
+    """
+    return _load_codab_entry(iso3, admin_level)[1]
+
+
+def load_codab_geometry(iso3: str, admin_level: int, pcode: str):
+    """
+    Load the boundary of a single admin unit through the geometry cache.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        Single-row frame for `pcode`, or an empty frame if the pcode is not
+        in the COD-AB.
+    """
+    _, gdf, pcode_index = _load_codab_entry(iso3, admin_level)
+    position = pcode_index.get(pcode)
+    if position is None:
+        return gdf.iloc[[]]
+    return gdf.iloc[[position]]
+
+
+def _load_codab_entry(iso3, admin_level):
+    key = (iso3.lower(), int(admin_level))
+    etag = _get_cached_etag(key)
+    entry = _codab_cache.get(key)
+    if entry is not None and entry[0] == etag:
+        return entry
+    entry = _codab_flight.do((*key, etag), _build_codab_entry, key, etag)
+    # Put by every waiter, since entries handed over by another process
+    # aren't cached here yet, without a lookup that would count as a miss
+    _codab_cache.put(key, entry, nbytes=_sizeof_gdf(entry[1]))
+    return entry
+
+
+def _build_codab_entry(key, etag):
+    parquet_path = _codab_parquet_path(*key, etag)
+    if os.path.exists(parquet_path):
+        gdf = gpd.read_parquet(parquet_path)
+    else:
+        logger.info(f"Downloading COD-AB for {key[0]} adm{key[1]}")
+        gdf = load_codab_from_blob(*key)
+        tmp_path = atomic_write_path(parquet_path)
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, parquet_path)
+        _remove_stale_mirrors(*key, etag)
+
+    pcode_col = f"ADM{key[1]}_PCODE"
+    pcode_index = {
+        pcode: position for position, pcode in enumerate(gdf[pcode_col])
+    }
+    return etag, gdf, pcode_index
+
+
+def _get_cached_etag(key):
+    now = time.monotonic()
+    with _etags_lock:
+        cached = _etags.get(key)
+    if cached is not None and now - cached[1] < CODAB_ETAG_TTL:
+        return cached[0]
+    etag = get_codab_etag(key[0])
+    with _etags_lock:
+        _etags[key] = (etag, now)
+    return etag
+
+
+def _codab_parquet_path(iso3, admin_level, etag):
+    etag = re.sub(r"[^0-9A-Za-z]", "", etag)
+    return os.path.join(
+        CODAB_CACHE_DIR, f"{iso3}_adm{admin_level}_{etag}.parquet"
+    )
+
+
+def _remove_stale_mirrors(iso3, admin_level, etag):
+    current = _codab_parquet_path(iso3, admin_level, etag)
+    pattern = os.path.join(
+        CODAB_CACHE_DIR, f"{iso3}_adm{admin_level}_*.parquet"
+    )
+    for path in glob.glob(pattern):
+        if path != current:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _sizeof_gdf(gdf):
+    # 16 bytes per 2D coordinate dominates the size of the geometries
+    n_coords = shapely.get_num_coordinates(gdf.geometry.values).sum()
+    attrs = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True)
+    return int(n_coords * 16 + attrs.sum())
@@ -1,24 +1,82 @@
-from datetime import datetime, timedelta
+import logging
+from datetime import datetime
 
-import ocha_stratus as stratus
+import dask
+import dask.array
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import rasterio
 import xarray as xr
+from rasterio.errors import RasterioIOError
+from rioxarray.exceptions import NoDataInBounds
 from sqlalchemy import text
 
-from src.constants import STAGE
+from src.constants import (
+    FLOODSCAN_HISTORY_CACHE_MAX_BYTES,
+    FLOODSCAN_SERIES_WORKERS,
+    FLOODSCAN_STATS_HISTORY,
+    RASTER_STATS_CACHE_MAX_BYTES,
+    RASTER_STATS_CACHE_PATH,
+    RASTER_STATS_CACHE_TTL,
+    STAGE,
+    STATS_BACKEND,
+)
+from src.datasources import stats_mirror
+from src.datasources.blob import get_cog_path
+from src.utils import blockcache, date_utils, db_utils
+from src.utils.cache_utils import DiskFrameCache, LRUCache
+from src.utils.raster import lazy_zonal_stats, open_cog, to_bbox
+from src.utils.singleflight import SingleFlight
 
+_stats_cache = DiskFrameCache(
+    RASTER_STATS_CACHE_PATH,
+    RASTER_STATS_CACHE_MAX_BYTES,
+    RASTER_STATS_CACHE_TTL,
+)
+_history_cache = LRUCache(FLOODSCAN_HISTORY_CACHE_MAX_BYTES)
+_stats_flight = SingleFlight("floodscan-stats")
+_raster_flight = SingleFlight("floodscan-rasters")
 
-def open_floodscan_cog(valid_date_str: str):
-    blob_name = f"floodscan/daily/v5/processed/aer_area_300s_v{valid_date_str}_v05r01.tif"
-    return stratus.open_blob_cog(
-        blob_name, stage=STAGE, container_name="raster"
+logger = logging.getLogger(__name__)
+
+FLOODSCAN_BANDS = {"SFED": 1, "MFED": 2}
+
+
+def get_floodscan_blob_name(valid_date_str: str):
+    return f"floodscan/daily/v5/processed/aer_area_300s_v{valid_date_str}_v05r01.tif"
+
+
+def open_floodscan_cog(valid_date_str: str, bbox=None, max_size=None):
+    blob_name = get_floodscan_blob_name(valid_date_str)
+    return open_cog(get_cog_path(blob_name), bbox=bbox, max_size=max_size)
+
+
+def open_floodscan_rasters(
+    valid_date_str: str, band: str, bbox=None, max_size=None
+):
+    """
+    Open a band of a Floodscan date as a stack with dimensions (date, y, x).
+
+    Without `bbox` the raster is opened lazily. With `bbox` the window is
+    read at once, and shared by concurrent identical calls of all workers.
+    """
+    if bbox is None:
+        return _open_floodscan_rasters(valid_date_str, band, None, max_size)
+    bbox = to_bbox(bbox)
+    return _raster_flight.do(
+        (valid_date_str, band, bbox, max_size),
+        lambda: _open_floodscan_rasters(
+            valid_date_str, band, bbox, max_size
+        ).load(),
     )
 
 
-def open_floodscan_rasters(valid_date_str: str, band: str):
+def _open_floodscan_rasters(valid_date_str, band, bbox, max_size):
     das = []
-    bands = {"SFED": 1, "MFED": 2}
-    da_in = open_floodscan_cog(valid_date_str).sel(band=bands[band])
+    da_in = open_floodscan_cog(
+        valid_date_str, bbox=bbox, max_size=max_size
+    ).sel(band=FLOODSCAN_BANDS[band])
     da_in = da_in.squeeze(drop=True)
     das.append(da_in)
     da_out = xr.combine_by_coords(das, combine_attrs="drop_conflicts")
@@ -27,41 +85,434 @@ def open_floodscan_rasters(valid_date_str: str, band: str):
     return da_out
 
 
+def open_floodscan_stack(valid_date_strs, band, bbox):
+    """
+    Open a band of several Floodscan dates as a lazy stack with dimensions
+    (date, y, x), windowed to `bbox`.
+
+    Each date is one dask chunk, read when it is computed, so the stack can
+    be reduced date by date in parallel without holding more windows in
+    memory than dask computes at once. Dates whose COG can't be read are
+    left as nodata.
+
+    Parameters
+    ----------
+    valid_date_strs : list of str
+        Dates as YYYY-MM-DD.
+    band : str
+        "SFED" or "MFED".
+    bbox : tuple, shapely geometry or GeoDataFrame
+        Bounds to read, see `src.utils.raster.open_cog`.
+
+    Returns
+    -------
+    xarray.DataArray
+    """
+    bbox = to_bbox(bbox)
+    # All dates are on the same grid, so the window of the last date gives
+    # the coordinates of all of them
+    template = (
+        open_floodscan_cog(valid_date_strs[-1], bbox=bbox)
+        .sel(band=FLOODSCAN_BANDS[band])
+        .drop_vars("band")
+    )
+    nodata = template.rio.nodata
+    fill = np.nan if nodata is None else nodata
+    chunks = [
+        dask.array.from_delayed(
+            dask.delayed(_read_floodscan_window, pure=True)(
+                valid_date_str,
+                band,
+                template.rio.bounds(),
+                template.shape,
+                template.dtype,
+                fill,
+            ),
+            shape=template.shape,
+            dtype=template.dtype,
+        )
+        for valid_date_str in valid_date_strs
+    ]
+    return xr.DataArray(
+        dask.array.stack(chunks),
+        dims=("date",) + template.dims,
+        coords={"date": list(valid_date_strs), **template.coords},
+        attrs=template.attrs,
+    )
+
+
+def _read_floodscan_window(valid_date_str, band, bounds, shape, dtype, fill):
+    # Read with rasterio rather than `open_cog`, whose xarray overhead
+    # outweighs the read of a small window. The COG is opened, read and
+    # closed in the dask thread, as the block cache needs
+    path = get_cog_path(get_floodscan_blob_name(valid_date_str))
+    try:
+        with rasterio.open(path, **blockcache.get_open_kwargs(path)) as src:
+            window = src.window(*bounds).round_offsets().round_lengths()
+            values = src.read(FLOODSCAN_BANDS[band], window=window)
+    except RasterioIOError as err:
+        logger.warning(f"Missing Floodscan COG for {valid_date_str}: {err}")
+        return np.full(shape, fill, dtype=dtype)
+    if values.shape != shape:
+        raise ValueError(
+            f"Unexpected raster shape {values.shape} for {valid_date_str}"
+        )
+    return values
+
+
+def get_raster_series(
+    valid_date_strs,
+    band,
+    gdf,
+    point=None,
+    max_workers=FLOODSCAN_SERIES_WORKERS,
+):
+    """
+    Compute the stats of an admin unit on each date from the Floodscan COGs,
+    to cross-check the stats in the database, and optionally the series of
+    the pixel at `point`.
+
+    The windows of the dates are read and reduced in parallel, without
+    holding the whole stack in memory, see `open_floodscan_stack`.
+
+    Parameters
+    ----------
+    valid_date_strs : list of str
+        Dates as YYYY-MM-DD, in ascending order.
+    band : str
+        "SFED" or "MFED".
+    gdf : geopandas.GeoDataFrame
+        Boundary of the admin unit.
+    point : tuple, optional
+        (x, y) of the pixel, in the CRS of the rasters.
+    max_workers : int, optional
+        Number of dates read at once.
+
+    Returns
+    -------
+    tuple
+        Frame of the stats with a `valid_date` column, and the values of the
+        pixel as a series indexed by date, or None without `point` or if it
+        is off the rasters.
+    """
+    stack = open_floodscan_stack(valid_date_strs, band, gdf)
+    stats = lazy_zonal_stats(stack, gdf)
+    pixel = None
+    if point is not None:
+        x, y = point
+        try:
+            pixel = open_floodscan_stack(valid_date_strs, band, (x, y, x, y))
+        except NoDataInBounds:
+            # A point off the raster only leaves out the pixel series
+            logger.info(f"No Floodscan pixel at {point}")
+        else:
+            pixel = pixel.sel(x=x, y=y, method="nearest")
+    df, pixel = dask.compute(
+        stats, pixel, scheduler="threads", num_workers=max_workers
+    )
+
+    df = df.drop(columns="zone").rename(columns={"date": "valid_date"})
+    df["valid_date"] = pd.to_datetime(df["valid_date"])
+    if pixel is not None:
+        nodata = pixel.rio.nodata
+        if nodata is not None:
+            pixel = pixel.where(pixel != nodata)
+        pixel = pixel.to_series()
+        pixel.index = pd.to_datetime(pixel.index)
+    return df, pixel
+
+
+def stack_series(df_db, df_cog, pixel=None, point=None):
+    """
+    Stack the outputs of `get_raster_stats_between` and `get_raster_series`
+    into one frame, e.g. to store them server-side, with a `source` column
+    of "db", "cog" or "pixel". The pixel rows hold its values in `pixel`
+    and its coordinates in `x` and `y`.
+    """
+    parts = [df_db.assign(source="db"), df_cog.assign(source="cog")]
+    if pixel is not None:
+        x, y = point
+        parts.append(
+            pd.DataFrame(
+                {
+                    "valid_date": pixel.index,
+                    "pixel": pixel.to_numpy(),
+                    "x": x,
+                    "y": y,
+                    "source": "pixel",
+                }
+            )
+        )
+    return pd.concat(parts, ignore_index=True)
+
+
+def unstack_series(df):
+    """
+    Split a frame from `stack_series`.
+
+    Returns
+    -------
+    tuple
+        The stats from the database and from the COGs, the values of the
+        pixel as a series indexed by date or None, and its (x, y) or None.
+    """
+    df_db = df[df["source"] == "db"].drop(columns="source")
+    df_cog = df[df["source"] == "cog"].drop(columns="source")
+    df_pixel = df[df["source"] == "pixel"]
+    if df_pixel.empty:
+        return df_db, df_cog, None, None
+    pixel = df_pixel.set_index("valid_date")["pixel"]
+    point = (df_pixel["x"].iloc[0], df_pixel["y"].iloc[0])
+    return df_db, df_cog, pixel, point
+
+
+def get_raster_stats_between(iso3, pcode, band, start_date, end_date):
+    """
+    Get the raster stats of an admin unit and band from `start_date` to
+    `end_date` inclusive, sliced from its cached history.
+    """
+    version = _get_latest_date()
+    history = get_raster_stats_history(iso3, pcode, band, version)
+    dates = history["valid_date"]
+    lo = np.searchsorted(dates, np.datetime64(start_date), side="left")
+    hi = np.searchsorted(dates, np.datetime64(end_date), side="right")
+    return pd.DataFrame(
+        {col: values[lo:hi] for col, values in history.items()}
+    )
+
+
+def get_raster_stats_query(iso3, pcode, issue_date, band, date_range=10):
+    """
+    Build the query for the `date_range` days up to `issue_date` in every
+    year. The days are matched with one `valid_date` range per year rather
+    than by formatting the date, so that the composite index in
+    `sql/indexes.sql` serves the whole predicate.
+
+    Returns
+    -------
+    tuple
+        The query and its parameters.
+    """
+    date_obj = datetime.strptime(issue_date, "%Y-%m-%d").date()
+    windows = date_utils.get_yearly_windows(
+        date_obj, date_range, date_utils.get_start_year("floodscan")
+    )
+
+    params = {"pcode": pcode, "iso3": iso3, "band": band}
+    date_filters = []
+    for i, (start, end) in enumerate(windows):
+        date_filters.append(f"valid_date BETWEEN :start_{i} AND :end_{i}")
+        params[f"start_{i}"] = start
+        params[f"end_{i}"] = end
+
+    query = text(
+        f"""
+        SELECT *
+        FROM floodscan
+        WHERE
+            iso3 = :iso3
+            AND pcode = :pcode
+            AND band = :band
+            AND ({" OR ".join(date_filters)})
+        ORDER BY valid_date DESC;
+        """
+    )
+    return query, params
+
+
 def get_raster_stats(iso3, pcode, issue_date, band, date_range=10):
-    date_obj = datetime.strptime(issue_date, "%Y-%m-%d")
+    """
+    Get the raster stats for an admin unit, through caches that are
+    invalidated when newer data is ingested into the table.
+
+    With `FLOODSCAN_STATS_HISTORY` the full history of the admin unit and
+    band is loaded once and the date windows are sliced from it in memory,
+    so that stepping through issue dates doesn't query the database.
+    Otherwise each window is queried and cached separately.
+    """
+    version = _get_latest_date()
+    if FLOODSCAN_STATS_HISTORY:
+        history = get_raster_stats_history(iso3, pcode, band, version)
+        return _slice_raster_stats_history(history, issue_date, date_range)
+
+    key = f"floodscan/{STAGE}/{iso3}/{pcode}/{issue_date}/{band}/{date_range}"
+    df = _stats_cache.get(key, version)
+    if df is None:
+        df = _stats_flight.do(
+            (key, version),
+            _load_cached,
+            key,
+            version,
+            _load_raster_stats,
+            iso3,
+            pcode,
+            issue_date,
+            band,
+            date_range,
+        )
+    return df
+
+
+def get_raster_stats_history(iso3, pcode, band, version=None):
+    """
+    Get all raster stats of an admin unit and band as numpy arrays sorted by
+    `valid_date`, with float stats stored as float32. Histories are kept in
+    an in-process LRU and in the cache shared by all workers.
+
+    Parameters
+    ----------
+    version : optional
+        Newest date in the table, to invalidate histories loaded before it.
+
+    Returns
+    -------
+    dict
+        Column name to array, in the column order of the table.
+    """
+    key = f"floodscan-history/{STAGE}/{iso3}/{pcode}/{band}"
+    cached = _history_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    df = _stats_cache.get(key, version)
+    if df is None:
+        df = _stats_flight.do(
+            (key, version),
+            _load_cached,
+            key,
+            version,
+            _load_raster_stats_history,
+            iso3,
+            pcode,
+            band,
+        )
+
+    history = {}
+    for col in df.columns:
+        if col == "valid_date":
+            history[col] = df[col].to_numpy("datetime64[ns]")
+        else:
+            history[col] = df[col].to_numpy()
+    nbytes = sum(values.nbytes for values in history.values())
+    _history_cache.put(key, (version, history), nbytes=nbytes)
+    return history
+
+
+def warm_raster_stats(iso3, pcode, band):
+    """
+    Load the stats history of an admin unit and band into the caches of
+    this process, e.g. in a worker before it forks the background job
+    reading the stats, which then slices it in memory.
+    """
+    if FLOODSCAN_STATS_HISTORY:
+        get_raster_stats_history(iso3, pcode, band, _get_latest_date())
+
+
+def _get_latest_date():
+    if STATS_BACKEND == "parquet":
+        return stats_mirror.get_latest_date("floodscan")
+    return db_utils.get_latest_date("floodscan", "valid_date")
+
 
-    # Create a list of MM-DD strings to match
-    mm_dd_list = []
-    for i in range(date_range):
-        day = date_obj - timedelta(i)
-        mm_dd_list.append(day.strftime("%m-%d"))
+def _load_cached(key, version, loader, *args):
+    # Load into the shared cache, unless another process just did
+    df = _stats_cache.get(key, version)
+    if df is None:
+        df = loader(*args)
+        _stats_cache.put(key, df, version)
+    return df
+
+
+def _load_raster_stats_history(iso3, pcode, band):
+    if STATS_BACKEND == "parquet":
+        df = stats_mirror.read_stats(
+            "floodscan",
+            (ds.field("iso3") == iso3)
+            & (ds.field("band") == band)
+            & (ds.field("pcode") == pcode),
+        )
+        df = df.sort_values("valid_date", ignore_index=True)
+    else:
+        df = _query_raster_stats_history(iso3, pcode, band)
+    df["valid_date"] = pd.to_datetime(df["valid_date"])
+    float_cols = df.select_dtypes("float").columns
+    df[float_cols] = df[float_cols].astype("float32")
+    return df
 
+
+def _query_raster_stats_history(iso3, pcode, band):
     query = text(
         """
         SELECT *
         FROM floodscan
         WHERE
-            TO_CHAR(valid_date, 'MM-DD') IN :mm_dd_list
-            AND iso3 = :iso3
+            iso3 = :iso3
             AND pcode = :pcode
             AND band = :band
-        ORDER BY valid_date DESC;
+        ORDER BY valid_date;
         """
     )
+    with db_utils.connect() as con:
+        return pd.read_sql(
+            query, con, params={"iso3": iso3, "pcode": pcode, "band": band}
+        )
+
+
+def _slice_raster_stats_history(history, issue_date, date_range):
+    date_obj = datetime.strptime(issue_date, "%Y-%m-%d").date()
+    windows = date_utils.get_yearly_windows(
+        date_obj, date_range, date_utils.get_start_year("floodscan")
+    )
+    dates = history["valid_date"]
+    starts = np.array([start for start, _ in windows], dtype="datetime64[ns]")
+    ends = np.array([end for _, end in windows], dtype="datetime64[ns]")
+    lo = np.searchsorted(dates, starts, side="left")
+    hi = np.searchsorted(dates, ends, side="right")
+    rows = np.concatenate(
+        [np.arange(i, j) for i, j in zip(lo, hi)] or [np.array([], int)]
+    )
+    df = pd.DataFrame({col: values[rows] for col, values in history.items()})
+    return _add_derived_columns(df, issue_date)
+
 
-    engine = stratus.get_engine("prod")
-    with engine.connect() as con:
-        df = pd.read_sql(
-            query,
-            con,
-            params={
-                "pcode": pcode,
-                "iso3": iso3,
-                "band": band,
-                "mm_dd_list": tuple(mm_dd_list),
-            },
+def _load_raster_stats(iso3, pcode, issue_date, band, date_range=10):
+    if STATS_BACKEND == "parquet":
+        df = _read_raster_stats(iso3, pcode, issue_date, band, date_range)
+    else:
+        query, params = get_raster_stats_query(
+            iso3, pcode, issue_date, band, date_range
         )
+        with db_utils.connect() as con:
+            df = pd.read_sql(query, con, params=params)
+
+    return _add_derived_columns(df, issue_date)
+
+
+def _read_raster_stats(iso3, pcode, issue_date, band, date_range):
+    # Same yearly windows as `get_raster_stats_query`, read from the mirror
+    date_obj = datetime.strptime(issue_date, "%Y-%m-%d").date()
+    windows = date_utils.get_yearly_windows(
+        date_obj, date_range, date_utils.get_start_year("floodscan")
+    )
+    in_windows = None
+    for start, end in windows:
+        in_window = (ds.field("valid_date") >= start) & (
+            ds.field("valid_date") <= end
+        )
+        in_windows = (
+            in_window if in_windows is None else in_windows | in_window
+        )
+    df = stats_mirror.read_stats(
+        "floodscan",
+        (ds.field("iso3") == iso3)
+        & (ds.field("band") == band)
+        & (ds.field("pcode") == pcode)
+        & in_windows,
+    )
+    return df.sort_values("valid_date", ascending=False, ignore_index=True)
+
 
+def _add_derived_columns(df, issue_date):
     df["valid_date"] = pd.to_datetime(df["valid_date"])
     df["valid_year"] = df["valid_date"].dt.year
 
@@ -0,0 +1,48 @@
+from collections import namedtuple
+from types import MappingProxyType
+
+import pandas as pd
+
+from src.constants import ISO3_REFRESH_INTERVAL, STAGE, STATS_BACKEND
+from src.datasources import stats_mirror
+from src.utils import db_utils
+from src.utils.cache_utils import RefreshedSnapshot
+
+Iso3Metadata = namedtuple("Iso3Metadata", ["max_adm_level", "floodscan"])
+# Read-only metadata by iso3, and the iso3s of each dataset in table order
+Iso3Snapshot = namedtuple("Iso3Snapshot", ["metadata", "iso3s"])
+
+
+def load_iso3_metadata(stage=STAGE):
+    if STATS_BACKEND == "parquet":
+        df_iso3 = stats_mirror.read_metadata("iso3", stage)
+    else:
+        with db_utils.connect(stage) as conn:
+            df_iso3 = pd.read_sql(
+                "select iso3, max_adm_level, floodscan from iso3", con=conn
+            )
+    metadata = {
+        row.iso3: Iso3Metadata(int(row.max_adm_level), bool(row.floodscan))
+        for row in df_iso3.itertuples()
+    }
+    iso3s = {
+        "seas5": tuple(metadata),
+        "floodscan": tuple(
+            iso3 for iso3, meta in metadata.items() if meta.floodscan
+        ),
+    }
+    return Iso3Snapshot(MappingProxyType(metadata), MappingProxyType(iso3s))
+
+
+iso3_metadata = RefreshedSnapshot(
+    load_iso3_metadata, ISO3_REFRESH_INTERVAL, "iso3 metadata"
+)
+
+
+def get_iso3s(dataset):
+    return iso3_metadata.get().iso3s.get(dataset, ())
+
+
+def get_max_adm_level(iso3):
+    meta = iso3_metadata.get().metadata.get(iso3)
+    return None if meta is None else meta.max_adm_level
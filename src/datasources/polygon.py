@@ -0,0 +1,106 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.constants import PCODE_INDEX_REFRESH_INTERVAL, STAGE, STATS_BACKEND
+from src.datasources import stats_mirror
+from src.utils import db_utils
+from src.utils.cache_utils import RefreshedSnapshot
+
+# Admin units of one iso3 and admin level, sorted by case-folded name.
+# `pcode_keys` are the case-folded pcodes in sorted order, and `pcode_order`
+# the position in name order of each of them
+PcodeGroup = namedtuple(
+    "PcodeGroup", ["names", "pcodes", "name_keys", "pcode_keys", "pcode_order"]
+)
+
+
+def load_pcode_index(stage=STAGE):
+    """
+    Load the admin units of the `polygon` table, or of its mirror with the
+    parquet stats backend, into sorted arrays per (iso3, admin level), for
+    prefix search by name or pcode.
+
+    Returns
+    -------
+    dict
+        (iso3, admin level) to `PcodeGroup`.
+    """
+    if STATS_BACKEND == "parquet":
+        df = stats_mirror.read_metadata("polygon", stage)
+    else:
+        with db_utils.connect(stage) as conn:
+            df = pd.read_sql(
+                "select iso3, adm_level, pcode, name from polygon", con=conn
+            )
+    df["name"] = df["name"].fillna(df["pcode"])
+    index = {}
+    for (iso3, adm_level), df_group in df.groupby(["iso3", "adm_level"]):
+        df_group = df_group.assign(key=df_group["name"].str.casefold())
+        df_group = df_group.sort_values(["key", "pcode"])
+        pcode_keys = df_group["pcode"].str.casefold().to_numpy(str)
+        pcode_order = np.argsort(pcode_keys, kind="stable")
+        index[(iso3, int(adm_level))] = PcodeGroup(
+            names=df_group["name"].to_numpy(str),
+            pcodes=df_group["pcode"].to_numpy(str),
+            name_keys=df_group["key"].to_numpy(str),
+            pcode_keys=pcode_keys[pcode_order],
+            pcode_order=pcode_order,
+        )
+    return index
+
+
+pcode_index = RefreshedSnapshot(
+    load_pcode_index, PCODE_INDEX_REFRESH_INTERVAL, "pcode index"
+)
+
+
+def search_pcodes(iso3, adm_level, query="", offset=0, limit=50):
+    """
+    Find the admin units of an iso3 and admin level whose name or pcode
+    starts with `query`, ignoring case, in alphabetical order of names.
+
+    Parameters
+    ----------
+    query : str, optional
+        Prefix to match. All admin units match an empty query.
+    offset, limit : int, optional
+        Page of matches to return.
+
+    Returns
+    -------
+    tuple
+        List of (pcode, name) pairs in the page, and total number of matches.
+    """
+    group = pcode_index.get().get((iso3, int(adm_level)))
+    if group is None:
+        return [], 0
+    query = query.strip().casefold()
+    if query:
+        positions = np.union1d(
+            np.arange(*_prefix_range(group.name_keys, query)),
+            group.pcode_order[slice(*_prefix_range(group.pcode_keys, query))],
+        )
+    else:
+        positions = np.arange(len(group.names))
+    page = positions[offset : offset + limit]
+    return list(zip(group.pcodes[page], group.names[page])), len(positions)
+
+
+def get_pcode_name(iso3, adm_level, pcode):
+    group = pcode_index.get().get((iso3, int(adm_level)))
+    if group is None:
+        return None
+    i = np.searchsorted(group.pcode_keys, pcode.casefold())
+    if i < len(group.pcode_keys) and group.pcode_keys[i] == pcode.casefold():
+        return group.names[group.pcode_order[i]]
+    return None
+
+
+def _prefix_range(keys, prefix):
+    # Keys starting with `prefix` sort between it and it followed by the
+    # highest code point
+    start = np.searchsorted(keys, prefix, side="left")
+    stop = np.searchsorted(keys, prefix + "\U0010ffff", side="left")
+    return start, stop
@@ -1,61 +1,322 @@
-import ocha_stratus as stratus
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import rasterio
 import xarray as xr
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+
+from src.constants import (
+    RASTER_STATS_CACHE_MAX_BYTES,
+    RASTER_STATS_CACHE_PATH,
+    RASTER_STATS_CACHE_TTL,
+    SEAS5_FETCH_TIMEOUT,
+    SEAS5_FETCH_WORKERS,
+    STAGE,
+    STATS_BACKEND,
+)
+from src.datasources import stats_mirror
+from src.datasources.blob import get_cog_path
+from src.utils import blockcache, date_utils, db_utils
+from src.utils.cache_utils import DiskFrameCache
+from src.utils.raster import open_cog, to_bbox
+from src.utils.singleflight import SingleFlight
+
+_stats_cache = DiskFrameCache(
+    RASTER_STATS_CACHE_PATH,
+    RASTER_STATS_CACHE_MAX_BYTES,
+    RASTER_STATS_CACHE_TTL,
+)
+_stats_flight = SingleFlight("seas5-stats")
+_raster_flight = SingleFlight("seas5-rasters")
+
+logger = logging.getLogger(__name__)
+
+SEAS5_LEADTIMES = range(0, 7)
+
+
+def get_seas5_blob_name(issued_date_str: str, lt: int):
+    return f"seas5/monthly/processed/precip_em_i{issued_date_str}_lt{lt}.tif"
+
+
+def open_seas5_cog(issued_date_str: str, lt: int, bbox=None, max_size=None):
+    blob_name = get_seas5_blob_name(issued_date_str, lt)
+    return open_cog(get_cog_path(blob_name), bbox=bbox, max_size=max_size)
+
+
+def open_seas5_rasters(
+    issued_date_str: str,
+    bbox=None,
+    max_size=None,
+    max_workers: int = SEAS5_FETCH_WORKERS,
+    timeout: float = SEAS5_FETCH_TIMEOUT,
+):
+    """
+    Open all leadtimes of a SEAS5 issue date as a single stack. Concurrent
+    identical calls of all workers share one fetch.
 
-from src.constants import STAGE
+    The leadtime COGs are fetched concurrently on a bounded thread pool and
+    written straight into a preallocated (lt, y, x) array. Leadtimes that
+    fail or time out are left as NaN and listed in the `missing_leadtimes`
+    attribute of the result.
 
+    Parameters
+    ----------
+    issued_date_str : str
+        Issue date as YYYY-MM-DD.
+    bbox : tuple, shapely geometry or GeoDataFrame, optional
+        Bounds to read, see `src.utils.raster.open_cog`.
+    max_size : int, optional
+        Display size used to select an overview, see
+        `src.utils.raster.open_cog`.
+    max_workers : int, optional
+        Number of leadtimes fetched at once.
+    timeout : float, optional
+        Seconds allowed for fetching each leadtime, from when its fetch
+        starts.
 
-def open_seas5_cog(issued_date_str: str, lt: int):
-    blob_name = (
-        f"seas5/monthly/processed/precip_em_i{issued_date_str}_lt{lt}.tif"
+    Returns
+    -------
+    xarray.DataArray
+        Stack with dimensions (date, lt, y, x).
+
+    Raises
+    ------
+    Exception
+        The error of the first leadtime if no leadtime could be fetched.
+    """
+    if bbox is not None:
+        bbox = to_bbox(bbox)
+    return _raster_flight.do(
+        (issued_date_str, bbox, max_size),
+        _open_seas5_rasters,
+        issued_date_str,
+        bbox,
+        max_size,
+        max_workers,
+        timeout,
     )
-    return stratus.open_blob_cog(
-        blob_name, stage=STAGE, container_name="raster"
+
+
+def _open_seas5_rasters(issued_date_str, bbox, max_size, max_workers, timeout):
+    leadtimes = list(SEAS5_LEADTIMES)
+    # Each leadtime gets `timeout` seconds from when its fetch starts. At
+    # most `max_workers` fetches run at once, and a timed out fetch gives up
+    # its slot, so the leadtimes queued after it still start
+    slots = threading.Semaphore(max_workers)
+    lock = threading.Lock()
+    started, released = {}, set()
+
+    def release(lt):
+        with lock:
+            if lt not in released:
+                released.add(lt)
+                slots.release()
+
+    def fetch(lt):
+        slots.acquire()
+        with lock:
+            started[lt] = time.monotonic()
+        try:
+            return _fetch_seas5_cog(
+                issued_date_str, lt, bbox, max_size, timeout
+            )
+        finally:
+            release(lt)
+
+    executor = ThreadPoolExecutor(max_workers=len(leadtimes))
+    futures = {executor.submit(fetch, lt): lt for lt in leadtimes}
+    pending, timed_out = set(futures), set()
+    while pending:
+        with lock:
+            deadlines = [
+                started[futures[future]] + timeout
+                for future in pending
+                if futures[future] in started
+            ]
+        wait_for = min(deadlines) - time.monotonic() if deadlines else timeout
+        _, pending = wait(
+            pending, timeout=max(wait_for, 0), return_when=FIRST_COMPLETED
+        )
+        now = time.monotonic()
+        for future in list(pending):
+            lt = futures[future]
+            with lock:
+                expired = lt in started and now - started[lt] >= timeout
+            if expired:
+                pending.remove(future)
+                timed_out.add(future)
+                release(lt)
+    # Timed out fetches stop at their next request, see `_fetch_seas5_cog`
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    das, errors = {}, {}
+    for future, lt in futures.items():
+        if future in timed_out:
+            errors[lt] = TimeoutError(f"Timed out after {timeout}s")
+        elif future.exception() is not None:
+            errors[lt] = future.exception()
+        else:
+            das[lt] = future.result()
+
+    if not das:
+        raise errors[leadtimes[0]]
+
+    template = das[min(das)]
+    for lt, da in list(das.items()):
+        if da.shape != template.shape:
+            errors[lt] = ValueError(f"Unexpected raster shape {da.shape}")
+            del das[lt]
+    if errors:
+        logger.warning(
+            f"Missing SEAS5 leadtimes for {issued_date_str}: "
+            + ", ".join(
+                f"{lt} ({err!r})" for lt, err in sorted(errors.items())
+            )
+        )
+
+    values = np.full(
+        (len(leadtimes),) + template.shape,
+        np.nan,
+        dtype=np.result_type(template.dtype, np.float32),
     )
+    lt_coords = list(leadtimes)
+    for i, lt in enumerate(leadtimes):
+        if lt in das:
+            values[i] = das[lt].values
+            lt_coords[i] = das[lt].attrs["leadtime"]
 
+    # Keep only the attributes shared by all leadtimes, like
+    # combine_attrs="drop_conflicts"
+    attrs = {
+        k: v
+        for k, v in template.attrs.items()
+        if all(
+            k in da.attrs and np.array_equal(da.attrs[k], v)
+            for da in das.values()
+        )
+    }
+    attrs["missing_leadtimes"] = sorted(errors)
 
-def open_seas5_rasters(issued_date_str: str):
-    das = []
-    for lt in range(0, 7):
-        da_in = open_seas5_cog(issued_date_str, lt)
-        da_in = da_in.squeeze(drop=True)
-        da_in["lt"] = da_in.attrs["leadtime"]
-        da_in = da_in.expand_dims(["lt"])
-        das.append(da_in)
-    da_out = xr.combine_by_coords(das, combine_attrs="drop_conflicts")
+    da_out = xr.DataArray(
+        values,
+        dims=("lt",) + template.dims,
+        coords={"lt": lt_coords, **template.coords},
+        attrs=attrs,
+    )
     da_out = da_out.expand_dims(date=[issued_date_str])
 
     return da_out
 
 
-def get_raster_stats(iso3, pcode, issue_date):
+def _fetch_seas5_cog(issued_date_str, lt, bbox, max_size, timeout):
+    # The timeout reaches the block cache requests and GDAL's, whose config
+    # is per thread, so the COG is read in this thread rather than by dask
+    with (
+        blockcache.deadline(timeout),
+        rasterio.Env(GDAL_HTTP_TIMEOUT=max(1, int(timeout))),
+    ):
+        da = open_seas5_cog(issued_date_str, lt, bbox=bbox, max_size=max_size)
+        return da.squeeze(drop=True).load(scheduler="synchronous")
+
+
+def get_raster_stats_query(iso3, pcode, issue_date):
+    """
+    Build the query for the same issue month and day in every year, matched
+    with explicit dates so that the composite index in `sql/indexes.sql`
+    serves the whole predicate.
+
+    Returns
+    -------
+    tuple
+        The query and its parameters.
+    """
+    date_obj = datetime.strptime(issue_date, "%Y-%m-%d").date()
+    windows = date_utils.get_yearly_windows(
+        date_obj, 1, date_utils.get_start_year("seas5")
+    )
     query = text(
         """
         SELECT
             *
         FROM seas5
         WHERE
-            EXTRACT(MONTH FROM issued_date) = EXTRACT(MONTH FROM DATE :issued_date) AND
-            EXTRACT(DAY FROM issued_date) = EXTRACT(DAY FROM DATE :issued_date) AND
             iso3=:iso3 AND
-            pcode=:pcode
+            pcode=:pcode AND
+            issued_date IN :issued_dates
         ORDER BY issued_date, leadtime;
         """
-    )
-    engine = stratus.get_engine(STAGE)
-    with engine.connect() as con:
-        df = pd.read_sql(
-            query,
-            con,
-            params={
-                "pcode": pcode,
-                "iso3": iso3,
-                "issued_date": issue_date,
-            },
+    ).bindparams(bindparam("issued_dates", expanding=True))
+    params = {
+        "pcode": pcode,
+        "iso3": iso3,
+        "issued_dates": tuple(start for start, _ in windows),
+    }
+    return query, params
+
+
+def get_raster_stats(iso3, pcode, issue_date):
+    """
+    Get the raster stats for an admin unit, through a cache shared by all
+    workers that is invalidated when newer data is ingested into the table.
+    """
+    key = f"seas5/{STAGE}/{iso3}/{pcode}/{issue_date}"
+    if STATS_BACKEND == "parquet":
+        version = stats_mirror.get_latest_date("seas5")
+    else:
+        version = db_utils.get_latest_date("seas5", "issued_date")
+    df = _stats_cache.get(key, version)
+    if df is None:
+        df = _stats_flight.do(
+            (key, version),
+            _load_cached,
+            key,
+            version,
+            iso3,
+            pcode,
+            issue_date,
         )
+    return df
+
+
+def _load_cached(key, version, iso3, pcode, issue_date):
+    # Load into the shared cache, unless another process just did
+    df = _stats_cache.get(key, version)
+    if df is None:
+        df = _load_raster_stats(iso3, pcode, issue_date)
+        _stats_cache.put(key, df, version)
+    return df
+
+
+def _load_raster_stats(iso3, pcode, issue_date):
+    if STATS_BACKEND == "parquet":
+        df = _read_raster_stats(iso3, pcode, issue_date)
+    else:
+        query, params = get_raster_stats_query(iso3, pcode, issue_date)
+        with db_utils.connect() as con:
+            df = pd.read_sql(query, con, params=params)
 
     df["issued_date"] = pd.to_datetime(df["issued_date"])
     df["issued_year"] = df["issued_date"].dt.year
 
     return df
+
+
+def _read_raster_stats(iso3, pcode, issue_date):
+    # Same issue dates as `get_raster_stats_query`, read from the mirror
+    date_obj = datetime.strptime(issue_date, "%Y-%m-%d").date()
+    windows = date_utils.get_yearly_windows(
+        date_obj, 1, date_utils.get_start_year("seas5")
+    )
+    df = stats_mirror.read_stats(
+        "seas5",
+        (ds.field("iso3") == iso3)
+        & (ds.field("pcode") == pcode)
+        & ds.field("issued_date").isin([start for start, _ in windows]),
+    )
+    return df.sort_values(["issued_date", "leadtime"], ignore_index=True)
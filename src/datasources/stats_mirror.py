@@ -0,0 +1,377 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import date
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+from src.constants import STAGE, STATS_MIRROR_DIR
+from src.utils import db_utils
+from src.utils.cache_utils import atomic_write_path
+
+logger = logging.getLogger(__name__)
+
+# Date column of each table, the columns its files are partitioned by, and
+# the order of the rows in each file
+DATE_COLUMNS = {"floodscan": "valid_date", "seas5": "issued_date"}
+PARTITION_COLUMNS = {"floodscan": ["iso3", "band"], "seas5": ["iso3"]}
+SORT_COLUMNS = {
+    "floodscan": ["pcode", "valid_date"],
+    "seas5": ["pcode", "issued_date", "leadtime"],
+}
+# Columns of the metadata tables read by the app, copied whole on each sync
+# so that the app runs without the database
+METADATA_COLUMNS = {
+    "iso3": ["iso3", "max_adm_level", "floodscan"],
+    "polygon": ["iso3", "adm_level", "pcode", "name"],
+}
+# Rows per row group, small enough for the pcode and date statistics of the
+# row groups to skip most of a partition
+ROW_GROUP_SIZE = 32 * 1024
+# Rows fetched from the database at once while syncing
+SYNC_CHUNK_ROWS = 500_000
+# Files in a partition above which a sync merges all but the largest
+MAX_PARTITION_FILES = 8
+
+# (stage, table) -> (modification time of the state, state, dataset)
+_datasets = {}
+_datasets_lock = threading.Lock()
+
+
+def get_table_dir(table, stage=STAGE):
+    return os.path.join(STATS_MIRROR_DIR, stage, table)
+
+
+def sync_table(table, stage=STAGE, full=False):
+    """
+    Mirror the new rows of a stats table to Parquet files under
+    `STATS_MIRROR_DIR`.
+
+    The files are partitioned by iso3 (and band for floodscan) in hive
+    layout, sorted by pcode and date, and written with the statistics of
+    each row group, so that the rows of an admin unit are read with
+    partition pruning and predicate pushdown. Like the caches of the app,
+    the sync assumes that the dates of the table are only appended: it
+    fetches the rows from the newest mirrored date on, and writes them as
+    new files per partition. The rows of the newest date, which may still
+    be ingested in several batches, go to separate files that the next sync
+    replaces. Once a partition has more than `MAX_PARTITION_FILES` files
+    of older dates, all but the largest are merged.
+
+    Readers only read the files listed in the state of the mirror, which is
+    written last, so they never see the files of a sync in progress or
+    failed. A `full` sync, e.g. after a backfill, rebuilds the mirror next
+    to the current one and swaps them once done.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+    """
+    root = get_table_dir(table, stage)
+    state = None if full else _read_state(root)
+    if state is not None and "open_files" not in state:
+        # Mirrored before the newest date was kept apart, so rebuilt
+        state = None
+    # Schema of the files, which hold all columns but the partition ones
+    schema = None
+    if state is None:
+        target = f"{root}.{uuid.uuid4().hex}.tmp"
+        files = set()
+        replaced = []
+    else:
+        target = root
+        files = set(state["files"])
+        _remove_unlisted(root, files)
+        # Read before the open files are left out, since they may be all
+        # the files of a mirror of a single date
+        if files:
+            schema = pq.read_schema(os.path.join(root, min(files)))
+        # Files of the newest mirrored date, fetched again in full
+        replaced = state["open_files"]
+        files.difference_update(replaced)
+    date_column = DATE_COLUMNS[table]
+    partition_columns = PARTITION_COLUMNS[table]
+
+    with db_utils.connect(stage) as con:
+        latest = con.execute(
+            text(f"SELECT MAX({date_column}) FROM {table}")
+        ).scalar()
+    if latest is None:
+        raise ValueError(f"No rows in {table}")
+    latest = pd.Timestamp(latest).date()
+    # Rows of dates ingested during the sync are left to the next one
+    query = f"SELECT * FROM {table} WHERE {date_column} <= :latest"
+    params = {"latest": latest}
+    if state is not None:
+        query += f" AND {date_column} >= :since"
+        params["since"] = date.fromisoformat(state["latest"])
+    columns = None if state is None else state["columns"]
+    dates = set() if state is None else set(state["dates"])
+    touched = set()
+    open_files = set()
+    n_rows = 0
+    with db_utils.connect(stage) as con:
+        # Stream the rows through a server-side cursor, rather than fetching
+        # the whole table into memory before the first chunk
+        con = con.execution_options(stream_results=True)
+        for df in pd.read_sql(
+            text(query), con, params=params, chunksize=SYNC_CHUNK_ROWS
+        ):
+            df = _normalize(df, table)
+            columns = columns or list(df.columns)
+            data = pa.Table.from_pandas(
+                df.drop(columns=partition_columns), preserve_index=False
+            )
+            if schema is None:
+                schema = data.schema
+            data = data.cast(schema)
+            is_open = (df[date_column] == latest).to_numpy()
+            for rows, paths in [(~is_open, files), (is_open, open_files)]:
+                for path in _write_partitions(
+                    target,
+                    table,
+                    df.loc[rows, partition_columns],
+                    data.filter(pa.array(rows)),
+                ):
+                    paths.add(os.path.relpath(path, target))
+                    if paths is files:
+                        touched.add(os.path.dirname(path))
+            dates |= set(df[date_column].astype(str))
+            n_rows += len(df)
+            logger.info(f"Mirrored {n_rows} rows of {table}")
+
+    merged = []
+    for partition_dir in touched:
+        merged += _compact_partition(target, partition_dir, table, files)
+    _write_state(
+        target,
+        {
+            "columns": columns,
+            "files": sorted(files | open_files),
+            "open_files": sorted(open_files),
+            "latest": latest.isoformat(),
+            "dates": sorted(dates),
+            "synced_at": time.time(),
+        },
+    )
+    for path in merged + replaced:
+        os.remove(os.path.join(target, path))
+    if target != root:
+        _swap(target, root)
+    return n_rows
+
+
+def sync_metadata(table, stage=STAGE):
+    """
+    Copy the columns of a metadata table listed in `METADATA_COLUMNS` to a
+    Parquet file under `STATS_MIRROR_DIR`, replacing the previous copy.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+    """
+    query = f"SELECT {', '.join(METADATA_COLUMNS[table])} FROM {table}"
+    with db_utils.connect(stage) as con:
+        df = pd.read_sql(text(query), con)
+    path = os.path.join(STATS_MIRROR_DIR, stage, f"{table}.parquet")
+    tmp_path = atomic_write_path(path)
+    df.to_parquet(tmp_path, index=False, compression="zstd")
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def read_metadata(table, stage=STAGE):
+    """
+    Read the copy of a metadata table written by `sync_metadata`.
+    """
+    path = os.path.join(STATS_MIRROR_DIR, stage, f"{table}.parquet")
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No mirror of {table} at {path}, run scripts/sync_stats_mirror.py"
+        )
+    return pd.read_parquet(path)
+
+
+def get_latest_date(table, stage=STAGE):
+    """
+    Get the newest date of a mirrored table, which versions the cached
+    stats like `db_utils.get_latest_date` does for the database.
+    """
+    return _get_dataset(table, stage)[0]["latest"]
+
+
+def list_dates(table, since=None, stage=STAGE):
+    """
+    List the distinct dates of a mirrored table, only from `since` onwards
+    if given.
+    """
+    dates = _get_dataset(table, stage)[0]["dates"]
+    return {d for d in dates if since is None or d >= since}
+
+
+def read_stats(table, filter, stage=STAGE):
+    """
+    Read the rows of a mirrored table matching a `pyarrow.dataset`
+    expression, e.g. `(ds.field("pcode") == pcode) & ...`. Partitions
+    are pruned by the iso3 and band terms, and row groups by the statistics
+    of the other columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows, with the columns of the table in its order.
+    """
+    state, dataset = _get_dataset(table, stage)
+    try:
+        arrow_table = dataset.to_table(columns=state["columns"], filter=filter)
+    except FileNotFoundError:
+        # Files merged or swapped by a sync since the dataset was listed
+        with _datasets_lock:
+            _datasets.pop((stage, table), None)
+        state, dataset = _get_dataset(table, stage)
+        arrow_table = dataset.to_table(columns=state["columns"], filter=filter)
+    return arrow_table.to_pandas()
+
+
+def _get_dataset(table, stage):
+    # The state is written last by a sync, so its modification time tells
+    # when the files have changed
+    root = get_table_dir(table, stage)
+    state_path = os.path.join(root, "_state.json")
+    try:
+        mtime = os.stat(state_path).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"No mirror of {table} at {root}, run scripts/sync_stats_mirror.py"
+        ) from None
+    key = (stage, table)
+    with _datasets_lock:
+        cached = _datasets.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1:]
+    state = _read_state(root)
+    dataset = ds.dataset(
+        [os.path.join(root, path) for path in state["files"]],
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema(
+                [(col, pa.string()) for col in PARTITION_COLUMNS[table]]
+            ),
+            flavor="hive",
+        ),
+        partition_base_dir=root,
+    )
+    with _datasets_lock:
+        _datasets[key] = (mtime, state, dataset)
+    return state, dataset
+
+
+def _normalize(df, table):
+    # Dates as date32 whether the database returns dates or strings
+    for col in ("valid_date", "issued_date"):
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col]).dt.date
+    return df.sort_values(PARTITION_COLUMNS[table] + SORT_COLUMNS[table])
+
+
+def _write_partitions(root, table, df_keys, data):
+    partition_columns = PARTITION_COLUMNS[table]
+    df_keys = df_keys.reset_index(drop=True)
+    # Rows are sorted by partition, so each partition is a contiguous slice
+    groups = df_keys.groupby(partition_columns, sort=False).indices
+    paths = []
+    for rows in groups.values():
+        start, stop = rows.min(), rows.max() + 1
+        keys = df_keys.iloc[start]
+        partition_dir = os.path.join(
+            root, *(f"{col}={keys[col]}" for col in partition_columns)
+        )
+        paths.append(
+            _write_file(partition_dir, data.slice(start, stop - start))
+        )
+    return paths
+
+
+def _write_file(partition_dir, arrow_table):
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, f"part-{uuid.uuid4().hex}.parquet")
+    tmp_path = atomic_write_path(path)
+    pq.write_table(
+        arrow_table,
+        tmp_path,
+        row_group_size=ROW_GROUP_SIZE,
+        compression="zstd",
+        write_statistics=True,
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+def _compact_partition(root, partition_dir, table, files):
+    # Merge the files of a partition into one, listed in `files` in place of
+    # the merged ones, which are returned to be removed once the state no
+    # longer lists them
+    paths = sorted(
+        (
+            path
+            for path in files
+            if os.path.dirname(os.path.join(root, path)) == partition_dir
+        ),
+        key=lambda path: os.path.getsize(os.path.join(root, path)),
+    )
+    if len(paths) <= MAX_PARTITION_FILES:
+        return []
+    # The largest file holds most of the history and is left as it is
+    merged = paths[:-1]
+    arrow_table = pa.concat_tables(
+        pq.ParquetFile(os.path.join(root, path)).read() for path in merged
+    )
+    arrow_table = arrow_table.sort_by(
+        [(col, "ascending") for col in SORT_COLUMNS[table]]
+    )
+    path = _write_file(partition_dir, arrow_table)
+    files.add(os.path.relpath(path, root))
+    files.difference_update(merged)
+    return merged
+
+
+def _remove_unlisted(root, files):
+    # Files left by a failed sync
+    for path in glob.glob(os.path.join(root, "*=*", "**"), recursive=True):
+        if os.path.isfile(path) and os.path.relpath(path, root) not in files:
+            os.remove(path)
+
+
+def _read_state(root):
+    try:
+        with open(os.path.join(root, "_state.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_state(root, state):
+    path = os.path.join(root, "_state.json")
+    tmp_path = atomic_write_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _swap(new_root, root):
+    old_root = f"{root}.{uuid.uuid4().hex}.old"
+    if os.path.exists(root):
+        os.rename(root, old_root)
+    os.rename(new_root, root)
+    shutil.rmtree(old_root, ignore_errors=True)
@@ -0,0 +1,331 @@
+import io
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+import diskcache
+
+from src.constants import (
+    BLOCK_CACHE,
+    BLOCK_CACHE_BLOCK_SIZE,
+    BLOCK_CACHE_DIR,
+    BLOCK_CACHE_ETAG_TTL,
+    BLOCK_CACHE_MAX_BYTES,
+    BLOCK_CACHE_PREFETCH_BYTES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds allowed for each HTTP request to blob storage
+HTTP_TIMEOUT = 30
+# Blocks kept in memory by each open file
+RECENT_BLOCKS = 16
+
+# Blob path -> (etag, size, time they were last checked)
+_heads = {}
+_heads_lock = threading.Lock()
+_blocks = None
+_blocks_pid = None
+_blocks_lock = threading.Lock()
+# Deadline of the requests of each thread, see `deadline`
+_local = threading.local()
+
+
+def get_open_kwargs(path):
+    """
+    Get the keyword arguments of `rasterio.open` or `rioxarray.open_rasterio`
+    reading the COG at `path` through the block cache.
+
+    Remote COGs are read in aligned blocks of `BLOCK_CACHE_BLOCK_SIZE`
+    bytes, kept on local disk and shared by all workers. Blocks are keyed by
+    the blob path without its query string, e.g. a SAS token, and by the
+    blob etag, so a re-uploaded COG is fetched again. The first
+    `BLOCK_CACHE_PREFETCH_BYTES` of a COG, holding its header and IFDs, are
+    fetched in one request when it is opened.
+
+    rasterio serves the reads of a dataset opened this way only in the
+    thread that opened it, so read and close it in that thread, e.g. not
+    through dask.
+
+    Returns
+    -------
+    dict
+        The `opener` serving the COG, or nothing for local paths and when
+        `BLOCK_CACHE` is disabled.
+    """
+    if not BLOCK_CACHE or urlsplit(str(path)).scheme not in ("http", "https"):
+        return {}
+
+    def opener(requested_path, mode="rb"):
+        # GDAL also probes for sidecar files, which blobs never have
+        if requested_path != path:
+            raise FileNotFoundError(requested_path)
+        return CachedBlobFile(path)
+
+    return {"opener": opener}
+
+
+class BlobChangedError(OSError):
+    """
+    The blob was re-uploaded while it was being read.
+    """
+
+
+class CachedBlobFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a blob URL, served from the block cache
+    and fetched with HTTP range requests on misses.
+
+    Range requests only match the etag the blocks are keyed by. If the blob
+    was re-uploaded since its etag was checked, the file starts over on the
+    new version as long as it hasn't returned any bytes yet. Otherwise
+    `BlobChangedError` is raised rather than mixing both versions, and the
+    next file opened on the blob reads the new one.
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.key_prefix = _strip_query(url)
+        self.block_size = BLOCK_CACHE_BLOCK_SIZE
+        self.position = 0
+        self._served = False
+        self._start()
+
+    def _start(self):
+        self.etag, self.size = _head(self.url)
+        # GDAL reads the same block in many small pieces, so the last blocks
+        # read stay in memory
+        self._recent = {}
+        try:
+            self._prefetch()
+        except BlobChangedError:
+            self.etag, self.size = _head(self.url)
+            self._prefetch()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        try:
+            data = self._read(len(buffer))
+        except BlobChangedError:
+            if self._served:
+                raise
+            self._start()
+            data = self._read(len(buffer))
+        if not data:
+            return 0
+        self._served = True
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def _read(self, n_bytes):
+        start = self.position
+        end = min(start + n_bytes, self.size)
+        if start >= end:
+            return b""
+        return self._read_range(start, end)
+
+    def _prefetch(self):
+        prefetch_bytes = min(BLOCK_CACHE_PREFETCH_BYTES, self.size)
+        self._get_blocks(range(-(-prefetch_bytes // self.block_size)))
+
+    def _read_range(self, start, end):
+        indexes = range(
+            start // self.block_size, (end - 1) // self.block_size + 1
+        )
+        blocks = self._get_blocks(indexes)
+        data = b"".join(blocks[i] for i in indexes)
+        offset = indexes[0] * self.block_size
+        return data[start - offset : end - offset]
+
+    def _get_blocks(self, indexes):
+        cache = _get_blocks_cache()
+        blocks, missing = {}, []
+        for i in indexes:
+            data = self._recent.get(i)
+            if data is None:
+                data = cache.get(self._block_key(i))
+            if data is None:
+                missing.append(i)
+            else:
+                blocks[i] = data
+        # One request per run of consecutive missing blocks
+        for run in _runs(missing):
+            blocks.update(self._fetch_blocks(run))
+        if len(self._recent) + len(blocks) > RECENT_BLOCKS:
+            self._recent.clear()
+        self._recent.update(blocks)
+        return blocks
+
+    def _fetch_blocks(self, run):
+        start = run[0] * self.block_size
+        end = min((run[-1] + 1) * self.block_size, self.size)
+        try:
+            data = _fetch_range(self.url, start, end, self.etag)
+        except BlobChangedError:
+            _forget_head(self.url)
+            raise
+        cache = _get_blocks_cache()
+        blocks = {}
+        for i in run:
+            offset = i * self.block_size - start
+            blocks[i] = data[offset : offset + self.block_size]
+            cache.set(self._block_key(i), blocks[i])
+        return blocks
+
+    def _block_key(self, i):
+        # (blob path, etag, offset, length)
+        offset = i * self.block_size
+        return f"{self.key_prefix}|{self.etag}|{offset}|{self.block_size}"
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Time out the requests made by this thread within the block, so that
+    together they take at most `seconds`, e.g. to bound the read of one COG.
+    Requests started after the deadline raise `TimeoutError`.
+    """
+    previous = getattr(_local, "deadline", None)
+    _local.deadline = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def get_stats():
+    """
+    Get the size of the block cache, and its hits and misses over all
+    processes since the cache was created.
+    """
+    cache = _get_blocks_cache()
+    hits, misses = cache.stats()
+    return {
+        "nbytes": cache.volume(),
+        "max_bytes": BLOCK_CACHE_MAX_BYTES,
+        "block_size": BLOCK_CACHE_BLOCK_SIZE,
+        "hits": hits,
+        "misses": misses,
+    }
+
+
+def get_etag(url):
+    """
+    Get the etag of a blob, revalidated at most every `BLOCK_CACHE_ETAG_TTL`
+    seconds.
+    """
+    return _head(url)[0]
+
+
+def _head(url):
+    key = _strip_query(url)
+    now = time.monotonic()
+    with _heads_lock:
+        cached = _heads.get(key)
+    if cached is not None and now - cached[2] < BLOCK_CACHE_ETAG_TTL:
+        return cached[:2]
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(
+        request, timeout=_request_timeout()
+    ) as response:
+        etag = response.headers.get("ETag", "").strip('"')
+        size = int(response.headers["Content-Length"])
+    with _heads_lock:
+        _heads[key] = (etag, size, now)
+    return etag, size
+
+
+def _forget_head(url):
+    with _heads_lock:
+        _heads.pop(_strip_query(url), None)
+
+
+def _fetch_range(url, start, end, etag=None):
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    if etag:
+        headers["If-Match"] = f'"{etag}"'
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=_request_timeout())
+    except urllib.error.HTTPError as err:
+        if err.code == 412:
+            raise BlobChangedError(
+                f"{_strip_query(url)} no longer has etag {etag}"
+            ) from None
+        raise
+    with response:
+        data = response.read()
+        if response.status == 200:
+            # The server ignored the range and sent the whole blob
+            data = data[start:end]
+    if len(data) != end - start:
+        raise OSError(
+            f"Expected {end - start} bytes of {_strip_query(url)} from "
+            f"{start}, got {len(data)}"
+        )
+    return data
+
+
+def _request_timeout():
+    end = getattr(_local, "deadline", None)
+    if end is None:
+        return HTTP_TIMEOUT
+    remaining = end - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Deadline of the read exceeded")
+    return min(HTTP_TIMEOUT, remaining)
+
+
+def _runs(indexes):
+    run = []
+    for i in indexes:
+        if run and i != run[-1] + 1:
+            yield run
+            run = []
+        run.append(i)
+    if run:
+        yield run
+
+
+def _strip_query(url):
+    return urlunsplit(urlsplit(url)._replace(query="", fragment=""))
+
+
+def _get_blocks_cache():
+    global _blocks, _blocks_pid
+    with _blocks_lock:
+        if _blocks_pid != os.getpid():
+            _blocks = diskcache.Cache(
+                BLOCK_CACHE_DIR,
+                size_limit=BLOCK_CACHE_MAX_BYTES,
+                eviction_policy="least-recently-used",
+            )
+            _blocks.stats(enable=True)
+            _blocks_pid = os.getpid()
+        return _blocks
@@ -0,0 +1,326 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache bounded by the total size of its values.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum combined size of all cached values, in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = sys.getsizeof(value)
+        # Never let a single oversized value flush the whole cache
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._data.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, nbytes = self._data.pop(key)
+            self.nbytes -= nbytes
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RefreshedSnapshot:
+    """
+    Immutable value built by `loader`, kept in memory and rebuilt on a
+    background thread every `interval` seconds.
+
+    Readers get the current snapshot without locking or blocking. A refresh
+    replaces the whole value at once, so a reader never sees a partially
+    updated one. If a refresh fails the previous snapshot is kept. Until a
+    first value is loaded, e.g. while the database is down, readers try to
+    load it themselves and the background thread retries every
+    `RETRY_INTERVAL` seconds.
+
+    Parameters
+    ----------
+    loader : callable
+        Builds the value, e.g. from the database. Called without arguments.
+    interval : float
+        Seconds between background refreshes.
+    name : str
+        Name of the value in logs.
+    """
+
+    # Seconds between background loads while there is no value yet
+    RETRY_INTERVAL = 30
+
+    def __init__(self, loader, interval, name):
+        self.loader = loader
+        self.interval = interval
+        self.name = name
+        self.loaded_at = None
+        self._value = None
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def get(self):
+        # Loads on first use if `start` hasn't been called, e.g. in scripts
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._load()
+                value = self._value
+        return value
+
+    def refresh(self):
+        with self._lock:
+            self._load()
+
+    def start(self):
+        """
+        Start refreshing the value in the background and load it if needed.
+        Threads don't survive forks, so call this in each worker process.
+
+        The thread is started before the first load, so that it retries a
+        failed one. The error of the first load is still raised.
+        """
+        with self._lock:
+            started = self._thread_pid == os.getpid()
+            self._thread_pid = os.getpid()
+        if not started:
+            thread = threading.Thread(
+                target=self._run, name=f"refresh-{self.name}", daemon=True
+            )
+            thread.start()
+        self.get()
+
+    def _run(self):
+        while True:
+            loaded = self._value is not None
+            time.sleep(self.interval if loaded else self.RETRY_INTERVAL)
+            try:
+                if loaded:
+                    self.refresh()
+                else:
+                    self.get()
+            except Exception:
+                logger.exception(f"Refreshing {self.name} failed")
+
+    def _load(self):
+        start = time.monotonic()
+        self._value = self.loader()
+        self.loaded_at = time.time()
+        logger.info(f"Loaded {self.name} in {time.monotonic() - start:.2f}s")
+
+
+def atomic_write_path(path):
+    """
+    Return a unique temporary path next to `path`, to be moved into place with
+    `os.replace` once fully written. Readers in other workers never see a
+    partially written file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+class DiskFrameCache:
+    """
+    DataFrame cache in a SQLite file on local disk, shared by all worker
+    processes. Frames are stored in the Arrow IPC format.
+
+    Entries expire after `ttl` seconds and can be tagged with a version, e.g.
+    the newest date in the source table, so that a lookup with another
+    version misses. Expired entries are kept until the stored frames exceed
+    `max_bytes`, and are then evicted before the least recently used ones,
+    so that lookups with `ignore_expired` can still find them.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file.
+    max_bytes : int
+        Maximum combined size of the serialized frames, in bytes.
+    ttl : float
+        Default lifetime of entries, in seconds.
+    """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._initialized = False
+
+    def get(self, key, version=None, ignore_expired=False):
+        now = time.time()
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT data, version, expires FROM frames WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            data, stored_version, expires = row
+            if stored_version != _as_version(version):
+                con.execute("DELETE FROM frames WHERE key = ?", (key,))
+                return None
+            if expires < now and not ignore_expired:
+                return None
+            con.execute(
+                "UPDATE frames SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return pa.ipc.open_stream(data).read_pandas()
+
+    def put(self, key, df, version=None, ttl=None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        data = _serialize_frame(df)
+        if len(data) > self.max_bytes:
+            return
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?)",
+                (key, _as_version(version), data, len(data), now, now + ttl),
+            )
+            self._evict(con, now)
+
+    def has(self, key, ignore_expired=False):
+        now = float("-inf") if ignore_expired else time.time()
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT 1 FROM frames WHERE key = ? AND expires >= ?",
+                (key, now),
+            ).fetchone()
+        return row is not None
+
+    def delete(self, key):
+        with self._connect() as con:
+            con.execute("DELETE FROM frames WHERE key = ?", (key,))
+
+    def stats(self):
+        with self._connect() as con:
+            entries, nbytes = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM frames"
+            ).fetchone()
+        return {
+            "entries": entries,
+            "nbytes": nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _evict(self, con, now):
+        total = con.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM frames"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = con.execute(
+            "SELECT key, nbytes FROM frames ORDER BY expires >= ?, accessed",
+            (now,),
+        ).fetchall()
+        evicted = []
+        for key, nbytes in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= nbytes
+        con.executemany("DELETE FROM frames WHERE key = ?", evicted)
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            self._initialize()
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:  # Commits unless the block raises
+                yield con
+        finally:
+            con.close()
+
+    def _initialize(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(sqlite3.connect(self.path, timeout=30)) as con:
+            # WAL lets readers in other workers proceed during writes
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS frames (
+                    key TEXT PRIMARY KEY,
+                    version TEXT,
+                    data BLOB,
+                    nbytes INTEGER,
+                    accessed REAL,
+                    expires REAL
+                )
+                """
+            )
+        self._initialized = True
+
+
+def _serialize_frame(df):
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _as_version(version):
+    return None if version is None else str(version)
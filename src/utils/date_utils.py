@@ -2,29 +2,82 @@ from datetime import date, timedelta
 
 import pandas as pd
 
+DATE_RANGES = {
+    "seas5": {"start_date": "1981-01-01", "frequency": "MS"},
+    "floodscan": {"start_date": "1998-01-12", "frequency": "D"},
+}
 
-# TODO: Modify for other datasets
-def get_date_range(dataset):
-    date_ranges = {
-        "seas5": {"start_date": "1981-01-01", "frequency": "MS"},
-        "floodscan": {"start_date": "1998-01-12", "frequency": "D"},
-    }
-    start_date = date_ranges[dataset]["start_date"]
-    frequency = date_ranges[dataset]["frequency"]
-    today = date.today()
-    if dataset == "seas5":
-        if today.day < 6:
-            if today.month == 1:
-                end_date = date(today.year - 1, 12, 1)
-            else:
-                end_date = date(today.year, today.month - 1, 1)
+
+def get_start_year(dataset):
+    return int(DATE_RANGES[dataset]["start_date"][:4])
+
+
+def get_yearly_windows(end_date, days, start_year, end_year=None):
+    """
+    Get the date ranges covering the same calendar days in every year, e.g.
+    to match `days` days up to `end_date` across the whole record with
+    index-friendly range predicates.
+
+    Parameters
+    ----------
+    end_date : datetime.date
+        Last day of the window.
+    days : int
+        Length of the window in days, including `end_date`.
+    start_year : int
+        First year of the record.
+    end_year : int, optional
+        Last year of the record, by default the current year.
+
+    Returns
+    -------
+    list of tuple
+        Inclusive (start, end) dates, one per year in which the window
+        overlaps the record. A window crossing new year ends in the year after
+        the one it starts in. Feb 29 is only matched if it is within the
+        window ending on `end_date`, as when matching by month and day.
+    """
+    if end_year is None:
+        end_year = date.today().year
+    start_date = end_date - timedelta(days=days - 1)
+    crosses_year = start_date.year != end_date.year
+
+    has_leap_day = any(
+        (day.month, day.day) == (2, 29)
+        for day in pd.date_range(start_date, end_date)
+    )
+
+    windows = []
+    for year in range(start_year, end_year + 1 + crosses_year):
+        offset = year - end_date.year
+        window_start = _shift_years(start_date, offset, leap_day=(3, 1))
+        window_end = _shift_years(end_date, offset, leap_day=(2, 28))
+        if window_start > window_end:
+            continue
+        leap_day = _get_leap_day(window_start, window_end)
+        if leap_day and not has_leap_day:
+            # Skip Feb 29 when it is not one of the calendar days matched
+            windows.append((window_start, leap_day - timedelta(days=1)))
+            windows.append((leap_day + timedelta(days=1), window_end))
         else:
-            end_date = date(today.year, today.month, 1)
-    elif dataset == "floodscan":
-        end_date = today - timedelta(days=1)
+            windows.append((window_start, window_end))
+    return windows
+
+
+def _get_leap_day(start_date, end_date):
+    for year in range(start_date.year, end_date.year + 1):
+        try:
+            leap_day = date(year, 2, 29)
+        except ValueError:
+            continue
+        if start_date <= leap_day <= end_date:
+            return leap_day
+    return None
 
-    date_range = pd.date_range(start=start_date, end=end_date, freq=frequency)
 
-    date_strings = [d.strftime("%Y-%m-%d") for d in date_range]
-    date_strings.sort(reverse=True)
-    return date_strings
+def _shift_years(day, years, leap_day):
+    try:
+        return day.replace(year=day.year + years)
+    except ValueError:
+        # Feb 29 in a non-leap year
+        return date(day.year + years, *leap_day)
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import ocha_stratus as stratus
+from sqlalchemy import create_engine, make_url, text
+
+from src.constants import (
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_STATEMENT_TIMEOUT_MS,
+    DB_URL,
+    RASTER_STATS_WATERMARK_TTL,
+    STAGE,
+)
+from src.utils import tracing
+
+logger = logging.getLogger(__name__)
+
+# stage -> engine, and checkout timings, owned by the current process
+_engines = {}
+_stats = {}
+_pid = None
+_lock = threading.Lock()
+# (stage, table, column) -> (newest date, time it was queried)
+_watermarks = {}
+
+
+def get_engine(stage: str = STAGE):
+    """
+    Get the pooled SQLAlchemy engine of a stage, created once per worker
+    process and kept for its lifetime.
+    """
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # Connections can't be shared with a parent process, so start
+            # with fresh pools after a fork
+            for engine in _engines.values():
+                engine.dispose(close=False)
+            _engines.clear()
+            _stats.clear()
+            _pid = os.getpid()
+        if stage not in _engines:
+            _engines[stage] = _create_engine(stage)
+            _stats[stage] = {
+                "checkouts": 0,
+                "checkout_wait_seconds_total": 0.0,
+                "checkout_wait_seconds_max": 0.0,
+            }
+        return _engines[stage]
+
+
+def _create_engine(stage):
+    url = make_url(DB_URL) if DB_URL else stratus.get_engine(stage).url
+    engine_kwargs = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+    if url.get_backend_name() == "postgresql":
+        engine_kwargs["connect_args"] = {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        }
+    elif url.get_backend_name() == "sqlite":
+        # Local stand-in, where in-memory databases use a pool without
+        # overflow or timeout options
+        engine_kwargs = {"pool_pre_ping": True}
+    return create_engine(url, **engine_kwargs)
+
+
+@contextmanager
+def connect(stage: str = STAGE):
+    """
+    Check out a connection from the pool of a stage, recording how long the
+    checkout took. The whole block is traced as the "db" phase.
+    """
+    engine = get_engine(stage)
+    with tracing.span("db"):
+        start = time.perf_counter()
+        con = engine.connect()
+        wait = time.perf_counter() - start
+        with _lock:
+            stats = _stats[stage]
+            stats["checkouts"] += 1
+            stats["checkout_wait_seconds_total"] += wait
+            stats["checkout_wait_seconds_max"] = max(
+                stats["checkout_wait_seconds_max"], wait
+            )
+        try:
+            yield con
+        finally:
+            con.close()
+
+
+def warm_pool(stage: str = STAGE, n_connections: int = DB_POOL_SIZE):
+    """
+    Open `n_connections` connections at once and return them to the pool, so
+    that the first requests of a worker don't pay for connection setup.
+    """
+
+    def checkout(_):
+        with connect(stage):
+            time.sleep(0.1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            list(executor.map(checkout, range(n_connections)))
+    except Exception as err:
+        logger.warning(f"Could not warm {stage} connection pool: {err!r}")
+
+
+def get_pool_stats():
+    """
+    Get the usage and checkout wait statistics of the pools of this process.
+    """
+    with _lock:
+        stats = {}
+        for stage, engine in _engines.items():
+            pool = engine.pool
+            stats[stage] = {
+                **_stats[stage],
+                "pool_size": getattr(pool, "size", lambda: None)(),
+                "checked_in": getattr(pool, "checkedin", lambda: None)(),
+                "checked_out": getattr(pool, "checkedout", lambda: None)(),
+                "overflow": getattr(pool, "overflow", lambda: None)(),
+            }
+        return stats
+
+
+def get_latest_date(table: str, column: str, stage: str = STAGE):
+    """
+    Get the newest date in a table, queried again at most every
+    `RASTER_STATS_WATERMARK_TTL` seconds. Used to tell when new data has been
+    ingested, and so when cached results are stale.
+    """
+    key = (stage, table, column)
+    now = time.monotonic()
+    cached = _watermarks.get(key)
+    if cached is not None and now - cached[1] < RASTER_STATS_WATERMARK_TTL:
+        return cached[0]
+    with connect(stage) as con:
+        latest = con.execute(
+            text(f"SELECT MAX({column}) FROM {table}")
+        ).scalar()
+    _watermarks[key] = (latest, now)
+    return latest
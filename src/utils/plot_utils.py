@@ -1,8 +1,18 @@
+import base64
+import functools
+import io
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
+import plotly.colors
 import plotly.express as px
 import plotly.graph_objects as go
+from PIL import Image
+from plotly.subplots import make_subplots
+
+from src.constants import COG_HOVER_GRID_SIZE, COG_IMAGE_MAX_SIZE, COG_RENDER
+from src.utils import tracing
 
 
 def blank_plot(center_text=None):
@@ -52,6 +62,7 @@ def blank_plot(center_text=None):
     return fig
 
 
+@tracing.timed("render")
 def plot_floodscan_timeseries(df, issued_date, stat="mean"):
     cur_year = datetime.strptime(issued_date, "%Y-%m-%d").year
 
@@ -111,6 +122,79 @@ def plot_floodscan_timeseries(df, issued_date, stat="mean"):
     return fig
 
 
+@tracing.timed("render")
+def plot_floodscan_series(df_db, df_cog, stat="mean", pixel=None, point=None):
+    """
+    Plot a stat of an admin unit over consecutive days from the database
+    and recomputed from the COGs, to cross-check them, with the values of a
+    pixel on a secondary axis.
+
+    Parameters
+    ----------
+    df_db, df_cog : pandas.DataFrame
+        Stats with a `valid_date` column.
+    pixel : pandas.Series, optional
+        Values of the pixel indexed by date.
+    point : tuple, optional
+        (x, y) of the pixel, for its legend entry.
+    """
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_trace(
+        go.Scatter(
+            x=df_db["valid_date"],
+            y=df_db[stat],
+            mode="lines",
+            name="Database",
+            line=dict(color="#c25048", width=3),
+            hovertemplate="<b>Valid Date:</b> %{x|%Y-%m-%d}<br>"
+            + "<b>Value:</b> %{y:.3f}<extra></extra>",
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=df_cog["valid_date"],
+            y=df_cog[stat],
+            mode="markers",
+            name="COGs",
+            marker=dict(color="#1f77b4", size=7),
+            hovertemplate="<b>Valid Date:</b> %{x|%Y-%m-%d}<br>"
+            + "<b>Value:</b> %{y:.3f}<extra></extra>",
+        )
+    )
+    if pixel is not None:
+        x, y = point
+        fig.add_trace(
+            go.Scatter(
+                x=pixel.index,
+                y=pixel.values,
+                mode="lines",
+                name=f"Pixel ({y:.3f}, {x:.3f})",
+                line=dict(color="#888888", width=1, dash="dot"),
+                hovertemplate="<b>Valid Date:</b> %{x|%Y-%m-%d}<br>"
+                + "<b>Value:</b> %{y:.3f}<extra></extra>",
+            ),
+            secondary_y=True,
+        )
+        fig.update_yaxes(
+            title_text="Pixel flooded fraction", range=[0, 1], secondary_y=True
+        )
+    fig.update_layout(
+        template="simple_white",
+        xaxis_title="Date",
+        yaxis_title=stat,
+        height=350,
+        margin={"l": 0, "r": 0, "t": 50, "b": 10},
+        font=dict(
+            family="Source Sans Pro, sans-serif",
+            color="#888888",  # Colors all text
+        ),
+        title=f"{stat.capitalize()} of Floodscan flooded fraction, "
+        "database vs COGs",
+    )
+    return fig
+
+
+@tracing.timed("render")
 def plot_seas5_timeseries(df, issued_date, stat="mean"):
     cur_year = datetime.strptime(issued_date, "%Y-%m-%d").year
 
@@ -158,27 +242,80 @@ def plot_seas5_timeseries(df, issued_date, stat="mean"):
     return fig
 
 
-def plot_cogs(da, title, units=None, leadtime_units=None):
+@tracing.timed("render")
+def plot_cogs(
+    da,
+    title,
+    units=None,
+    leadtime_units=None,
+    render=COG_RENDER,
+    anomaly=False,
+):
+    """
+    Plot a clipped raster, with one facet per leadtime for 3D rasters.
+
+    With `render="image"` each facet is sent as a colour-mapped PNG, scaled
+    down to at most `COG_IMAGE_MAX_SIZE` pixels, with an invisible coarse
+    heatmap for hover values and the colour bar. Rasters no larger than the
+    hover grid are drawn by the heatmap alone. With
+    `render="heatmap"` the full array is sent as a heatmap.
+
+    With `anomaly`, the raster holds differences from the climatology and is
+    drawn on a diverging colour scale centred on 0.
+    """
     if not units:
         units = da.attrs["units"]
+    colorscale = "Blues"
+    # Flooded fractions of 2D Floodscan rasters are always in [0, 1]
+    zmin, zmax = (0, 1) if len(da.shape) == 2 else (None, None)
+    if anomaly:
+        colorscale = "RdBu"
+        values = da.values
+        zmax = (
+            float(np.nanmax(np.abs(values)))
+            if np.isfinite(values).any()
+            else 0
+        )
+        zmax = zmax or 1
+        zmin = -zmax
     # Eg. if leadtime dimension
-    if len(da.shape) == 3:
+    if len(da.shape) == 3 and render == "image":
+        fig = imshow_compressed(
+            da.values,
+            zmin=zmin,
+            zmax=zmax,
+            colorscale=colorscale,
+            facet_labels=[f"lt={lt}" for lt in da[da.dims[0]].values],
+            facet_col_wrap=4,
+            max_size=COG_IMAGE_MAX_SIZE // 2,
+        )
+    elif len(da.shape) == 2 and render == "image":
+        fig = imshow_compressed(
+            da.values,
+            zmin=zmin,
+            zmax=zmax,
+            colorscale=colorscale,
+            max_size=COG_IMAGE_MAX_SIZE,
+        )
+    elif len(da.shape) == 3:
         fig = px.imshow(
             da.values,
-            color_continuous_scale="Blues",
+            color_continuous_scale=colorscale,
             template="simple_white",
             facet_col=0,
             facet_col_wrap=4,
             labels={"color": units},
+            zmin=zmin,
+            zmax=zmax,
         )
     elif len(da.shape) == 2:
         fig = px.imshow(
             da.values,
-            color_continuous_scale="Blues",
+            color_continuous_scale=colorscale,
             template="simple_white",
             labels={"color": units},
-            zmin=0,
-            zmax=1,
+            zmin=zmin,
+            zmax=zmax,
         )
     fig.update_layout(
         margin={"l": 20, "r": 0, "t": 50, "b": 10},
@@ -188,6 +325,7 @@ def plot_cogs(da, title, units=None, leadtime_units=None):
             color="#888888",  # Colors all text
         ),
         title=title,
+        coloraxis_colorbar_title_text=units,
     )
 
     # This only shows up now for SEAS5
@@ -196,6 +334,149 @@ def plot_cogs(da, title, units=None, leadtime_units=None):
         annotation.text = f"Leadtime: {lead_time} {leadtime_units}"
 
     fig.update_traces(hovertemplate=f"%{{z:.4f}} {units}<extra></extra>")
+    fig.update_traces(
+        hoverinfo="skip", hovertemplate=None, selector=dict(type="image")
+    )
     fig.update_xaxes(showline=False, ticks="", showticklabels=False)
     fig.update_yaxes(showline=False, ticks="", showticklabels=False)
     return fig
+
+
+def imshow_compressed(
+    values,
+    zmin=None,
+    zmax=None,
+    colorscale="Blues",
+    facet_labels=None,
+    facet_col_wrap=4,
+    max_size=COG_IMAGE_MAX_SIZE,
+    hover_size=COG_HOVER_GRID_SIZE,
+):
+    """
+    Draw a raster as losslessly compressed PNG images rather than as heatmap
+    values, which plotly serializes as text.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D (y, x) array, or 3D array with one facet per entry along the first
+        axis. NaN is drawn transparent.
+    zmin, zmax : float, optional
+        Range of the colour scale, by default the range of `values`.
+    colorscale : str, optional
+        Plotly colour scale name.
+    facet_labels : list of str, optional
+        Title of each facet, for 3D arrays.
+    facet_col_wrap : int, optional
+        Number of facets per row.
+    max_size : int, optional
+        Maximum number of image pixels along each side of a facet. Larger
+        arrays are subsampled with nearest neighbour, keeping whole pixels.
+    hover_size : int, optional
+        Maximum number of cells along each side of the hover grid.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+    """
+    facets = values[np.newaxis] if values.ndim == 2 else values
+    auto_zmin, auto_zmax = autoscale(facets)
+    zmin = auto_zmin if zmin is None else zmin
+    zmax = auto_zmax if zmax is None else zmax
+
+    n_cols = min(len(facets), facet_col_wrap)
+    n_rows = -(-len(facets) // n_cols)
+    fig = make_subplots(
+        rows=n_rows,
+        cols=n_cols,
+        subplot_titles=facet_labels,
+        horizontal_spacing=0.02,
+        vertical_spacing=0.1 if facet_labels else 0.02,
+    )
+    height, width = facets.shape[1:]
+    step = max(1, -(-max(height, width) // max_size))
+    hover_step = max(step, -(-max(height, width) // hover_size))
+    lut = _colorscale_lut(colorscale)
+
+    for i, facet in enumerate(facets):
+        row, col = i // n_cols + 1, i % n_cols + 1
+        if hover_step > 1:
+            # Centre of each sampled pixel, in the index space of the array
+            offset = (step - 1) // 2
+            fig.add_trace(
+                go.Image(
+                    source=_to_png_uri(facet[::step, ::step], zmin, zmax, lut),
+                    x0=offset,
+                    dx=step,
+                    y0=offset,
+                    dy=step,
+                ),
+                row=row,
+                col=col,
+            )
+        hover_offset = hover_step // 2
+        fig.add_trace(
+            go.Heatmap(
+                z=facet[hover_offset::hover_step, hover_offset::hover_step],
+                x=np.arange(hover_offset, width, hover_step),
+                y=np.arange(hover_offset, height, hover_step),
+                coloraxis="coloraxis",
+                # Small rasters are drawn by the full resolution hover grid
+                opacity=0 if hover_step > 1 else 1,
+            ),
+            row=row,
+            col=col,
+        )
+    fig.update_layout(
+        template="simple_white",
+        coloraxis=dict(colorscale=colorscale, cmin=zmin, cmax=zmax),
+    )
+    fig.update_yaxes(autorange="reversed")
+    return fig
+
+
+@functools.lru_cache
+def _colorscale_lut(colorscale, n_colors=255):
+    # One palette entry is kept free for transparent NaN pixels
+    colors = plotly.colors.sample_colorscale(
+        colorscale, np.linspace(0, 1, n_colors)
+    )
+    return np.array(
+        [plotly.colors.unlabel_rgb(color) for color in colors], dtype=np.uint8
+    )
+
+
+def autoscale(values):
+    """
+    Get the colour scale range of a raster, from its finite values, or (0, 1)
+    if it has none.
+    """
+    if not np.isfinite(values).any():
+        return 0.0, 1.0
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+
+def _to_png_uri(values, zmin, zmax, lut):
+    encoded = base64.b64encode(_to_png(values, zmin, zmax, lut))
+    return f"data:image/png;base64,{encoded.decode('ascii')}"
+
+
+def to_png(values, zmin, zmax, colorscale="Blues"):
+    """
+    Encode a 2D array as a colour-mapped PNG, with NaN transparent.
+    """
+    return _to_png(values, zmin, zmax, _colorscale_lut(colorscale))
+
+
+def _to_png(values, zmin, zmax, lut):
+    # 8-bit palette image, with index len(lut) for NaN
+    scale = (values - zmin) / (zmax - zmin) if zmax > zmin else values * 0
+    index = np.round(np.clip(scale, 0, 1) * (len(lut) - 1))
+    index = np.where(np.isfinite(index), index, len(lut)).astype(np.uint8)
+
+    # An "L" image becomes "P" once it has a palette
+    image = Image.fromarray(index)
+    image.putpalette(np.vstack([lut, [[0, 0, 0]]]).ravel().tolist())
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", transparency=len(lut))
+    return buffer.getvalue()
@@ -1,8 +1,24 @@
+import hashlib
 import logging
+import os
 
+import dask
 import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import rioxarray as rxr
+import shapely
 import xarray as xr
+from affine import Affine
 from rasterio.enums import Resampling
+from rioxarray.exceptions import NoDataInBounds
+
+from src.constants import MASK_CACHE_DIR, MASK_CACHE_MAX_BYTES
+from src.utils import blockcache
+from src.utils.cache_utils import atomic_write_path
+
+ZONAL_STATS = ["mean", "median", "min", "max", "count", "sum", "std"]
 
 
 def validate_dimensions(ds):
@@ -65,6 +81,17 @@ def upsample_raster(ds, resampled_resolution=0.05, logger=None):
         )
         ds = ds.rio.write_crs("EPSG:4326")
 
+    # Nearest neighbour upsampling by an integer factor on the same grid is a
+    # plain block repeat, which avoids reprojecting each slice separately
+    factor = round(upscale_factor)
+    if factor >= 1 and np.isclose(upscale_factor, factor):
+        logger.debug(f"Upsampling by repeating blocks of {factor} pixels.")
+        return _upsample_block_repeat(ds, factor, fourth_dim)
+
+    return _upsample_reproject(ds, new_height, new_width, fourth_dim)
+
+
+def _upsample_reproject(ds, new_height, new_width, fourth_dim=None):
     if fourth_dim:  # 4D case
         resampled_arrays = []
 
@@ -99,3 +126,476 @@ def upsample_raster(ds, resampled_resolution=0.05, logger=None):
         )
 
     return ds_resampled
+
+
+def _upsample_block_repeat(ds, factor, fourth_dim=None):
+    """
+    Upsample by an integer factor by repeating each pixel into a
+    `factor` x `factor` block across all other dimensions in one pass.
+    Matches `_upsample_reproject` with nearest neighbour resampling, including
+    nodata being converted to NaN.
+    """
+    nodata = ds.rio.nodata
+    values = np.asarray(ds.values)
+    values = values.astype(np.result_type(values.dtype, np.float32))
+    if nodata is not None and not np.isnan(nodata):
+        values[values == nodata] = np.nan
+
+    y_axis, x_axis = ds.get_axis_num("y"), ds.get_axis_num("x")
+    values = np.repeat(values, factor, axis=y_axis)
+    values = np.repeat(values, factor, axis=x_axis)
+
+    transform = ds.rio.transform() * Affine.scale(1 / factor)
+    height, width = values.shape[y_axis], values.shape[x_axis]
+    coords = {
+        name: coord
+        for name, coord in ds.coords.items()
+        if "x" not in coord.dims and "y" not in coord.dims
+    }
+    coords["x"] = transform.c + (np.arange(width) + 0.5) * transform.a
+    coords["y"] = transform.f + (np.arange(height) + 0.5) * transform.e
+    if fourth_dim == "band":
+        # Use the band names instead of integer values, as when reprojecting
+        coords["band"] = [
+            "SFED" if int(band) == 1 else "MFED" for band in ds["band"].values
+        ]
+
+    attrs = {k: v for k, v in ds.attrs.items() if k != "_FillValue"}
+    ds_resampled = xr.DataArray(
+        values, dims=ds.dims, coords=coords, attrs=attrs, name=ds.name
+    )
+    ds_resampled = ds_resampled.rio.write_crs(ds.rio.crs)
+    ds_resampled = ds_resampled.rio.write_transform(transform)
+    return ds_resampled.rio.write_nodata(np.nan, encoded=False)
+
+
+def to_bbox(bounds):
+    """
+    Normalise a bounding box given as a (minx, miny, maxx, maxy) sequence, a
+    shapely geometry or a GeoDataFrame/GeoSeries to a tuple of floats.
+    """
+    if hasattr(bounds, "total_bounds"):
+        bounds = bounds.total_bounds
+    elif hasattr(bounds, "bounds"):
+        bounds = bounds.bounds
+    return tuple(float(b) for b in bounds)
+
+
+def select_overview_level(src, bbox=None, max_size=None):
+    """
+    Select the coarsest overview of an open rasterio dataset that still has
+    at least `max_size` pixels along the longer side of `bbox`.
+
+    Returns
+    -------
+    int or None
+        Index of the overview to pass as `overview_level`, or None to read
+        full resolution data.
+    """
+    factors = src.overviews(1)
+    if not max_size or not factors:
+        return None
+    if bbox is None:
+        width, height = src.width, src.height
+    else:
+        window = rasterio.windows.from_bounds(*bbox, transform=src.transform)
+        # Rounded, since bounds on pixel edges give sizes such as 399.9999
+        width, height = (
+            round(abs(size), 6) for size in (window.width, window.height)
+        )
+    level = None
+    for i, factor in enumerate(factors):
+        if max(width, height) / factor >= max_size:
+            level = i
+    return level
+
+
+def open_cog(path, bbox=None, max_size=None):
+    """
+    Open a COG, optionally reading only the window intersecting `bbox`.
+
+    Without `bbox` the whole raster is opened lazily as a dask array. With
+    `bbox` the raster is opened without dask and sliced to the window padded
+    by one pixel, so that only the internal tiles intersecting it are
+    fetched and decoded once the values are accessed. Windows of remote COGs
+    are read at once through the block cache of `src.utils.blockcache`.
+
+    Parameters
+    ----------
+    path : str
+        Local path or URL of the COG.
+    bbox : tuple, shapely geometry or GeoDataFrame, optional
+        Bounds to read, in the CRS of the raster.
+    max_size : int, optional
+        Display size in pixels along the longer side of the window. When set,
+        the coarsest overview that still has at least this many pixels is read
+        instead of full resolution data.
+
+    Returns
+    -------
+    xarray.DataArray
+    """
+    if bbox is None and not max_size:
+        return rxr.open_rasterio(path, chunks=True)
+
+    if bbox is not None:
+        bbox = to_bbox(bbox)
+    # Only windows are read through the block cache, since dask reads in
+    # other threads than the one that opened the dataset
+    cache_kwargs = blockcache.get_open_kwargs(path) if bbox is not None else {}
+    with rasterio.open(path, **cache_kwargs) as src:
+        overview_level = select_overview_level(src, bbox, max_size)
+
+    open_kwargs = {}
+    if overview_level is not None:
+        open_kwargs["overview_level"] = overview_level
+    if bbox is None:
+        return rxr.open_rasterio(path, chunks=True, **open_kwargs)
+    if cache_kwargs:
+        with rxr.open_rasterio(
+            path, lock=False, **open_kwargs, **cache_kwargs
+        ) as da:
+            return _clip_to_bbox(da, bbox).load()
+    return _clip_to_bbox(rxr.open_rasterio(path, **open_kwargs), bbox)
+
+
+def _clip_to_bbox(da, bbox):
+    # Pad by one pixel, so that pixels partly inside the bbox are kept
+    res_x, res_y = (abs(r) for r in da.rio.resolution())
+    minx, miny, maxx, maxy = bbox
+    return da.rio.clip_box(
+        minx - res_x,
+        miny - res_y,
+        maxx + res_x,
+        maxy + res_y,
+        allow_one_dimensional_raster=True,
+    )
+
+
+def clip(da, gdf, all_touched=False, cache_key=None):
+    """
+    Mask a raster to the geometries of `gdf`, like
+    `da.rio.clip(gdf.geometry, all_touched=all_touched)`.
+
+    With `cache_key`, the rasterized mask is stored as a `.npy` file under
+    `MASK_CACHE_DIR` and memory-mapped by later calls from any worker, so
+    that a detailed boundary is only rasterized once per raster grid and
+    clipping is a slice and a masked select.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Raster to clip, with `y` and `x` dimensions.
+    gdf : geopandas.GeoDataFrame
+        Geometries to clip to, in the CRS of the raster.
+    all_touched : bool, optional
+        Include all pixels touched by the geometries.
+    cache_key : tuple, optional
+        Identifies the geometries in the cache file names, e.g.
+        (iso3, admin level, pcode).
+
+    Raises
+    ------
+    rioxarray.exceptions.NoDataInBounds
+        If no pixel is inside the geometries.
+    """
+    shape = (da.rio.height, da.rio.width)
+    mask = get_mask(
+        gdf.geometry, da.rio.transform(), shape, all_touched, cache_key
+    )
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        raise NoDataInBounds("No data found in bounds.")
+    # Crop to the bounds of the pixels inside, like rio.clip
+    rows = slice(rows[0], rows[-1] + 1)
+    cols = slice(cols[0], cols[-1] + 1)
+    da = da.isel(y=rows, x=cols)
+    da = da.rio.write_transform(da.rio.transform(recalc=True))
+    mask = xr.DataArray(mask[rows, cols], dims=("y", "x"))
+    nodata = da.rio.nodata
+    return da.where(mask, np.nan if nodata is None else nodata)
+
+
+def get_mask(geometries, transform, shape, all_touched=False, cache_key=None):
+    """
+    Rasterize geometries into a boolean mask of the pixels inside them, with
+    the same rules as `rio.clip`, through the on-disk mask cache when
+    `cache_key` is given.
+
+    The cache file name combines `cache_key` with a hash of the grid
+    (transform and shape), `all_touched` and the geometries themselves, so
+    masks of re-uploaded boundaries or other grids are never reused.
+
+    Returns
+    -------
+    numpy.ndarray
+        Read-only mask of `shape`, memory-mapped when cached.
+    """
+    geometries = list(geometries)
+    if cache_key is None:
+        return _rasterize_mask(geometries, transform, shape, all_touched)
+
+    digest = hashlib.sha1(
+        repr((tuple(transform)[:6], tuple(shape), all_touched)).encode()
+    )
+    for geometry in geometries:
+        digest.update(shapely.to_wkb(geometry))
+    name = "_".join(str(part) for part in cache_key)
+    path = os.path.join(MASK_CACHE_DIR, f"{name}_{digest.hexdigest()}.npy")
+    try:
+        mask = np.load(path, mmap_mode="r")
+        os.utime(path)  # Mark as recently used
+        return mask
+    except FileNotFoundError:
+        pass
+
+    mask = _rasterize_mask(geometries, transform, shape, all_touched)
+    tmp_path = atomic_write_path(path)
+    with open(tmp_path, "wb") as f:
+        np.save(f, mask)
+    os.replace(tmp_path, path)
+    _prune_mask_cache()
+    return np.load(path, mmap_mode="r")
+
+
+def _rasterize_mask(geometries, transform, shape, all_touched):
+    return rasterio.features.geometry_mask(
+        geometries,
+        out_shape=shape,
+        transform=transform,
+        all_touched=all_touched,
+        invert=True,
+    )
+
+
+def _prune_mask_cache():
+    # Remove the least recently used masks beyond MASK_CACHE_MAX_BYTES
+    entries = []
+    with os.scandir(MASK_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MASK_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def rasterize_zones(geometries, transform, shape, all_touched=False):
+    """
+    Find the pixels of a grid covered by each of a set of polygons.
+
+    Polygons are burnt into integer label grids aligned with the raster,
+    with the same rules as `rio.clip`. Without `all_touched`, polygons of an
+    admin level don't share pixels and all of them go into a single label
+    grid. With `all_touched`, neighbouring polygons share the pixels along
+    their boundaries, so the polygons are split into a few groups whose
+    windows don't overlap, and each group is burnt into its own label grid.
+
+    Parameters
+    ----------
+    geometries : sequence of shapely geometries
+        The polygons, in the CRS of the grid.
+    transform : affine.Affine
+        Transform of the grid.
+    shape : tuple
+        Height and width of the grid.
+    all_touched : bool, optional
+        Include all pixels touched by the polygons, as in `rio.clip`.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Flat pixel indices and positions in `geometries` of each
+        (pixel, polygon) pair, sorted by polygon.
+    """
+    geometries = list(geometries)
+    valid = [
+        i
+        for i, geometry in enumerate(geometries)
+        if geometry is not None and not geometry.is_empty
+    ]
+    if all_touched:
+        groups = _group_disjoint_windows(
+            [geometries[i] for i in valid], transform
+        )
+        groups = [[valid[i] for i in group] for group in groups]
+    else:
+        groups = [valid] if valid else []
+
+    pixels, zones = [np.array([], dtype=np.intp)], [np.array([], dtype=int)]
+    for group in groups:
+        labels = rasterio.features.rasterize(
+            ((geometries[i], i + 1) for i in group),
+            out_shape=shape,
+            transform=transform,
+            fill=0,
+            all_touched=all_touched,
+            dtype="int32",
+        ).ravel()
+        group_pixels = np.flatnonzero(labels)
+        pixels.append(group_pixels)
+        zones.append(labels[group_pixels] - 1)
+    pixels, zones = np.concatenate(pixels), np.concatenate(zones)
+
+    order = np.argsort(zones, kind="stable")
+    return pixels[order], zones[order]
+
+
+def zonal_stats(da, geometries, all_touched=False, zones=None):
+    """
+    Compute `ZONAL_STATS` of every polygon over a raster or a stack of
+    rasters in one vectorized pass.
+
+    The polygons are rasterized once with `rasterize_zones`, and the values
+    of all layers are grouped by (layer, polygon) with a single sort, from
+    which each stat is read per segment with `numpy.bincount` or at the
+    segment bounds. NaN and nodata pixels are ignored, as after `rio.clip`.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Raster with `y` and `x` as its last dimensions, and any number of
+        leading dimensions such as `date`, `band` or `lt`.
+    geometries : sequence of shapely geometries or GeoDataFrame
+        The polygons, in the CRS of the raster.
+    all_touched : bool, optional
+        Include all pixels touched by the polygons, as in `rio.clip`.
+    zones : tuple, optional
+        Output of `rasterize_zones` for the polygons on the grid of `da`, to
+        rasterize them once for several rasters on the same grid.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per combination of leading coordinates and polygon, with the
+        position of the polygon in `geometries` as `zone`. Stats of polygons
+        without valid pixels are NaN, with a count of 0.
+    """
+    if hasattr(geometries, "geometry"):
+        geometries = geometries.geometry
+    geometries = list(geometries)
+    other_dims = [dim for dim in da.dims if dim not in ("y", "x")]
+    da = da.transpose(*other_dims, "y", "x")
+    shape = (da.rio.height, da.rio.width)
+    if zones is None:
+        zones = rasterize_zones(
+            geometries, da.rio.transform(), shape, all_touched
+        )
+    pixels, zones = zones
+
+    n_zones = len(geometries)
+    values = np.asarray(da.values).reshape(-1, shape[0] * shape[1])
+    n_segments = values.shape[0] * n_zones
+    segments = zones + n_zones * np.arange(values.shape[0])[:, np.newaxis]
+    values, segments = values[:, pixels].ravel(), segments.ravel()
+    valid = ~np.isnan(values)
+    nodata = da.rio.nodata
+    if nodata is not None and not np.isnan(nodata):
+        valid &= values != nodata
+    values, segments = values[valid], segments[valid]
+
+    # Sort by segment, then by value within each segment
+    order = np.lexsort((values, segments))
+    values, segments = values[order].astype(np.float64), segments[order]
+    count = np.bincount(segments, minlength=n_segments)
+    starts = np.cumsum(count) - count
+    has_values = count > 0
+    first, last = starts[has_values], (starts + count - 1)[has_values]
+
+    stats = {stat: np.full(n_segments, np.nan) for stat in ZONAL_STATS}
+    stats["count"] = count
+    total = np.bincount(segments, weights=values, minlength=n_segments)
+    stats["sum"][has_values] = total[has_values]
+    stats["mean"][has_values] = total[has_values] / count[has_values]
+    squares = np.bincount(
+        segments,
+        weights=(values - stats["mean"][segments]) ** 2,
+        minlength=n_segments,
+    )
+    stats["std"][has_values] = np.sqrt(squares[has_values] / count[has_values])
+    stats["min"][has_values] = values[first]
+    stats["max"][has_values] = values[last]
+    stats["median"][has_values] = (
+        values[(first + last) // 2] + values[(first + last + 1) // 2]
+    ) / 2
+
+    index = pd.MultiIndex.from_product(
+        [da[dim].values for dim in other_dims] + [range(n_zones)],
+        names=other_dims + ["zone"],
+    )
+    return pd.DataFrame(stats, index=index).reset_index()
+
+
+def lazy_zonal_stats(da, geometries, all_touched=False):
+    """
+    Compute `zonal_stats` over a dask-backed stack chunk by chunk along its
+    first dimension, so that only the chunks being reduced are held in
+    memory. The polygons are rasterized once for all chunks.
+
+    Returns
+    -------
+    dask.delayed.Delayed
+        The frame of `zonal_stats`, once computed.
+    """
+    if hasattr(geometries, "geometry"):
+        geometries = geometries.geometry
+    geometries = list(geometries)
+    zones = rasterize_zones(
+        geometries,
+        da.rio.transform(),
+        (da.rio.height, da.rio.width),
+        all_touched,
+    )
+    dim = da.dims[0]
+    parts, start = [], 0
+    for size in da.chunksizes[dim]:
+        chunk = da.isel({dim: slice(start, start + size)})
+        parts.append(
+            dask.delayed(zonal_stats)(chunk, geometries, all_touched, zones)
+        )
+        start += size
+    return dask.delayed(pd.concat)(parts, ignore_index=True)
+
+
+def _group_disjoint_windows(geometries, transform):
+    # Greedily colour the geometries so that the pixel windows of those with
+    # the same colour, padded by a pixel, don't overlap
+    bounds = np.array([geometry.bounds for geometry in geometries])
+    if len(bounds) == 0:
+        return []
+    inverse = ~transform
+    cols, rows = inverse * (bounds[:, [0, 2]].T, bounds[:, [3, 1]].T)
+    cols, rows = np.sort(cols, axis=0), np.sort(rows, axis=0)
+    boxes = shapely.box(
+        np.floor(cols[0]) - 1,
+        np.floor(rows[0]) - 1,
+        np.ceil(cols[1]),
+        np.ceil(rows[1]),
+    )
+    tree = shapely.STRtree(boxes)
+    left, right = tree.query(boxes, predicate="intersects")
+    order = np.argsort(left, kind="stable")
+    left, right = left[order], right[order]
+    neighbours = np.split(
+        right, np.searchsorted(left, np.arange(1, len(boxes)))
+    )
+
+    colours = np.full(len(geometries), -1)
+    for i, others in enumerate(neighbours):
+        taken = set(colours[others])
+        colour = 0
+        while colour in taken:
+            colour += 1
+        colours[i] = colour
+    return [
+        list(np.flatnonzero(colours == colour))
+        for colour in range(colours.max() + 1)
+    ]
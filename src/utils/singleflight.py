@@ -0,0 +1,250 @@
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import Future
+
+import diskcache
+
+from src.constants import SINGLE_FLIGHT_DIR
+from src.utils.cache_utils import atomic_write_path
+
+logger = logging.getLogger(__name__)
+
+# Seconds a result handed over to waiting processes is kept on disk
+HANDOFF_TTL = 60
+# Seconds before unused lock files are removed
+LOCK_FILE_TTL = 86400
+# Seconds to wait for another process computing the same key, before
+# computing it here
+LOCK_WAIT_TIMEOUT = 120
+
+# Counts of calls per flight and outcome, shared by all processes
+_counts = None
+_counts_pid = None
+_counts_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+class SingleFlight:
+    """
+    Share one in-flight computation between concurrent callers with the same
+    key, e.g. the identical loads fired by cascading callbacks or by several
+    analysts opening the latest date of a country.
+
+    Within a process, callers arriving while the first caller of a key is
+    computing it wait for its result. Across processes, i.e. the workers and
+    the background callback jobs, the computing process holds a lock file
+    under `SINGLE_FLIGHT_DIR`. A process that has to wait for the lock asks
+    the holder to hand its result over through a pickle file, and uses it
+    instead of computing it again. A process that can't get the lock within
+    `LOCK_WAIT_TIMEOUT` seconds, e.g. because the holder is stuck on a hung
+    request, computes the result itself.
+
+    Results are shared between callers, so treat them as read-only.
+
+    Parameters
+    ----------
+    name : str
+        Name of the flight, in the lock file paths and call counts.
+    cross_process : bool, optional
+        Also coalesce calls from other processes. Results must be picklable.
+    """
+
+    def __init__(self, name, cross_process=True):
+        self.name = name
+        self.cross_process = cross_process
+        self._calls = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return `func(*args, **kwargs)`, or the result of the call for `key`
+        already in flight.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the computation. Its `repr` names the lock file.
+        func : callable
+            Computes the result. Its exceptions are raised to every caller
+            waiting for it.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Calls in flight in the parent don't complete in a fork
+                self._calls = {}
+                self._pid = os.getpid()
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            _count(self.name, "coalesced")
+            return future.result()
+
+        try:
+            if self.cross_process:
+                result = self._do_locked(key, func, args, kwargs)
+            else:
+                _count(self.name, "computed")
+                result = func(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                if self._calls.get(key) is future:
+                    del self._calls[key]
+
+    def _do_locked(self, key, func, args, kwargs):
+        directory = os.path.join(SINGLE_FLIGHT_DIR, self.name)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        path = os.path.join(directory, digest)
+        with open(f"{path}.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waiting_since = time.time()
+                # Ask the process computing the key to hand its result over
+                with open(f"{path}.waiting", "a"):
+                    pass
+                if not _wait_for_lock(lock_file, LOCK_WAIT_TIMEOUT):
+                    logger.warning(
+                        f"Timed out waiting for {self.name} {key!r}, "
+                        "computing it here"
+                    )
+                    _count(self.name, "computed")
+                    return func(*args, **kwargs)
+                handoff = _read_handoff(f"{path}.pkl")
+                if handoff is not None and handoff[0] >= waiting_since:
+                    _count(self.name, "handoffs")
+                    return handoff[1]
+            # Keeps the lock file of a key in use from being swept
+            os.utime(f"{path}.lock")
+            try:
+                _count(self.name, "computed")
+                result = func(*args, **kwargs)
+                if os.path.exists(f"{path}.waiting"):
+                    _write_handoff(f"{path}.pkl", result)
+                    _remove(f"{path}.waiting")
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                _sweep()
+
+
+def get_stats():
+    """
+    Get the number of calls of each flight since the server started, summed
+    over all processes:
+
+    - "computed": calls that ran the computation
+    - "coalesced": calls that got the result of a call in the same process
+    - "handoffs": calls that got the result of a call in another process
+    """
+    counts = _get_counts()
+    stats = {}
+    for counter in counts.iterkeys():
+        name, outcome = counter.rsplit("/", 1)
+        stats.setdefault(name, {"computed": 0, "coalesced": 0, "handoffs": 0})[
+            outcome
+        ] = counts.get(counter, 0)
+    return stats
+
+
+def clear_stats():
+    _get_counts().clear()
+
+
+def _count(name, outcome):
+    try:
+        _get_counts().incr(f"{name}/{outcome}")
+    except Exception:
+        # Counts are informative only, never fail the call over them
+        logger.exception(f"Counting {outcome} call of {name} failed")
+
+
+def _get_counts():
+    global _counts, _counts_pid
+    with _counts_lock:
+        if _counts_pid != os.getpid():
+            _counts = diskcache.Cache(
+                os.path.join(SINGLE_FLIGHT_DIR, "counts")
+            )
+            _counts_pid = os.getpid()
+        return _counts
+
+
+def _wait_for_lock(lock_file, timeout):
+    # Polls for the lock with backoff, since flock itself can't time out
+    deadline = time.monotonic() + timeout
+    interval = 0.01
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 0.5)
+
+
+def _read_handoff(path):
+    # (time the result was computed, result), or None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_handoff(path, result):
+    tmp_path = atomic_write_path(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((time.time(), result), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception:
+        # Waiting processes then compute the result themselves
+        logger.exception(f"Handing over {path} failed")
+        _remove(tmp_path)
+
+
+def _sweep():
+    # Remove expired handoffs, and lock files of keys not computed lately, at
+    # most once per HANDOFF_TTL in each process
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < HANDOFF_TTL:
+        return
+    _last_sweep = now
+    for pattern, ttl in [
+        ("*.pkl", HANDOFF_TTL),
+        ("*.waiting", HANDOFF_TTL),
+        ("*.lock", LOCK_FILE_TTL),
+    ]:
+        for path in glob.glob(os.path.join(SINGLE_FLIGHT_DIR, "*", pattern)):
+            try:
+                if now - os.path.getmtime(path) > ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
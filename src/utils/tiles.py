@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+from src.utils import blockcache
+from src.utils.raster import select_overview_level
+
+TILE_SIZE = 256
+# Pixels along each side of previews, which covers global SEAS5 COGs at full
+# resolution
+PREVIEW_SIZE = 1024
+# Half the circumference of the earth in web mercator metres
+ORIGIN_SHIFT = math.pi * 6378137
+
+
+def tile_bounds(z, x, y):
+    """
+    Get the web mercator (EPSG:3857) bounds of an XYZ tile.
+    """
+    tile_span = 2 * ORIGIN_SHIFT / 2**z
+    minx = -ORIGIN_SHIFT + x * tile_span
+    maxy = ORIGIN_SHIFT - y * tile_span
+    return minx, maxy - tile_span, minx + tile_span, maxy
+
+
+def read_preview(path, band, size=PREVIEW_SIZE):
+    """
+    Read a COG band, decimated to at most `size` pixels along each side for
+    larger rasters, which GDAL serves from the overviews.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 array, NaN where the raster has no data.
+    """
+    with rasterio.open(path, **blockcache.get_open_kwargs(path)) as src:
+        step = max(1, -(-max(src.height, src.width) // size))
+        values = src.read(
+            band,
+            out_shape=(-(-src.height // step), -(-src.width // step)),
+            resampling=Resampling.nearest,
+            masked=True,
+        )
+    return values.astype(np.float32).filled(np.nan)
+
+
+def read_tile(path, band, z, x, y, tile_size=TILE_SIZE):
+    """
+    Read one XYZ tile of a COG band, warped to web mercator.
+
+    The coarsest overview that still has at least `tile_size` pixels across
+    the tile is used, and only the source window under the tile is read.
+
+    Parameters
+    ----------
+    path : str
+        Local path or URL of the COG.
+    band : int
+        Band number, starting from 1.
+    z, x, y : int
+        Tile coordinates.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 array of shape (tile_size, tile_size), NaN outside the
+        raster and where it has no data.
+    """
+    bounds = tile_bounds(z, x, y)
+    open_kwargs = blockcache.get_open_kwargs(path)
+    with rasterio.open(path, **open_kwargs) as src:
+        src_bounds = transform_bounds("EPSG:3857", src.crs, *bounds)
+        # Clamp to the raster so the window stays valid at low zoom levels
+        src_bounds = (
+            max(src_bounds[0], src.bounds.left),
+            max(src_bounds[1], src.bounds.bottom),
+            min(src_bounds[2], src.bounds.right),
+            min(src_bounds[3], src.bounds.top),
+        )
+        if src_bounds[0] >= src_bounds[2] or src_bounds[1] >= src_bounds[3]:
+            return np.full((tile_size, tile_size), np.nan, dtype=np.float32)
+        overview_level = select_overview_level(src, src_bounds, tile_size)
+
+    if overview_level is not None:
+        open_kwargs["overview_level"] = overview_level
+    with rasterio.open(path, **open_kwargs) as src:
+        with WarpedVRT(
+            src,
+            crs="EPSG:3857",
+            transform=from_bounds(*bounds, tile_size, tile_size),
+            width=tile_size,
+            height=tile_size,
+            resampling=Resampling.nearest,
+            src_nodata=src.nodata,
+            nodata=np.nan,
+            dtype="float32",
+        ) as vrt:
+            return vrt.read(band)
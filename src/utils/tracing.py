@@ -0,0 +1,396 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+import flask
+from dash.exceptions import PreventUpdate
+
+from src.constants import METRICS_FLUSH_INTERVAL, METRICS_PATH, TRACING
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(9))  # 1 KiB to 64 MiB
+
+HISTOGRAMS = {
+    "dsci_callback_duration_seconds": (
+        "Time spent in Dash callbacks",
+        DURATION_BUCKETS,
+    ),
+    "dsci_callback_phase_seconds": (
+        "Time spent in each phase of Dash callbacks",
+        DURATION_BUCKETS,
+    ),
+    "dsci_callback_response_bytes": (
+        "Size of the Dash callback responses sent to the browser",
+        SIZE_BUCKETS,
+    ),
+}
+
+# Phase name -> seconds, of the callback running in the current context
+_trace = ContextVar("trace", default=None)
+# (histogram name, labels) -> [bucket counts..., sum, count], observed by
+# this process since the last flush
+_histograms = {}
+_lock = threading.Lock()
+_last_flush = 0.0
+_flusher_pid = None
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("trace", "phase", "start")
+
+    def __init__(self, trace, phase):
+        self.trace = trace
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.trace[self.phase] = self.trace.get(self.phase, 0.0) + elapsed
+        return False
+
+
+def span(phase):
+    """
+    Time a block as a phase of the traced callback running in the current
+    context, e.g. `with tracing.span("db"): ...`. Time spent in the same
+    phase is summed over the callback.
+
+    Outside traced callbacks, or with tracing disabled, this is a no-op.
+    """
+    trace = _trace.get() if TRACING else None
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, phase)
+
+
+def timed(phase):
+    """
+    Decorator timing every call of a function as a phase, see `span`.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(app):
+    """
+    Trace the callbacks registered through the returned app when
+    `TRACING` is set, and return `app` itself otherwise.
+
+    Each traced callback records its duration, the time spent in the phases
+    timed with `span`, and the size of its response. Dash serializes the
+    outputs once the callback has returned, so the time between the return
+    and the response is recorded as the "serialize" phase. Each call is
+    logged as one JSON line.
+    """
+    if not TRACING:
+        return app
+    _configure_json_logs()
+    server = app.server
+
+    @server.before_request
+    def _start_request_timer():
+        flask.g.dsci_request_start = time.perf_counter()
+        flask.g.dsci_request_pid = os.getpid()
+
+    @server.after_request
+    def _record_response(response):
+        call = flask.g.pop("dsci_callback", None)
+        if call is not None:
+            request_elapsed = time.perf_counter() - flask.g.dsci_request_start
+            call["phases"]["serialize"] = max(
+                0.0, request_elapsed - call["duration"]
+            )
+            call["duration"] = request_elapsed
+            call["response_bytes"] = response.calculate_content_length()
+            _record(call)
+        return response
+
+    return _TracedApp(app)
+
+
+class _TracedApp:
+    # Registers callbacks on the wrapped app with tracing, and forwards
+    # everything else to it
+    def __init__(self, app):
+        self._app = app
+
+    def callback(self, *args, **kwargs):
+        register = self._app.callback(*args, **kwargs)
+        return lambda func: register(_traced(func))
+
+    def __getattr__(self, name):
+        return getattr(self._app, name)
+
+
+def _traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = {}
+        token = _trace.set(trace)
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            status = "prevent_update"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            call = {
+                "callback": func.__name__,
+                "status": status,
+                "duration": time.perf_counter() - start,
+                "phases": trace,
+                "response_bytes": None,
+            }
+            _trace.reset(token)
+            if _handling_request():
+                # Completed by `_record_response` once Dash has serialized
+                # the outputs
+                flask.g.dsci_callback = call
+            else:
+                # Background jobs run in short-lived processes, with a copy
+                # of the request context, so their observations are written
+                # at once
+                _record(call)
+                flush_metrics()
+
+    # dash-extensions reads the arguments with `inspect.getfullargspec`,
+    # which doesn't follow `__wrapped__`
+    wrapper.__signature__ = inspect.signature(func)
+    return wrapper
+
+
+def _handling_request():
+    return (
+        flask.has_request_context()
+        and flask.g.get("dsci_request_pid") == os.getpid()
+    )
+
+
+def _record(call):
+    labels = (("callback", call["callback"]), ("status", call["status"]))
+    _observe("dsci_callback_duration_seconds", labels, call["duration"])
+    for phase, seconds in call["phases"].items():
+        _observe(
+            "dsci_callback_phase_seconds",
+            (("callback", call["callback"]), ("phase", phase)),
+            seconds,
+        )
+    if call["response_bytes"] is not None:
+        _observe(
+            "dsci_callback_response_bytes",
+            (("callback", call["callback"]),),
+            call["response_bytes"],
+        )
+    logger.info(
+        json.dumps(
+            {
+                "event": "callback",
+                "time": time.time(),
+                "pid": os.getpid(),
+                "callback": call["callback"],
+                "status": call["status"],
+                "duration_ms": round(call["duration"] * 1000, 2),
+                "phases_ms": {
+                    phase: round(seconds * 1000, 2)
+                    for phase, seconds in call["phases"].items()
+                },
+                "response_bytes": call["response_bytes"],
+            }
+        )
+    )
+    if time.monotonic() - _last_flush > METRICS_FLUSH_INTERVAL:
+        flush_metrics()
+
+
+def _observe(name, labels, value):
+    buckets = HISTOGRAMS[name][1]
+    with _lock:
+        counts = _histograms.get((name, labels))
+        if counts is None:
+            counts = _histograms[(name, labels)] = [0] * (len(buckets) + 3)
+        # Buckets are cumulative when rendered, here each value is counted
+        # in the first bucket it fits, or in the +Inf bucket
+        counts[bisect_left(buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+def flush_metrics():
+    """
+    Add the observations of this process since the last flush to the
+    histograms in `METRICS_PATH`, shared by the workers and the background
+    job processes.
+    """
+    global _histograms, _last_flush
+    with _lock:
+        observed, _histograms = _histograms, {}
+        _last_flush = time.monotonic()
+    rows = [
+        (name, json.dumps(labels), slot, value)
+        for (name, labels), counts in observed.items()
+        for slot, value in enumerate(counts)
+        if value
+    ]
+    if not rows:
+        return
+    with _connect() as con:
+        con.executemany(
+            """
+            INSERT INTO histograms VALUES (?, ?, ?, ?)
+            ON CONFLICT (name, labels, slot)
+            DO UPDATE SET value = value + excluded.value
+            """,
+            rows,
+        )
+
+
+def start_flushing():
+    """
+    Flush the observations of this process every `METRICS_FLUSH_INTERVAL`
+    seconds on a background thread, so that those of an idle worker still
+    reach /metrics. Threads don't survive forks, so call this in each worker
+    process.
+
+    With tracing disabled, this is a no-op.
+    """
+    global _flusher_pid
+    if not TRACING:
+        return
+    with _lock:
+        started = _flusher_pid == os.getpid()
+        _flusher_pid = os.getpid()
+    if not started:
+        thread = threading.Thread(
+            target=_flush_periodically, name="flush-metrics", daemon=True
+        )
+        thread.start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except Exception:
+            logger.exception("Flushing metrics failed")
+
+
+def clear_metrics():
+    """
+    Remove the histograms of previous runs, when the server starts.
+    """
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(METRICS_PATH + suffix):
+            os.remove(METRICS_PATH + suffix)
+
+
+def render_metrics():
+    """
+    Render the histograms of all processes in the Prometheus text format.
+    """
+    flush_metrics()
+    totals = {}
+    if os.path.exists(METRICS_PATH):
+        with _connect() as con:
+            rows = con.execute(
+                "SELECT name, labels, slot, value FROM histograms"
+            ).fetchall()
+        for name, labels, slot, value in rows:
+            if name not in HISTOGRAMS:
+                continue
+            labels = tuple(tuple(label) for label in json.loads(labels))
+            n_slots = len(HISTOGRAMS[name][1]) + 3
+            totals.setdefault((name, labels), [0] * n_slots)[slot] = value
+
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (key_name, labels), counts in sorted(totals.items()):
+            if key_name != name:
+                continue
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), counts[:-2]):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{{{label_str},le="{bound}"}} {cumulative:g}'
+                )
+            lines.append(f"{name}_sum{{{label_str}}} {counts[-2]}")
+            lines.append(f"{name}_count{{{label_str}}} {int(counts[-1])}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def _connect():
+    os.makedirs(os.path.dirname(METRICS_PATH), exist_ok=True)
+    con = sqlite3.connect(METRICS_PATH, timeout=30)
+    try:
+        with con:  # Commits unless the block raises
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS histograms (
+                    name TEXT,
+                    labels TEXT,
+                    slot INTEGER,
+                    value REAL,
+                    PRIMARY KEY (name, labels, slot)
+                )
+                """
+            )
+            yield con
+    finally:
+        con.close()
+
+
+def _configure_json_logs():
+    # Callback records are JSON lines on stderr, whatever the root logger's
+    # format
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
@@ -0,0 +1,381 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from rasterio.errors import RasterioIOError
+from rioxarray.exceptions import NoDataInBounds
+from sqlalchemy import text
+
+from src.constants import STAGE
+from src.datasources import codab, floodscan, seas5
+from src.utils import db_utils, raster
+from src.utils.cache_utils import atomic_write_path
+
+logger = logging.getLogger(__name__)
+
+STAT_NAMES = raster.ZONAL_STATS
+REPORT_COLUMNS = [
+    "dataset",
+    "date",
+    "iso3",
+    "adm_level",
+    "pcode",
+    "layer",
+    "stat",
+    "raster_value",
+    "db_value",
+    "abs_diff",
+    "issue",
+]
+
+
+def get_tasks(dataset, iso3s=None, stage=STAGE):
+    """
+    List the (iso3, admin level) pairs to validate: those with admin units
+    in the `polygon` table, up to the `max_adm_level` of the countries of
+    the `iso3` table that have the dataset.
+    """
+    with db_utils.connect(stage) as conn:
+        df_iso3 = pd.read_sql(
+            "select iso3, max_adm_level, floodscan from iso3", con=conn
+        )
+        df_levels = pd.read_sql(
+            "select distinct iso3, adm_level from polygon", con=conn
+        )
+    if dataset == "floodscan":
+        df_iso3 = df_iso3[df_iso3["floodscan"].astype(bool)]
+    if iso3s:
+        df_iso3 = df_iso3[df_iso3["iso3"].str.upper().isin(iso3s)]
+    df = df_levels.merge(df_iso3[["iso3", "max_adm_level"]], on="iso3")
+    df = df[df["adm_level"] <= df["max_adm_level"]]
+    return [
+        (row.iso3, int(row.adm_level))
+        for row in df.sort_values(["iso3", "adm_level"]).itertuples()
+    ]
+
+
+def run_validation(
+    dataset,
+    date,
+    output_path,
+    checkpoint_dir=None,
+    iso3s=None,
+    max_workers=None,
+    rtol=1e-3,
+    atol=1e-6,
+):
+    """
+    Recompute the zonal stats of every admin unit of the `polygon` table
+    from the COGs of a date and compare them with the stats tables,
+    writing the discrepancies to a Parquet report.
+
+    Each iso3 and admin level is validated in a separate process. The
+    discrepancies of completed tasks are checkpointed to `checkpoint_dir`,
+    so that an interrupted run resumes where it stopped. Failed tasks are
+    reported but not checkpointed, so they are retried on the next run.
+
+    Parameters
+    ----------
+    dataset : str
+        "floodscan" or "seas5".
+    date : str
+        Valid date (floodscan) or issue date (seas5), as YYYY-MM-DD.
+    output_path : str
+        Path of the Parquet report.
+    checkpoint_dir : str, optional
+        Directory of the per-task results, defaults to `output_path` with a
+        ".checkpoint" suffix.
+    iso3s : list of str, optional
+        Only validate these countries.
+    max_workers : int, optional
+        Number of worker processes, defaults to the number of CPUs.
+    rtol, atol : float, optional
+        Tolerances of the comparison, as in `numpy.isclose`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The discrepancy report.
+    """
+    if checkpoint_dir is None:
+        checkpoint_dir = f"{output_path}.checkpoint"
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    tasks = get_tasks(dataset, iso3s)
+    pending = [
+        task
+        for task in tasks
+        if not os.path.exists(
+            _checkpoint_path(checkpoint_dir, dataset, date, *task)
+        )
+    ]
+    logger.info(
+        f"Validating {dataset} {date}: {len(tasks)} tasks, "
+        f"{len(tasks) - len(pending)} already checkpointed"
+    )
+
+    failed = []
+    # Spawned workers don't inherit the parent's threads, pools or GDAL state
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers, mp_context=context) as pool:
+        futures = {
+            pool.submit(
+                _run_task,
+                dataset,
+                date,
+                iso3,
+                adm_level,
+                rtol,
+                atol,
+                _checkpoint_path(
+                    checkpoint_dir, dataset, date, iso3, adm_level
+                ),
+            ): (iso3, adm_level)
+            for iso3, adm_level in pending
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            iso3, adm_level = futures[future]
+            try:
+                df_failed = future.result()
+            except Exception as err:
+                # E.g. BrokenProcessPool after a worker was killed, which
+                # fails all pending tasks. They are retried on the next run
+                logger.error(f"Validation of {iso3} adm{adm_level} failed")
+                df_failed = _failed_report(dataset, date, iso3, adm_level, err)
+            if df_failed is not None:
+                failed.append(df_failed)
+            logger.info(f"[{i}/{len(pending)}] {iso3} adm{adm_level} done")
+
+    paths = [
+        _checkpoint_path(checkpoint_dir, dataset, date, *task)
+        for task in tasks
+    ]
+    parts = [pd.read_parquet(path) for path in paths if os.path.exists(path)]
+    df_report = _as_report(pd.concat(parts + failed, ignore_index=True))
+    tmp_path = atomic_write_path(os.path.abspath(output_path))
+    df_report.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    return df_report
+
+
+def validate_admin_level(dataset, date, iso3, adm_level, rtol, atol):
+    """
+    Compare the stats of the admin units of a country and admin level in the
+    `polygon` table with stats recomputed from the COGs.
+
+    The `polygon` table has no geometries, so the boundaries come from the
+    COD-AB. Admin units missing from it are reported as "missing_in_codab".
+
+    Returns
+    -------
+    pandas.DataFrame
+        Discrepancies in the columns of `REPORT_COLUMNS`.
+    """
+    pcode_col = f"ADM{adm_level}_PCODE"
+    pcodes = load_polygon_pcodes(iso3, adm_level)
+    gdf = codab.load_codab(iso3, adm_level)
+    gdf = gdf[gdf[pcode_col].isin(pcodes)]
+    missing_in_codab = sorted(set(pcodes) - set(gdf[pcode_col]))
+    df_db = load_db_stats(dataset, date, iso3, adm_level)
+    try:
+        layers = open_layers(dataset, date, gdf)
+    except (RasterioIOError, NoDataInBounds) as err:
+        logger.warning(f"No raster for {dataset} {date} {iso3}: {err}")
+        layers = {}
+    df_raster = compute_stats(layers, gdf, pcode_col)
+    df_issues = compare_stats(df_raster, df_db, rtol, atol)
+    df_issues = pd.concat(
+        [
+            df_issues[~df_issues["pcode"].isin(missing_in_codab)],
+            pd.DataFrame(
+                {"pcode": missing_in_codab, "issue": "missing_in_codab"}
+            ),
+        ],
+        ignore_index=True,
+    )
+    df_issues = df_issues.assign(
+        dataset=dataset, date=date, iso3=iso3, adm_level=adm_level
+    )
+    return _as_report(df_issues)
+
+
+def load_polygon_pcodes(iso3, adm_level, stage=STAGE):
+    query = text(
+        "SELECT pcode FROM polygon WHERE iso3 = :iso3 AND adm_level = :adm_level"
+    )
+    with db_utils.connect(stage) as conn:
+        df = pd.read_sql(
+            query, con=conn, params={"iso3": iso3, "adm_level": adm_level}
+        )
+    return df["pcode"].tolist()
+
+
+def load_db_stats(dataset, date, iso3, adm_level, stage=STAGE):
+    if dataset == "floodscan":
+        layer, date_column = "band", "valid_date"
+    else:
+        layer, date_column = "leadtime", "issued_date"
+    query = text(
+        f"""
+        SELECT pcode, {layer} AS layer, {", ".join(STAT_NAMES)}
+        FROM {dataset}
+        WHERE
+            iso3 = :iso3
+            AND adm_level = :adm_level
+            AND {date_column} = :date
+        """
+    )
+    with db_utils.connect(stage) as conn:
+        df = pd.read_sql(
+            query,
+            con=conn,
+            params={"iso3": iso3, "adm_level": adm_level, "date": date},
+        )
+    return df.astype({"layer": str})
+
+
+def open_layers(dataset, date, gdf):
+    """
+    Read the COG windows covering `gdf` and upsample them like the stats
+    pipeline does.
+
+    Returns
+    -------
+    dict
+        Band name (floodscan) or leadtime (seas5), as a string, to a 2D
+        DataArray.
+    """
+    if dataset == "floodscan":
+        return {
+            band: raster.upsample_raster(
+                floodscan.open_floodscan_rasters(date, band, bbox=gdf)
+            ).squeeze("date", drop=True)
+            for band in floodscan.FLOODSCAN_BANDS
+        }
+    da = seas5.open_seas5_rasters(date, bbox=gdf)
+    missing = da.attrs["missing_leadtimes"]
+    da = raster.upsample_raster(da)
+    return {
+        str(lt): da.sel(lt=lt).squeeze("date", drop=True)
+        for lt in da["lt"].values
+        if lt not in missing
+    }
+
+
+def compute_stats(layers, gdf, pcode_col):
+    """
+    Compute `STAT_NAMES` over the pixels of each layer whose centres fall
+    inside each admin unit, for all units and layers in one pass.
+    """
+    if not layers:
+        return pd.DataFrame(columns=["pcode", "layer", *STAT_NAMES])
+    da = xr.concat(
+        list(layers.values()),
+        dim=pd.Index(list(layers), name="layer"),
+        coords="minimal",
+        compat="override",
+    )
+    df = raster.zonal_stats(da, gdf)
+    df["pcode"] = gdf[pcode_col].values[df["zone"]]
+    return df[["pcode", "layer", *STAT_NAMES]]
+
+
+def compare_stats(df_raster, df_db, rtol, atol):
+    """
+    Match recomputed and stored stats by pcode and layer, and list the stats
+    that differ beyond the tolerances and the rows missing on either side.
+    """
+    df = df_raster.merge(
+        df_db,
+        on=["pcode", "layer"],
+        how="outer",
+        suffixes=("_raster", "_db"),
+        indicator=True,
+    )
+    issues = []
+
+    missing_in_db = df[
+        (df["_merge"] == "left_only") & (df["count_raster"] > 0)
+    ]
+    issues.append(
+        missing_in_db[["pcode", "layer"]].assign(issue="missing_in_db")
+    )
+    missing_raster = df[df["_merge"] == "right_only"]
+    issues.append(
+        missing_raster[["pcode", "layer"]].assign(issue="missing_in_raster")
+    )
+
+    df_both = df[df["_merge"] == "both"]
+    for stat in STAT_NAMES:
+        raster_value = df_both[f"{stat}_raster"].astype(float)
+        db_value = df_both[f"{stat}_db"].astype(float)
+        close = np.isclose(
+            raster_value, db_value, rtol=rtol, atol=atol, equal_nan=True
+        )
+        df_stat = df_both.loc[~close, ["pcode", "layer"]].assign(
+            stat=stat,
+            raster_value=raster_value[~close],
+            db_value=db_value[~close],
+            abs_diff=(raster_value - db_value).abs()[~close],
+            issue="mismatch",
+        )
+        issues.append(df_stat)
+    return pd.concat(issues, ignore_index=True)
+
+
+def _run_task(dataset, date, iso3, adm_level, rtol, atol, checkpoint_path):
+    try:
+        df = validate_admin_level(dataset, date, iso3, adm_level, rtol, atol)
+    except Exception as err:
+        logger.exception(f"Validation of {iso3} adm{adm_level} failed")
+        return _failed_report(dataset, date, iso3, adm_level, err)
+    tmp_path = atomic_write_path(checkpoint_path)
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, checkpoint_path)
+    return None
+
+
+def _failed_report(dataset, date, iso3, adm_level, err):
+    return _as_report(
+        pd.DataFrame(
+            [
+                {
+                    "dataset": dataset,
+                    "date": date,
+                    "iso3": iso3,
+                    "adm_level": adm_level,
+                    "issue": f"error: {err!r}",
+                }
+            ]
+        )
+    )
+
+
+def _checkpoint_path(checkpoint_dir, dataset, date, iso3, adm_level):
+    return os.path.join(
+        checkpoint_dir,
+        f"{dataset}_{date}_{iso3.lower()}_adm{adm_level}.parquet",
+    )
+
+
+def _as_report(df):
+    df = df.reindex(columns=REPORT_COLUMNS)
+    return df.astype(
+        {
+            "dataset": "string",
+            "date": "string",
+            "iso3": "string",
+            "adm_level": "Int64",
+            "pcode": "string",
+            "layer": "string",
+            "stat": "string",
+            "raster_value": "float64",
+            "db_value": "float64",
+            "abs_diff": "float64",
+            "issue": "string",
+        }
+    )
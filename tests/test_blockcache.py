@@ -0,0 +1,212 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import diskcache
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.utils import blockcache
+
+BLOCK_SIZE = 16
+
+
+class RangeServer:
+    """
+    Serves one blob with HEAD and range requests, and records the requests
+    it gets.
+    """
+
+    def __init__(self, data, etag="v1"):
+        self.data = data
+        self.etag = etag
+        self.ignore_range = False
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                server.requests.append(("HEAD", None))
+                self.send_response(200)
+                self.send_header("ETag", f'"{server.etag}"')
+                self.send_header("Content-Length", str(len(server.data)))
+                self.end_headers()
+
+            def do_GET(self):
+                byte_range = self.headers.get("Range")
+                server.requests.append(("GET", byte_range))
+                if_match = self.headers.get("If-Match")
+                if if_match is not None and if_match != f'"{server.etag}"':
+                    self.send_response(412)
+                    self.end_headers()
+                    return
+                data = server.data
+                if byte_range is None or server.ignore_range:
+                    self.send_response(200)
+                else:
+                    start, end = byte_range.removeprefix("bytes=").split("-")
+                    data = data[int(start) : int(end) + 1]
+                    self.send_response(206)
+                self.send_header("ETag", f'"{server.etag}"')
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_port}/blob.tif"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def update(self, data, etag):
+        self.data = data
+        self.etag = etag
+
+    def gets(self):
+        return [
+            byte_range
+            for method, byte_range in self.requests
+            if method == "GET"
+        ]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def block_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE", True)
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE_BLOCK_SIZE", BLOCK_SIZE)
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE_PREFETCH_BYTES", 0)
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE_ETAG_TTL", 600)
+    monkeypatch.setattr(blockcache, "_heads", {})
+    cache = diskcache.Cache(str(tmp_path / "blocks"))
+    monkeypatch.setattr(blockcache, "_get_blocks_cache", lambda: cache)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def server():
+    server = RangeServer(bytes(range(256)) * 4)
+    yield server
+    server.close()
+
+
+def read(url, start, n_bytes):
+    with blockcache.CachedBlobFile(url) as f:
+        f.seek(start)
+        return f.read(n_bytes)
+
+
+def test_reads_aligned_blocks(server):
+    assert read(server.url, 20, 20) == server.data[20:40]
+    # Bytes 20 to 39 span blocks 1 and 2
+    assert server.gets() == ["bytes=16-47"]
+
+
+def test_fetches_runs_of_missing_blocks_in_one_request(server):
+    read(server.url, 16, 16)
+    server.requests.clear()
+    assert read(server.url, 0, 80) == server.data[:80]
+    # Block 1 is cached, blocks 0 and 2 to 4 are fetched
+    assert server.gets() == ["bytes=0-15", "bytes=32-79"]
+
+
+def test_prefetches_the_header(server, monkeypatch):
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE_PREFETCH_BYTES", 40)
+    f = blockcache.CachedBlobFile(server.url)
+    assert server.gets() == ["bytes=0-47"]
+    assert f.read(48) == server.data[:48]
+    assert server.gets() == ["bytes=0-47"]
+
+
+def test_serves_cached_blocks_to_other_files(server):
+    read(server.url, 0, 100)
+    server.requests.clear()
+    assert read(server.url, 10, 50) == server.data[10:60]
+    assert server.requests == []
+
+
+def test_fetches_again_when_the_etag_changes(server):
+    read(server.url, 0, 64)
+    server.update(bytes(reversed(server.data)), "v2")
+    blockcache._heads.clear()
+    server.requests.clear()
+    assert read(server.url, 0, 64) == server.data[:64]
+    assert server.gets() == ["bytes=0-63"]
+
+
+def test_starts_over_when_the_blob_changes_before_reading(server):
+    f = blockcache.CachedBlobFile(server.url)
+    # Re-uploaded while the etag of the first version is still cached
+    server.update(bytes(reversed(server.data)), "v2")
+    assert f.read(32) == server.data[:32]
+    assert f.etag == "v2"
+    assert read(server.url, 0, 32) == server.data[:32]
+
+
+def test_raises_when_the_blob_changes_while_reading(server):
+    f = blockcache.CachedBlobFile(server.url)
+    f.read(16)
+    server.update(bytes(reversed(server.data)), "v2")
+    with pytest.raises(blockcache.BlobChangedError):
+        f.read(16)
+    # The next file reads the new version
+    assert read(server.url, 0, 32) == server.data[:32]
+
+
+def test_slices_whole_blob_sent_for_a_range(server):
+    server.ignore_range = True
+    assert read(server.url, 40, 30) == server.data[40:70]
+    assert read(server.url, 1000, 100) == server.data[1000:]
+
+
+def test_times_out_requests_after_the_deadline(server):
+    f = blockcache.CachedBlobFile(server.url)
+    with blockcache.deadline(0.5):
+        assert f.read(16) == server.data[:16]
+        time.sleep(0.5)
+        with pytest.raises(TimeoutError):
+            f.read(16)
+
+
+def test_open_kwargs(server, monkeypatch):
+    assert blockcache.get_open_kwargs("/local/blob.tif") == {}
+    opener = blockcache.get_open_kwargs(server.url)["opener"]
+    with pytest.raises(FileNotFoundError):
+        opener(server.url + ".aux.xml")
+    monkeypatch.setattr(blockcache, "BLOCK_CACHE", False)
+    assert blockcache.get_open_kwargs(server.url) == {}
+
+
+def test_rasterio_reads_through_the_opener(server, tmp_path):
+    values = np.arange(64 * 64, dtype="float32").reshape(64, 64)
+    path = tmp_path / "cog.tif"
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=64,
+        height=64,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(30, 6, 0.1, 0.1),
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as dst:
+        dst.write(values, 1)
+    server.update(path.read_bytes(), "v1")
+
+    window = rasterio.windows.Window(8, 24, 20, 12)
+    kwargs = blockcache.get_open_kwargs(server.url)
+    with rasterio.open(server.url, **kwargs) as src:
+        np.testing.assert_array_equal(
+            src.read(1, window=window), values[24:36, 8:28]
+        )
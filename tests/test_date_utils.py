@@ -0,0 +1,55 @@
+from datetime import date
+
+import pytest
+
+from src.utils.date_utils import get_yearly_windows
+
+
+@pytest.mark.parametrize(
+    "end_date, days, start_year, end_year, expected",
+    [
+        # Crossing new year, the last window ends in the year after end_year
+        (
+            date(2024, 1, 5),
+            10,
+            2021,
+            2023,
+            [
+                (date(2020, 12, 27), date(2021, 1, 5)),
+                (date(2021, 12, 27), date(2022, 1, 5)),
+                (date(2022, 12, 27), date(2023, 1, 5)),
+                (date(2023, 12, 27), date(2024, 1, 5)),
+            ],
+        ),
+        # Ending on Feb 29, which ends on Feb 28 in non-leap years
+        (
+            date(2024, 2, 29),
+            3,
+            2020,
+            2024,
+            [
+                (date(2020, 2, 27), date(2020, 2, 29)),
+                (date(2021, 2, 27), date(2021, 2, 28)),
+                (date(2022, 2, 27), date(2022, 2, 28)),
+                (date(2023, 2, 27), date(2023, 2, 28)),
+                (date(2024, 2, 27), date(2024, 2, 29)),
+            ],
+        ),
+        # From Feb 28 to Mar 1 of a non-leap year, which skips Feb 29 in
+        # leap years
+        (
+            date(2023, 3, 1),
+            2,
+            2023,
+            2024,
+            [
+                (date(2023, 2, 28), date(2023, 3, 1)),
+                (date(2024, 2, 28), date(2024, 2, 28)),
+                (date(2024, 3, 1), date(2024, 3, 1)),
+            ],
+        ),
+    ],
+)
+def test_get_yearly_windows(end_date, days, start_year, end_year, expected):
+    windows = get_yearly_windows(end_date, days, start_year, end_year)
+    assert windows == expected
@@ -0,0 +1,209 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+import rasterio.shutil
+import rioxarray as rxr
+import xarray as xr
+from rasterio.transform import from_origin
+from rioxarray.exceptions import NoDataInBounds
+from shapely.geometry import box
+
+from src.utils import raster
+
+
+def make_raster(height=10, width=12, seed=0):
+    values = np.random.default_rng(seed).random((height, width))
+    values = values.astype("float32")
+    values[3, 2] = np.nan
+    transform = from_origin(0, height, 1, 1)
+    da = xr.DataArray(
+        values,
+        dims=("y", "x"),
+        coords={
+            "y": height - 0.5 - np.arange(height),
+            "x": 0.5 + np.arange(width),
+        },
+    )
+    return da.rio.write_crs("EPSG:4326").rio.write_transform(transform)
+
+
+# Two neighbours sharing a boundary that cuts through a column of pixels,
+# one polygon inside a pixel away from its centre, and one smaller than a
+# pixel but covering its centre
+POLYGONS = [
+    box(0.2, 1.2, 4.7, 9.1),
+    box(4.7, 1.2, 8.6, 9.1),
+    box(10.1, 2.1, 10.4, 2.4),
+    box(10.3, 6.3, 10.7, 6.7),
+]
+
+
+def clip_stats(da, geometry, all_touched):
+    try:
+        clipped = da.rio.clip([geometry], all_touched=all_touched, drop=True)
+    except NoDataInBounds:
+        values = np.array([])
+    else:
+        values = clipped.values[~np.isnan(clipped.values)].astype(np.float64)
+    if values.size == 0:
+        return {stat: np.nan for stat in raster.ZONAL_STATS} | {"count": 0}
+    return {
+        "mean": values.mean(),
+        "median": np.median(values),
+        "min": values.min(),
+        "max": values.max(),
+        "count": values.size,
+        "sum": values.sum(),
+        "std": values.std(),
+    }
+
+
+@pytest.mark.parametrize("all_touched", [False, True])
+def test_zonal_stats_match_clip(all_touched):
+    da = make_raster()
+    df = raster.zonal_stats(da, POLYGONS, all_touched=all_touched)
+    assert df["zone"].tolist() == list(range(len(POLYGONS)))
+    for zone, geometry in enumerate(POLYGONS):
+        expected = clip_stats(da, geometry, all_touched)
+        row = df.iloc[zone]
+        for stat in raster.ZONAL_STATS:
+            np.testing.assert_allclose(
+                row[stat], expected[stat], rtol=1e-6, err_msg=stat
+            )
+
+
+def test_polygon_smaller_than_a_pixel():
+    da = make_raster()
+    df = raster.zonal_stats(da, POLYGONS[2:], all_touched=False)
+    # Only the polygon covering a pixel centre has a pixel
+    assert df["count"].tolist() == [0, 1]
+    df = raster.zonal_stats(da, POLYGONS[2:], all_touched=True)
+    assert df["count"].tolist() == [1, 1]
+
+
+@pytest.fixture
+def mask_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(raster, "MASK_CACHE_DIR", str(tmp_path))
+    rasterized = []
+    rasterize = raster._rasterize_mask
+
+    def counting_rasterize(*args):
+        rasterized.append(args)
+        return rasterize(*args)
+
+    monkeypatch.setattr(raster, "_rasterize_mask", counting_rasterize)
+    return tmp_path, rasterized
+
+
+@pytest.mark.parametrize("all_touched", [False, True])
+def test_clip_matches_rio_clip(mask_cache, all_touched):
+    da = make_raster()
+    gdf = gpd.GeoDataFrame(geometry=[POLYGONS[0]], crs="EPSG:4326")
+    expected = da.rio.clip(gdf.geometry, all_touched=all_touched, drop=True)
+    for _ in range(2):
+        clipped = raster.clip(
+            da, gdf, all_touched=all_touched, cache_key=("abc", 1, "AB01")
+        )
+        xr.testing.assert_equal(clipped, expected)
+        assert clipped.rio.transform() == expected.rio.transform()
+
+
+def test_clip_reuses_the_cached_mask(mask_cache):
+    tmp_path, rasterized = mask_cache
+    da = make_raster()
+    gdf = gpd.GeoDataFrame(geometry=[POLYGONS[0]], crs="EPSG:4326")
+    raster.clip(da, gdf, cache_key=("abc", 1, "AB01"))
+    raster.clip(da, gdf, cache_key=("abc", 1, "AB01"))
+    assert len(rasterized) == 1
+    assert len(list(tmp_path.glob("abc_1_AB01_*.npy"))) == 1
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"geometries": [POLYGONS[1]]},
+        {"transform": from_origin(1, 10, 1, 1)},
+        {"shape": (8, 12)},
+        {"all_touched": True},
+    ],
+)
+def test_mask_cache_key_covers_its_inputs(mask_cache, change):
+    tmp_path, rasterized = mask_cache
+    inputs = {
+        "geometries": [POLYGONS[0]],
+        "transform": from_origin(0, 10, 1, 1),
+        "shape": (10, 12),
+        "all_touched": False,
+    }
+    raster.get_mask(**inputs, cache_key=("abc", 1, "AB01"))
+    inputs.update(change)
+    mask = raster.get_mask(**inputs, cache_key=("abc", 1, "AB01"))
+    assert len(rasterized) == 2
+    assert len(list(tmp_path.glob("abc_1_AB01_*.npy"))) == 2
+    np.testing.assert_array_equal(mask, raster.get_mask(**inputs))
+
+
+@pytest.fixture
+def cog_path(tmp_path):
+    # Constant over blocks of 8x8 pixels, so that every overview up to a
+    # factor of 8 holds the same values whatever its resampling
+    blocks = np.random.default_rng(0).random((128, 128)).astype("float32")
+    values = np.kron(blocks, np.ones((8, 8), dtype="float32"))
+    src_path = tmp_path / "src.tif"
+    profile = {
+        "driver": "GTiff",
+        "width": 1024,
+        "height": 1024,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:4326",
+        "transform": from_origin(30, 10, 0.01, 0.01),
+    }
+    with rasterio.open(src_path, "w", **profile) as dst:
+        dst.write(values, 1)
+    path = tmp_path / "cog.tif"
+    rasterio.shutil.copy(
+        src_path,
+        path,
+        driver="COG",
+        BLOCKSIZE=128,
+        OVERVIEWS="AUTO",
+        RESAMPLING="NEAREST",
+    )
+    return str(path)
+
+
+# 400 pixels along the longer side, aligned with the blocks of 8 pixels
+BBOX = (30.8, 4.8, 34.8, 8.0)
+
+
+def test_select_overview_level(cog_path):
+    with rasterio.open(cog_path) as src:
+        assert src.overviews(1) == [2, 4, 8]
+        assert raster.select_overview_level(src, BBOX, None) is None
+        # 400 / 4 = 100 pixels is the coarsest still at least 100
+        assert raster.select_overview_level(src, BBOX, 100) == 1
+        assert raster.select_overview_level(src, BBOX, 50) == 2
+        assert raster.select_overview_level(src, BBOX, 500) is None
+        # 1024 / 8 pixels over the whole raster
+        assert raster.select_overview_level(src, None, 128) == 2
+
+
+def test_open_cog_reads_the_window(cog_path):
+    full = rxr.open_rasterio(cog_path).squeeze("band", drop=True)
+    da = raster.open_cog(cog_path, bbox=BBOX).squeeze("band", drop=True)
+    # The window is padded by one pixel
+    assert da.rio.bounds() == pytest.approx((30.79, 4.79, 34.81, 8.01))
+    xr.testing.assert_equal(da, full.sel(x=da["x"], y=da["y"]))
+
+
+def test_open_cog_reads_the_overview(cog_path):
+    full = rxr.open_rasterio(cog_path).squeeze("band", drop=True)
+    da = raster.open_cog(cog_path, bbox=BBOX, max_size=100)
+    da = da.squeeze("band", drop=True)
+    assert da.rio.resolution() == pytest.approx((0.04, -0.04))
+    assert da.rio.bounds() == pytest.approx((30.76, 4.76, 34.84, 8.04))
+    np.testing.assert_array_equal(
+        da.values, full.sel(x=da["x"], y=da["y"], method="nearest").values
+    )